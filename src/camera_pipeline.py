@@ -0,0 +1,190 @@
+import time
+import logging
+from queue import Queue, Empty, Full
+from threading import Thread, Condition
+
+'''
+Capture -> detect -> display pipeline for the GCS camera.
+The capture thread drops each frame into a single slot, overwriting any
+frame the detector has not started on yet, so detection always works on
+the newest frame and never falls behind the stream. Detection results
+are passed to the GUI through a short queue, again dropping the oldest
+when the GUI is slow.
+Every result carries monotonic timestamps for each stage so latency and
+rates can be measured. A frame whose processing raises is counted and
+skipped, the workers carry on with the next one.
+'''
+
+
+class LatestSlot():
+    '''
+    Holds only the most recent item, put never blocks
+    '''
+
+    def __init__(self):
+        self.cond = Condition()
+        self.item = None
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if self.item is None:
+                self.cond.wait(timeout)
+            item, self.item = self.item, None
+            return item
+
+
+class StageStats():
+    '''
+    Exponentially weighted mean latency and event rate for a stage
+
+    :param alpha: weight of the newest sample
+    '''
+
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.latency = 0.
+        self.count = 0
+        self._t0 = time.monotonic()
+        self._n0 = 0
+
+    def add(self, latency):
+        self.latency += self.alpha * (latency - self.latency) if self.count else latency
+        self.count += 1
+
+    def rate(self):
+        now = time.monotonic()
+        r = (self.count - self._n0) / max(now - self._t0, 1e-9)
+        self._t0, self._n0 = now, self.count
+        return r
+
+
+class CameraPipeline():
+    '''
+    Runs process(frame) on the newest captured frame in worker threads
+    and queues the results for the GUI
+
+    :param process: callable taking a frame and returning a dict of results
+    :param workers: number of detection threads
+    :param depth: results kept for the GUI before the oldest is dropped
+    :param logger: logger for processing errors
+    '''
+
+    def __init__(self, process, workers=1, depth=2, logger=None):
+        self.process = process
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.slot = LatestSlot()
+        self.results = Queue(maxsize=depth)
+        self.frame_id = 0
+        self.last_shown = -1
+        self.dropped_results = 0
+        self.errors = 0
+
+        self.capture = StageStats()
+        self.queued = StageStats()
+        self.detect = StageStats()
+        self.display = StageStats()
+
+        self.workers = [Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, frame):
+        '''
+        Capture stage, offer a new frame. Never blocks
+
+        :param frame: camera image
+        '''
+        self.frame_id += 1
+        self.capture.add(0.)
+        self.slot.put((self.frame_id, time.monotonic(), frame))
+
+    def _work(self):
+        while True:
+            item = self.slot.get(timeout=1.)
+            if item is None:
+                continue
+            frame_id, t_capture, frame = item
+            t_start = time.monotonic()
+            try:
+                result = self.process(frame)
+            except Exception:
+                self.errors += 1
+                # The first error in full, then every 100th
+                if self.errors == 1 or self.errors % 100 == 0:
+                    self.logger.exception(f'Camera frame {frame_id} failed, {self.errors} errors')
+                continue
+            t_done = time.monotonic()
+            result.update(frame_id=frame_id, t_capture=t_capture, t_start=t_start, t_done=t_done)
+            self.queued.add(t_start - t_capture)
+            self.detect.add(t_done - t_start)
+
+            while True:
+                try:
+                    self.results.put_nowait(result)
+                    break
+                except Full:
+                    try:
+                        self.results.get_nowait()
+                        self.dropped_results += 1
+                    except Empty:
+                        pass
+
+    def latest(self):
+        '''
+        Newest result not yet shown, or None. Called from the GUI thread,
+        records the capture to display latency
+        '''
+        result = None
+        while True:
+            try:
+                r = self.results.get_nowait()
+            except Empty:
+                break
+            if r['frame_id'] > self.last_shown:
+                result = r
+                self.last_shown = r['frame_id']
+        if result is not None:
+            self.display.add(time.monotonic() - result['t_capture'])
+        return result
+
+    def stats(self):
+        '''
+        Per stage rates (fps) and mean latencies (s), dropped frames and
+        results, and frames that failed processing
+        '''
+        return {
+            'capture_fps': self.capture.rate(),
+            'detect_fps': self.detect.rate(),
+            'display_fps': self.display.rate(),
+            'queue_latency': self.queued.latency,
+            'detect_latency': self.detect.latency,
+            'display_latency': self.display.latency,
+            'dropped_frames': self.slot.dropped,
+            'dropped_results': self.dropped_results,
+            'errors': self.errors,
+        }
+
+
+if __name__ == '__main__':
+    import numpy as np
+
+    def slow_detect(frame):
+        time.sleep(0.02)
+        return {'mean': frame.mean()}
+
+    pipeline = CameraPipeline(slow_detect, workers=2)
+    frame = np.zeros((1080,1920,3),dtype=np.uint8)
+    t = time.monotonic()
+    while time.monotonic() - t < 2.:
+        pipeline.submit(frame)
+        time.sleep(1/60.)
+        pipeline.latest()
+    print({k: round(v, 4) for k, v in pipeline.stats().items()})
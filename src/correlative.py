@@ -0,0 +1,149 @@
+import numpy as np
+
+from scan_likelihood import beam_vectors
+
+'''
+Multi-resolution correlative scan matching for global localisation.
+Level k of the map pyramid holds, at each pixel, the max of the base
+grid over the 2^k x 2^k block starting at that pixel. Scoring a scan
+against level k at (x,y) is then an upper bound on its score at every
+translation in that block, so the full (x, y, heading) search can be
+done by branch and bound: coarse blocks whose bound is below the best
+full resolution score found so far are never expanded.
+
+Hess, Kohler, Rapp and Andor, "Real-Time Loop Closure in 2D LIDAR SLAM", 2016
+Olson, "Real-Time Correlative Scan Matching", 2009
+'''
+
+LEVELS = 6
+HEADING_STEP = 1.
+MAX_BEAMS = 180
+
+
+class CorrelativeMatcher():
+    '''
+    Branch and bound scan matcher over a max pooled map pyramid
+
+    :param grid: per pixel beam score, e.g. np.exp of a likelihood field
+    :param levels: number of pyramid levels above full resolution
+    :param margin: zero padding around the map, at least the max beam range
+    '''
+
+    def __init__(self, grid, levels=LEVELS, margin=256):
+        self.shape = grid.shape
+        self.levels = levels
+        self.margin = margin
+        base = np.zeros((grid.shape[0] + 2*margin + (1 << levels),
+                         grid.shape[1] + 2*margin + (1 << levels)), dtype=np.float32)
+        base[margin:margin+grid.shape[0], margin:margin+grid.shape[1]] = grid
+        self.pyramid = [base]
+        for k in range(1, levels + 1):
+            prev = self.pyramid[-1]
+            step = 1 << (k - 1)
+            level = prev.copy()
+            np.maximum(level[:, :-step], prev[:, step:], out=level[:, :-step])
+            np.maximum(level[:-step, :], level[step:, :].copy(), out=level[:-step, :])
+            self.pyramid.append(level)
+
+    def _offsets(self, scan, angles, headings):
+        # Integer beam end points for every heading, (headings, beams)
+        bx, by = beam_vectors(scan, angles)
+        if len(bx) > MAX_BEAMS:
+            keep = np.linspace(0, len(bx) - 1, MAX_BEAMS).astype(int)
+            bx, by = bx[keep], by[keep]
+        h = np.radians(headings)[:,None]
+        ox = np.rint(np.cos(h)*bx - np.sin(h)*by).astype(np.int64)
+        oy = np.rint(np.sin(h)*bx + np.cos(h)*by).astype(np.int64)
+        ox = np.clip(ox, -self.margin, self.margin)
+        oy = np.clip(oy, -self.margin, self.margin)
+        return ox, oy
+
+    def _score(self, level, hi, x, y, ox, oy):
+        grid = self.pyramid[level]
+        m = self.margin
+        return grid[y[:,None] + oy[hi] + m, x[:,None] + ox[hi] + m].sum(axis=1)
+
+    def match(self, scan, angles, x_range=None, y_range=None, h_range=(-180., 180.),
+              heading_step=HEADING_STEP, min_score=0.):
+        '''
+        Exhaustive (x, y, heading) search, returning the best pose
+
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        :param x_range: (min, max) x to search, defaults to the whole map
+        :param y_range: (min, max) y to search, defaults to the whole map
+        :param h_range: (min, max) heading to search in degrees
+        :param heading_step: heading resolution in degrees
+        :param min_score: only accept poses scoring above this (mean per beam)
+        :return: pose (x, y, heading) and mean score per beam, or None, 0
+        '''
+        x_range = x_range or (0, self.shape[1])
+        y_range = y_range or (0, self.shape[0])
+        headings = np.arange(h_range[0], h_range[1], heading_step)
+        ox, oy = self._offsets(scan, angles, headings)
+        beams = ox.shape[1]
+
+        # Root nodes at the coarsest level, one per block and heading
+        size = 1 << self.levels
+        gx, gy = np.meshgrid(np.arange(x_range[0], x_range[1], size),
+                             np.arange(y_range[0], y_range[1], size))
+        gx, gy = gx.ravel(), gy.ravel()
+        hi = np.repeat(np.arange(len(headings)), len(gx))
+        x = np.tile(gx, len(headings))
+        y = np.tile(gy, len(headings))
+        score = self._score(self.levels, hi, x, y, ox, oy)
+        order = np.argsort(score)
+        stack = [(self.levels, hi[i], x[i], y[i], score[i]) for i in order]
+
+        best_score = min_score * beams
+        best = None
+        child = np.array([[0,0],[1,0],[0,1],[1,1]])
+        while stack:
+            level, h, x0, y0, s = stack.pop()
+            if s <= best_score:
+                continue
+            if level == 0:
+                best_score = s
+                best = (x0, y0, h)
+                continue
+            # Split the block into its four children at the next level
+            half = 1 << (level - 1)
+            cx = x0 + half * child[:,0]
+            cy = y0 + half * child[:,1]
+            inside = (cx < x_range[1]) & (cy < y_range[1])
+            cx, cy = cx[inside], cy[inside]
+            ch = np.full(len(cx), h)
+            cs = self._score(level - 1, ch, cx, cy, ox, oy)
+            for i in np.argsort(cs):
+                if cs[i] > best_score:
+                    stack.append((level - 1, h, cx[i], cy[i], cs[i]))
+
+        if best is None:
+            return None, 0.
+        x0, y0, h = best
+        return (float(x0), float(y0), float(headings[h])), float(best_score / beams)
+
+
+if __name__ == '__main__':
+    import time
+    import cv2
+    import likelihood_field
+
+    static_map = np.zeros((500,500),dtype=np.uint8)
+    cv2.rectangle(static_map,(100,100),(300,389),255,1)
+    cv2.rectangle(static_map,(244,149),(300,318),255,1)
+    t = time.perf_counter()
+    matcher = CorrelativeMatcher(np.exp(likelihood_field.build_field(static_map)))
+    print(f'pyramid {(time.perf_counter()-t)*1e3:.1f}ms')
+
+    true = (180., 250., 30.)
+    angles = np.linspace(np.radians(0),np.radians(360),720)
+    r = np.arange(1,250)
+    h = np.radians(true[2]) + angles
+    x = np.clip(true[0] + np.outer(np.cos(h), r), 0, 499).astype(int)
+    y = np.clip(true[1] + np.outer(np.sin(h), r), 0, 499).astype(int)
+    scan = (static_map[y, x] > 0).argmax(axis=1) + 1.
+
+    t = time.perf_counter()
+    pose, score = matcher.match(scan, angles)
+    print(f'true {true} found {pose} score {score:.3f} in {(time.perf_counter()-t)*1e3:.1f}ms')
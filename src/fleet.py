@@ -0,0 +1,177 @@
+import time
+
+import numpy as np
+
+'''
+Per vessel state for the WAM-V GCS when several vessels share the
+telemetry port.
+Packets are demultiplexed by sender address into one row each of a
+structured array. A batch of packets is parsed into column lists first
+and written with one fancy assignment per field, the newest packet per
+vessel winning, and all vessels with new fixes are projected to UTM in a
+single pyproj call. Per packet work is just the split and the float
+conversions, whatever the size of the fleet.
+'''
+
+VESSEL = np.dtype([
+    ('lat', np.float64), ('lon', np.float64), ('hdg', np.float32),
+    ('x', np.float64), ('y', np.float64),
+    ('port', np.int16), ('stbd', np.int16),
+    ('t_fix', np.float64), ('t_hlc', np.float64),
+    ('packets', np.int64), ('fixes', np.int64),
+])
+
+
+class Fleet():
+    '''
+    Vessel records keyed by telemetry sender address
+
+    :param proj: pyproj.Proj from lon, lat to x, y
+    :param command_port: vessels take commands on their sender IP at this
+                         port, None to reply to the sender address
+    :param capacity: initial number of records, doubled when full
+    '''
+
+    def __init__(self, proj, command_port=None, capacity=16):
+        self.proj = proj
+        self.command_port = command_port
+        self.data = np.zeros(capacity, dtype=VESSEL)
+        self.index = {}
+        self.addrs = []
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def row(self, addr):
+        '''
+        Record number for a sender, adding a vessel the first time
+
+        :param addr: sender (host, port)
+        '''
+        i = self.index.get(addr)
+        if i is None:
+            i = self.index[addr] = len(self.addrs)
+            self.addrs.append(addr)
+            if i == len(self.data):
+                self.data = np.concatenate((self.data, np.zeros(len(self.data), dtype=VESSEL)))
+        return i
+
+    def name(self, i):
+        return f'{self.addrs[i][0]}:{self.addrs[i][1]}'
+
+    def command_addr(self, i):
+        '''
+        Where commands for vessel i are sent
+        '''
+        host, port = self.addrs[i]
+        return (host, port if self.command_port is None else self.command_port)
+
+    def ingest(self, packets):
+        '''
+        Apply a batch of received packets
+
+        :param packets: (receive time, sender, fields) as from UdpReceiver.drain
+        :return: rows with new fixes, rows with new HLC states, and the
+                 (sender, fields) of packets that could not be parsed
+        '''
+        rows = []
+        fix_rows, lat, lon, hdg, t_fix = [], [], [], [], []
+        hlc_rows, port, stbd, t_hlc = [], [], [], []
+        bad = []
+        for t_recv, addr, fields in packets:
+            i = self.index.get(addr)
+            if i is None:
+                i = self.row(addr)
+            rows.append(i)
+            try:
+                if fields[0] == 'N2K':
+                    la, lo, hd = float(fields[1]), float(fields[2]), float(fields[4])
+                    fix_rows.append(i)
+                    lat.append(la)
+                    lon.append(lo)
+                    hdg.append(hd)
+                    t_fix.append(t_recv)
+                elif fields[0] == 'HLC':
+                    p, s = int(fields[3]), int(fields[4])
+                    hlc_rows.append(i)
+                    port.append(p)
+                    stbd.append(s)
+                    t_hlc.append(t_recv)
+            except (IndexError, ValueError):
+                bad.append((addr, fields))
+
+        d = self.data
+        if rows:
+            np.add.at(d['packets'], rows, 1)
+        if fix_rows:
+            np.add.at(d['fixes'], fix_rows, 1)
+            # Later packets overwrite earlier ones for the same vessel
+            fix_rows, last = _last(fix_rows)
+            d['lat'][fix_rows] = np.asarray(lat)[last]
+            d['lon'][fix_rows] = np.asarray(lon)[last]
+            d['hdg'][fix_rows] = np.asarray(hdg)[last]
+            d['t_fix'][fix_rows] = np.asarray(t_fix)[last]
+            x, y = self.proj(d['lon'][fix_rows], d['lat'][fix_rows])
+            d['x'][fix_rows] = x
+            d['y'][fix_rows] = y
+        if hlc_rows:
+            hlc_rows, last = _last(hlc_rows)
+            d['port'][hlc_rows] = np.asarray(port)[last]
+            d['stbd'][hlc_rows] = np.asarray(stbd)[last]
+            d['t_hlc'][hlc_rows] = np.asarray(t_hlc)[last]
+        return np.asarray(fix_rows, dtype=np.intp), np.asarray(hlc_rows, dtype=np.intp), bad
+
+
+def _last(rows):
+    # Distinct rows and the batch index of the last packet for each, numpy
+    # leaves the winner of repeated fancy index assignments unspecified
+    rows = np.asarray(rows)
+    unique, first = np.unique(rows[::-1], return_index=True)
+    return unique, len(rows) - 1 - first
+
+
+def benchmark(vessels=(1, 10, 30, 60), rate=20., duration=3., tick=0.1):
+    '''
+    Receive and ingest cost for growing fleets of simulated vessels on
+    loopback, draining at the GUI tick like the GCS. The vessels run in
+    a separate process
+
+    :param vessels: fleet sizes to try
+    :param rate: N2K messages per second per vessel
+    :param duration: seconds per fleet size
+    :param tick: GUI update period (s)
+    '''
+    import socket
+    import multiprocessing
+    import pyproj
+    from udp_telemetry import UdpReceiver
+    from simulators import run_fleet
+
+    proj = pyproj.Proj(proj='utm', zone=55, ellps='WGS84', preserve_units=True)
+    for num in vessels:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        receiver = UdpReceiver(sock)
+        receiver.start()
+        sent = multiprocessing.Queue()
+        sim = multiprocessing.Process(target=run_fleet, args=(sock.getsockname(), num, rate, duration, sent))
+        sim.start()
+        fleet = Fleet(proj)
+        costs, packets = [], 0
+        while sim.is_alive() or not receiver.queue.empty():
+            time.sleep(tick)
+            t = time.perf_counter()
+            batch = receiver.drain()
+            fleet.ingest(batch)
+            costs.append(time.perf_counter() - t)
+            packets += len(batch)
+        sent = sum(sent.get())
+        sim.join()
+        rate_rx, total, kernel, queued, latency = receiver.stats()
+        print(f'{num:3d} vessels: {packets/duration:7.0f} packets/s, {len(fleet)} tracked, '
+              f'ingest {np.mean(costs)*1e3:.2f}ms mean {np.max(costs)*1e3:.2f}ms max per tick, '
+              f'{sent - packets} lost, drops kernel {kernel} queue {queued}')
+
+
+if __name__ == '__main__':
+    benchmark()
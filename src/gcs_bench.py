@@ -0,0 +1,250 @@
+import os
+import sys
+import time
+import socket
+import tempfile
+import tkinter as tk
+
+import numpy as np
+
+from simulators import WamvSim, SikSim, stamp_age, run_fleet
+
+'''
+Load and latency benchmark for the two GCS front ends, driven by the
+local simulators. Each GCS runs its real Tk window and threads while the
+simulator rate is stepped up. For every rate it reports the messages
+processed per second and the end to end latency, from the simulator send
+to the GCS handling the message:
+
+    wamv_gcs.GCS  N2K packets, latency at the GUI thread drain
+    gcs.GCS       LIDAR frames, latency at the SiK thread frame parse
+
+bench_fleet instead grows the number of vessels sending to wamv_gcs.GCS
+and reports the GUI update time alongside the latency.
+
+Only messages sent during each measurement window are counted. A rate
+is sustained when the simulator manages 95% of it, at least 99% of the
+messages sent are processed and the 99th percentile latency stays under
+max_latency. A SiK simulator falling short means the GCS stopped reading
+and the pty filled up.
+Needs a display, run under xvfb-run on a headless machine.
+'''
+
+RATES = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def pump(gcs, duration):
+    # Run the Tk event loop for duration seconds, GCS.update shadows Tk.update
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        tk.Tk.update(gcs)
+        time.sleep(0.001)
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def summarise(name, rate, duration, sent, processed, latency, max_latency):
+    latency = np.array(latency) if len(latency) else np.full(1, np.nan)
+    p50, p99 = np.percentile(latency, [50, 99])
+    ok = sent >= 0.95 * rate * duration and processed >= 0.99 * sent and p99 < max_latency
+    print(f'{name:>5} {rate:6.0f}/s: sent {sent:7d}, processed {processed:7d}, '
+          f'latency p50 {p50*1e3:7.2f}ms p99 {p99*1e3:7.2f}ms {"ok" if ok else "SATURATED"}')
+    return {'rate': rate, 'sent': sent, 'processed': processed, 'p50': p50, 'p99': p99, 'ok': ok}
+
+
+def bench_wamv(rates=RATES, duration=5., max_latency=0.5):
+    '''
+    Step the N2K rate of a WamvSim feeding wamv_gcs.GCS
+
+    :param rates: N2K messages per second to try
+    :param duration: seconds per rate
+    :param max_latency: p99 latency limit for a sustained rate (s)
+    :return: per rate results and the highest sustained rate
+    '''
+    import wamv_gcs
+    wamv_gcs.GCS_ADDR = ('127.0.0.1', free_port())
+    sim = WamvSim(wamv_gcs.GCS_ADDR, ('127.0.0.1', 0), n2k_rate=0.).start()
+    wamv_gcs.WAMV_ADDR = sim.addr
+    wamv_gcs.CMD_PORT = None
+    gcs = wamv_gcs.GCS()
+    gcs.on_enable()
+
+    # Age of every drained N2K packet sent in the measurement window
+    latency = []
+    drain = gcs.link.drain
+    def timed_drain():
+        packets = drain()
+        now = time.monotonic()
+        for t_recv, addr, fields in packets:
+            if fields[0] == 'N2K' and float(fields[-1]) >= sim.started:
+                latency.append(now - float(fields[-1]))
+        return packets
+    gcs.link.drain = timed_drain
+
+    results = []
+    for rate in rates:
+        sim.n2k_rate = rate
+        pump(gcs, 0.5)
+        sim.reset()
+        latency.clear()
+        pump(gcs, duration)
+        sent = sim.n2k_sent
+        sim.n2k_rate = 0.
+        pump(gcs, 0.5)
+        results.append(summarise('wamv', rate, duration, sent, len(latency), latency, max_latency))
+        stats = sim.stats()
+        print(f'{"":>14}commands {stats["commands"]}, period {stats["cmd_period"]*1e3:.2f}ms '
+              f'std {stats["cmd_std"]*1e3:.2f}ms')
+
+    gcs.on_closing()
+    sim.stop()
+    return results, max([r['rate'] for r in results if r['ok']], default=0)
+
+
+def bench_fleet(vessels=(1, 10, 20, 50, 100), rate=10., duration=5., max_latency=0.5):
+    '''
+    Grow the number of vessels, each a WamvSim sending N2K at rate,
+    feeding wamv_gcs.GCS. The vessels run in a separate process
+
+    :param vessels: fleet sizes to try
+    :param rate: N2K messages per second per vessel
+    :param duration: seconds per fleet size
+    :param max_latency: p99 latency limit for a sustained fleet (s)
+    :return: per fleet size results and the largest sustained fleet
+    '''
+    import multiprocessing
+    import wamv_gcs
+    wamv_gcs.GCS_ADDR = ('127.0.0.1', free_port())
+    wamv_gcs.CMD_PORT = None
+    gcs = wamv_gcs.GCS()
+
+    latency = []
+    drain = gcs.link.drain
+    def timed_drain():
+        packets = drain()
+        now = time.monotonic()
+        for t_recv, addr, fields in packets:
+            if fields[0] == 'N2K':
+                latency.append(now - float(fields[-1]))
+        return packets
+    gcs.link.drain = timed_drain
+
+    # Time every GUI update, after() looks the method up on the instance
+    update_times = []
+    update = gcs.update
+    def timed_update():
+        t = time.perf_counter()
+        update()
+        update_times.append(time.perf_counter() - t)
+    gcs.update = timed_update
+    pump(gcs, 1.)
+
+    results = []
+    for num in vessels:
+        sent = multiprocessing.Queue()
+        sim = multiprocessing.Process(target=run_fleet, args=(wamv_gcs.GCS_ADDR, num, rate, duration, sent))
+        latency.clear()
+        update_times.clear()
+        known = len(gcs.fleet)
+        sim.start()
+        while sim.is_alive():
+            pump(gcs, 0.1)
+        pump(gcs, 0.5)
+        sent = sent.get()[0]
+        sim.join()
+        result = summarise('fleet', num * rate, duration, sent, len(latency), latency, max_latency)
+        result['vessels'] = num
+        result['update_mean'] = np.mean(update_times)
+        result['update_max'] = np.max(update_times)
+        result['ok'] = result['ok'] and len(gcs.fleet) - known == num
+        rx_rate, packets, kernel, queued, rx_latency = gcs.link.receiver.stats()
+        print(f'{"":>14}{len(gcs.fleet) - known} vessels tracked, GUI update mean '
+              f'{result["update_mean"]*1e3:.2f}ms max {result["update_max"]*1e3:.2f}ms, '
+              f'drops kernel {kernel} queue {queued}')
+        results.append(result)
+
+    gcs.on_closing()
+    return results, max([r['vessels'] for r in results if r['ok']], default=0)
+
+
+def bench_sik(rates=RATES, duration=5., max_latency=0.5, log=None):
+    '''
+    Step the frame rate of a SikSim feeding gcs.GCS
+
+    :param rates: LIDAR frames per second to try
+    :param duration: seconds per rate
+    :param max_latency: p99 latency limit for a sustained rate (s)
+    :param log: gcs_*.log to replay, synthetic scans if None
+    :return: per rate results and the highest sustained rate
+    '''
+    import gcs as gcs_module
+    sim = SikSim(rate=0., log=log, echo=False).start()
+    gcs_module.SIK_PORT = sim.port
+    gcs_module.CAMERA_URL = ''
+
+    # Age of every parsed frame sent in the measurement window
+    latency = []
+    split_frame = gcs_module.split_frame
+    def timed_split(frame):
+        stamp, ranges = split_frame(frame)
+        age = stamp_age(stamp)
+        if time.monotonic() - age >= sim.started:
+            latency.append(age)
+        return stamp, ranges
+    gcs_module.split_frame = timed_split
+    gcs = gcs_module.GCS()
+
+    results = []
+    for rate in rates:
+        sim.rate = rate
+        pump(gcs, 0.5)
+        sim.reset()
+        latency.clear()
+        pump(gcs, duration)
+        sent, processed = sim.sent, len(latency)
+        sim.rate = 0.
+        pump(gcs, 0.5)
+        results.append(summarise('sik', rate, duration, sent, processed, latency, max_latency))
+
+    gcs_module.split_frame = split_frame
+    gcs.cap.release()
+    gcs.telemetry.close()
+    gcs.recorder.close()
+    gcs.destroy()
+    # The GCS SiK thread has no shutdown, leave its pty open
+    sim.rate = 0.
+    return results, max([r['rate'] for r in results if r['ok']], default=0)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='GCS throughput and latency against the simulators')
+    parser.add_argument('gcs', choices=('wamv', 'sik', 'both', 'fleet'), nargs='?', default='both')
+    parser.add_argument('--rates', type=float, nargs='+', default=RATES, help='message rates to step through')
+    parser.add_argument('--duration', type=float, default=5., help='seconds per rate')
+    parser.add_argument('--max-latency', type=float, default=0.5, help='p99 latency limit (s)')
+    parser.add_argument('--log', default=None, help='gcs_*.log for the SiK simulator to replay')
+    args = parser.parse_args()
+    import wamv_gcs
+    sys.setswitchinterval(wamv_gcs.SWITCH_INTERVAL)
+
+    # Both GCSs write their logs to the working directory
+    if args.log:
+        args.log = os.path.abspath(args.log)
+    os.chdir(tempfile.mkdtemp(prefix='gcs_bench_'))
+    print(f'GCS logs in {os.getcwd()}')
+    if args.gcs in ('wamv', 'both'):
+        results, best = bench_wamv(args.rates, args.duration, args.max_latency)
+        print(f'wamv_gcs: max sustained {best:.0f} N2K/s')
+    if args.gcs == 'fleet':
+        results, best = bench_fleet(duration=args.duration, max_latency=args.max_latency)
+        print(f'wamv_gcs: max sustained {best:.0f} vessels at 10 N2K/s')
+    if args.gcs in ('sik', 'both'):
+        results, best = bench_sik(args.rates, args.duration, args.max_latency, args.log)
+        print(f'gcs: max sustained {best:.0f} frames/s')
@@ -0,0 +1,211 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from telemetry_log import read_binary
+
+'''
+Binary columnar store for GCS text logs.
+A gcs_*.log is converted once into a directory of .npy columns which
+are memory mapped on load:
+
+    lidar_time.npy      datetime64[us] (n,)
+    lidar_scan.npy      uint8 (n, beams)
+    aruco_time.npy      datetime64[us] (m,)
+    aruco_id.npy        int32 (m,)
+    aruco_corners.npy   float32 (m, 8)
+    index_time.npy      datetime64[us] (n+m,) every record in log order
+    index_source.npy    int16 (n+m,) position in meta.json sources
+    index_row.npy       int32 (n+m,) row in the table for that source
+    meta.json           source ids and conversion counts
+'''
+
+LIDAR = 'LIDAR'
+ARUCO = 'ARUCO'
+
+
+def parse_time(fields):
+    '''
+    Log timestamp from the date, time and microsecond fields
+
+    :param fields: split log line
+    '''
+    d, t, us = fields[0], fields[1], fields[2]
+    return np.datetime64(f'{d[:4]}-{d[4:6]}-{d[6:8]}T{t[:2]}:{t[2:4]}:{t[4:6]}.{us:0>6}', 'us')
+
+
+def _records(log_file):
+    # (timestamp, source id, values) from a text or binary telemetry log,
+    # timestamp is None for lines that cannot be parsed
+    if log_file.suffix == '.bin':
+        for stamp, src, values in read_binary(log_file):
+            yield np.datetime64(stamp, 'us'), src, values
+        return
+    with open(log_file) as log:
+        for line in log:
+            fields = line.rstrip('\n').split(',')
+            try:
+                yield parse_time(fields), fields[3], fields[4:]
+            except (ValueError, IndexError):
+                yield None, None, None
+
+
+def convert(log_file, out_dir=None):
+    '''
+    Convert a text or binary GCS log into a columnar store
+
+    :param log_file: gcs_*.log or gcs_*.bin written by gcs.GCS.log_data
+    :param out_dir: output directory, defaults to the log path with a .cols suffix
+    :return: output directory
+    '''
+    log_file = Path(log_file)
+    out_dir = Path(out_dir) if out_dir else log_file.with_suffix('.cols')
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    sources = []
+    source_ids = {}
+    lidar_time, lidar_scan = [], []
+    aruco_time, aruco_id, aruco_corners = [], [], []
+    index = []
+    skipped = 0
+    width = None
+
+    for stamp, src, values in _records(log_file):
+        if stamp is None:
+            skipped += 1
+            continue
+        try:
+            if src == LIDAR:
+                scan = np.array(values, dtype=np.int64).astype(np.uint8)
+                width = width or len(scan)
+                if len(scan) != width:
+                    skipped += 1
+                    continue
+                row = len(lidar_scan)
+                lidar_time.append(stamp)
+                lidar_scan.append(scan)
+            elif src.startswith(ARUCO + '_'):
+                corners = np.array(values, dtype=np.float32)
+                if len(corners) != 8:
+                    skipped += 1
+                    continue
+                row = len(aruco_corners)
+                aruco_time.append(stamp)
+                aruco_id.append(int(src[len(ARUCO)+1:]))
+                aruco_corners.append(corners)
+            else:
+                skipped += 1
+                continue
+        except ValueError:
+            skipped += 1
+            continue
+        if src not in source_ids:
+            source_ids[src] = len(sources)
+            sources.append(src)
+        index.append((stamp, source_ids[src], row))
+
+    width = width or 0
+    np.save(out_dir / 'lidar_time.npy', np.array(lidar_time, dtype='datetime64[us]'))
+    np.save(out_dir / 'lidar_scan.npy', np.array(lidar_scan, dtype=np.uint8).reshape(len(lidar_scan), width))
+    np.save(out_dir / 'aruco_time.npy', np.array(aruco_time, dtype='datetime64[us]'))
+    np.save(out_dir / 'aruco_id.npy', np.array(aruco_id, dtype=np.int32))
+    np.save(out_dir / 'aruco_corners.npy', np.array(aruco_corners, dtype=np.float32).reshape(len(aruco_corners), 8))
+    np.save(out_dir / 'index_time.npy', np.array([i[0] for i in index], dtype='datetime64[us]'))
+    np.save(out_dir / 'index_source.npy', np.array([i[1] for i in index], dtype=np.int16))
+    np.save(out_dir / 'index_row.npy', np.array([i[2] for i in index], dtype=np.int32))
+    with open(out_dir / 'meta.json', 'w') as meta:
+        json.dump({'log': str(log_file), 'sources': sources, 'beams': width,
+                   'lidar': len(lidar_scan), 'aruco': len(aruco_corners), 'skipped': skipped}, meta)
+    return out_dir
+
+
+class GCSLog():
+    '''
+    Memory mapped reader for a converted GCS log
+
+    :param path: directory written by convert
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as meta:
+            self.meta = json.load(meta)
+        self.sources = self.meta['sources']
+
+        load = lambda name: np.load(self.path / f'{name}.npy', mmap_mode='r')
+        self.lidar_time = load('lidar_time')
+        self.lidar_scan = load('lidar_scan')
+        self.aruco_time = load('aruco_time')
+        self.aruco_id = load('aruco_id')
+        self.aruco_corners = load('aruco_corners')
+        self.index_time = load('index_time')
+        self.index_source = load('index_source')
+        self.index_row = load('index_row')
+
+    def __len__(self):
+        return len(self.index_time)
+
+    @property
+    def start(self):
+        return self.index_time[0] if len(self) else None
+
+    def seek(self, stamp):
+        '''
+        Row of the first scan at or after stamp
+
+        :param stamp: np.datetime64, datetime, or seconds from the start of the log
+        '''
+        if isinstance(stamp, (int, float)):
+            stamp = self.start + np.timedelta64(int(stamp * 1e6), 'us')
+        return int(np.searchsorted(self.lidar_time, np.datetime64(stamp, 'us')))
+
+    def scans(self, start=None, stop=None):
+        '''
+        Timestamps and scans in [start, stop)
+
+        :param start: see seek, defaults to the start of the log
+        :param stop: see seek, defaults to the end of the log
+        '''
+        i = 0 if start is None else self.seek(start)
+        j = len(self.lidar_time) if stop is None else self.seek(stop)
+        return self.lidar_time[i:j], self.lidar_scan[i:j]
+
+    def source(self, src_id):
+        '''
+        Timestamps and table rows of every record from one source,
+        e.g. 'LIDAR' or 'ARUCO_3'
+
+        :param src_id: source id as written in the log
+        '''
+        if src_id not in self.sources:
+            return self.index_time[:0], self.index_row[:0]
+        mask = self.index_source == self.sources.index(src_id)
+        return self.index_time[mask], self.index_row[mask]
+
+    def aruco(self, marker_id=None):
+        '''
+        Timestamps and corners of ArUco detections
+
+        :param marker_id: only this marker, defaults to all
+        '''
+        if marker_id is None:
+            return self.aruco_time, self.aruco_id, self.aruco_corners
+        mask = self.aruco_id == marker_id
+        return self.aruco_time[mask], self.aruco_id[mask], self.aruco_corners[mask]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    for log_file in sys.argv[1:]:
+        t = time.perf_counter()
+        out_dir = convert(log_file)
+        t_convert = time.perf_counter() - t
+        t = time.perf_counter()
+        log = GCSLog(out_dir)
+        times, scans = log.scans()
+        scans.sum()
+        t_load = time.perf_counter() - t
+        print(f'{log_file} -> {out_dir}: {len(scans)} scans, {len(log.aruco_id)} aruco, '
+              f'convert {t_convert:.2f}s, load {t_load*1e3:.1f}ms')
@@ -0,0 +1,201 @@
+from threading import Lock
+
+import numpy as np
+import cv2
+
+'''
+Laser view rendering for the GCS.
+Beam direction tables are computed once per scan size and the scan is
+drawn into one of two preallocated images, which are swapped when the
+scan is complete. The GUI only picks the image up when a new scan has
+been drawn since it last looked.
+PoseOverlay draws the static map and the localiser's position
+uncertainty over the scan image in the sensor frame, so the walls line
+up with the scan when the pose estimate is right.
+'''
+
+
+class LaserRenderer():
+    '''
+    Double buffered laser scan image
+
+    :param size: image width and height in pixels
+    :param rings: spacing of range rings in pixels, 0 for none
+    :param decay: fraction of the previous image kept as a trail, 0 for none
+    '''
+
+    def __init__(self, size=400, rings=0, decay=0.):
+        self.size = size
+        self.center = size // 2
+        self.front = np.zeros((size,size),dtype=np.uint8)
+        self.back = np.zeros((size,size),dtype=np.uint8)
+        self.lock = Lock()
+        self.dirty = False
+        self.scans = 0
+
+        self._tables = {}
+        self._decay_lut = (np.arange(256) * decay).astype(np.uint8) if decay else None
+        self.rings = None
+        if rings:
+            yy, xx = np.mgrid[:size,:size] - self.center
+            r = np.hypot(xx, yy)
+            self.rings = np.where(np.abs(r - np.round(r / rings) * rings) < 0.5, 64, 0).astype(np.uint8)
+            self.rings[self.center, self.center] = 0
+
+    def beam_table(self, n):
+        '''
+        cos and sin of each beam for an n beam scan, cached
+
+        :param n: number of beams
+        '''
+        table = self._tables.get(n)
+        if table is None:
+            angles = np.linspace(np.radians(0),np.radians(360),n) + np.pi
+            table = (np.cos(angles), np.sin(angles), np.empty(n), np.empty(n),
+                     np.empty(n, dtype=np.intp), np.empty(n, dtype=np.intp))
+            self._tables[n] = table
+        return table
+
+    def render(self, ranges):
+        '''
+        Draw a scan into the back buffer and make it the front
+
+        :param ranges: beam ranges in pixels
+        '''
+        cos, sin, fx, fy, ix, iy = self.beam_table(len(ranges))
+        np.multiply(ranges, cos, out=fx)
+        np.multiply(ranges, sin, out=fy)
+        fx += self.center
+        fy += self.center
+        np.clip(fx, 0, self.size-1, out=fx)
+        np.clip(fy, 0, self.size-1, out=fy)
+        ix[:] = fx
+        iy[:] = fy
+
+        back = self.back
+        if self._decay_lut is not None:
+            cv2.LUT(self.front, self._decay_lut, dst=back)
+        else:
+            back.fill(0)
+        if self.rings is not None:
+            np.maximum(back, self.rings, out=back)
+        back[ix,iy] = 0xFF
+
+        with self.lock:
+            self.front, self.back = back, self.front
+            self.dirty = True
+            self.scans += 1
+
+    def consume(self, show, force=False):
+        '''
+        Call show(image) with the latest scan image if it has changed
+        since the last call. The image must not be kept after show returns
+
+        :param show: callback taking a (size,size) uint8 image
+        :param force: call show even if the scan has not changed, e.g.
+                      when an overlay has
+        :return: True if show was called
+        '''
+        with self.lock:
+            if not self.dirty and not force:
+                return False
+            self.dirty = False
+            show(self.front)
+        return True
+
+
+class PoseOverlay():
+    '''
+    Static map and pose uncertainty drawn over LaserRenderer images.
+    Map coordinates are pixels indexed [y,x] with heading in degrees, as
+    used by the localiser, and scan ranges are in the same pixels
+
+    :param static_map: greyscale map, walls are bright
+    :param size: laser image width and height in pixels
+    :param threshold: map values above this are walls
+    :param level: grey level of the overlay
+    '''
+
+    def __init__(self, static_map, size=400, threshold=127, level=96):
+        self.size = size
+        self.center = size // 2
+        self.level = level
+        wy, wx = np.nonzero(static_map > threshold)
+        self.walls = np.stack((wx, wy)).astype(np.float64)
+        self.image = np.zeros((size,size),dtype=np.uint8)
+        self.ellipse = np.stack((np.cos(np.linspace(0, 2*np.pi, 33)), np.sin(np.linspace(0, 2*np.pi, 33))))
+        self.pose = None
+        self.text = ''
+
+    def set_pose(self, pose, var=None):
+        '''
+        :param pose: x, y, heading of the sensor in the map
+        :param var: variance of x, y and heading, None for unknown
+        '''
+        self.pose = np.array(pose[:3], dtype=np.float64)
+        self.var = None if var is None or not np.all(np.isfinite(var[:3])) else np.array(var[:3])
+        self.text = f'{pose[0]:6.1f} {pose[1]:6.1f} {pose[2]:+6.1f}'
+        if self.var is not None:
+            sx, sy, sh = np.sqrt(self.var)
+            self.text += f'  sd {sx:.1f} {sy:.1f} {sh:.1f}'
+
+    def to_image(self, points):
+        '''
+        Image (column, row) of map points, (2,n), seen from the pose.
+        LaserRenderer draws sensor frame beam (bx,by) at row center - bx,
+        column center - by
+        '''
+        x, y, h = self.pose
+        c, s = np.cos(np.radians(h)), np.sin(np.radians(h))
+        dx = points[0] - x
+        dy = points[1] - y
+        bx = c*dx + s*dy
+        by = -s*dx + c*dy
+        return np.stack((self.center - by, self.center - bx))
+
+    def draw(self, img):
+        '''
+        Copy of the scan image with the overlay, or the image itself
+        before the first pose
+
+        :param img: LaserRenderer image, not modified
+        '''
+        if self.pose is None:
+            return img
+        out = self.image
+        np.copyto(out, img)
+        col, row = self.to_image(self.walls).astype(np.intp)
+        inside = (col >= 0) & (col < self.size) & (row >= 0) & (row < self.size)
+        row, col = row[inside], col[inside]
+        out[row, col] = np.maximum(out[row, col], self.level)
+        if self.var is not None:
+            # Two sigma position ellipse about the sensor
+            sx, sy = 2. * np.sqrt(self.var[:2])
+            points = self.pose[:2,None] + self.ellipse * np.array([[sx], [sy]])
+            cv2.polylines(out, [np.round(self.to_image(points).T).astype(np.int32)], True, 0xFF)
+        cv2.putText(out, self.text, (4, self.size - 6), cv2.FONT_HERSHEY_PLAIN, 1., 0xFF)
+        return out
+
+
+if __name__ == '__main__':
+    import time
+
+    ranges = np.random.randint(0,255,720).astype(np.uint8)
+    angles = np.linspace(np.radians(0),np.radians(360),len(ranges)) + np.pi
+    num = 2000
+
+    t = time.perf_counter()
+    for _ in range(num):
+        x = (200 + ranges * np.cos(angles)).astype(np.uint8)
+        y = (200 + ranges * np.sin(angles)).astype(np.uint8)
+        img = np.zeros((400,400),dtype=np.uint8)
+        img[x,y] = 0xFF
+    old = (time.perf_counter() - t) / num
+
+    for rings, decay in ((0, 0.), (50, 0.), (50, 0.8)):
+        renderer = LaserRenderer(rings=rings, decay=decay)
+        t = time.perf_counter()
+        for _ in range(num):
+            renderer.render(ranges)
+        dt = (time.perf_counter() - t) / num
+        print(f'rings {rings:2d} decay {decay:.1f}: {dt*1e6:6.1f}us/scan (per scan allocation {old*1e6:6.1f}us)')
@@ -0,0 +1,86 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+'''
+Likelihood field for laser scan scoring.
+The static map is turned into a per-pixel table holding the log
+probability of a beam ending at that pixel, based on the distance to
+the nearest wall:
+
+    p = z_hit * exp(-d**2 / (2 * sigma**2)) + z_rand
+
+The table is built once and cached next to the map image, keyed by a
+hash of the map contents and the field parameters, so it is only
+rebuilt when either changes.
+'''
+
+SIGMA = 2.
+THRESHOLD = 127
+Z_HIT = 0.9
+Z_RAND = 0.1
+
+
+def build_field(static_map, sigma=SIGMA, threshold=THRESHOLD, z_hit=Z_HIT, z_rand=Z_RAND):
+    '''
+    Build a log likelihood table from a static map
+
+    :param static_map: greyscale map, walls are bright
+    :param sigma: beam end point standard deviation in pixels
+    :param threshold: map values above this are walls
+    :param z_hit: weight of the gaussian hit model
+    :param z_rand: weight of the uniform random model
+    '''
+    free = np.where(static_map > threshold, 0, 255).astype(np.uint8)
+    dist = cv2.distanceTransform(free, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    prob = z_hit * np.exp(-dist**2 / (2. * sigma**2)) + z_rand
+    return np.log(prob).astype(np.float32)
+
+
+def field_key(static_map, sigma=SIGMA, threshold=THRESHOLD, z_hit=Z_HIT, z_rand=Z_RAND):
+    '''
+    Hash of the map contents and field parameters
+
+    :param static_map: greyscale map
+    '''
+    h = hashlib.sha1(np.ascontiguousarray(static_map).tobytes())
+    h.update(repr((static_map.shape, sigma, threshold, z_hit, z_rand)).encode())
+    return h.hexdigest()[:16]
+
+
+def load_field(map_file, sigma=SIGMA, threshold=THRESHOLD, z_hit=Z_HIT, z_rand=Z_RAND):
+    '''
+    Load the likelihood field for a map image, building and caching
+    it alongside the map if no up to date copy exists
+
+    :param map_file: path to the map image
+    :return: static map, log likelihood field
+    '''
+    map_file = Path(map_file)
+    static_map = cv2.imread(str(map_file), cv2.IMREAD_GRAYSCALE)
+    if static_map is None:
+        raise FileNotFoundError(map_file)
+    key = field_key(static_map, sigma, threshold, z_hit, z_rand)
+    cache = map_file.with_name(f'{map_file.stem}_lf_{key}.npy')
+    try:
+        field = np.load(cache)
+        if field.shape == static_map.shape:
+            return static_map, field
+    except (OSError, ValueError):
+        pass
+    field = build_field(static_map, sigma, threshold, z_hit, z_rand)
+    try:
+        np.save(cache, field)
+    except OSError:
+        print(f'Could not cache likelihood field {cache}')
+    return static_map, field
+
+
+if __name__ == '__main__':
+    import sys
+    static_map, field = load_field(sys.argv[1])
+    cv2.imshow('field',cv2.normalize(field,None,0,255,cv2.NORM_MINMAX).astype(np.uint8))
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
@@ -0,0 +1,258 @@
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import NULL_METRICS
+
+'''
+Live laser localisation for the GCS.
+The particle filter runs in its own process, started with spawn so it
+shares neither the GIL nor any Tk or serial state with the GUI. Two
+shared memory blocks connect it to the GCS:
+
+    scan slot   the newest scan, written by the SiK thread for each frame
+    pose slot   the newest estimate, written by the filter after each step
+
+Each slot holds a single record behind a sequence counter (a seqlock).
+The writer makes the counter odd, writes, and makes it even again, and a
+reader copies the record and retries if the counter was odd or moved
+meanwhile, so neither side ever blocks the other. The slot only ever
+holds the newest scan, so when the filter falls behind it picks up the
+latest one and the scans in between are counted as skipped rather than
+queued.
+'''
+
+SCAN_HEAD = ('seq', 't_scan')
+POSE = ('seq', 'scan', 't_scan', 't_done', 'step', 'x', 'y', 'h', 'v',
+        'var_x', 'var_y', 'var_h', 'var_v', 'particles', 'skipped')
+P = {name: i for i, name in enumerate(POSE)}
+
+
+def _write(record, seq, values, offset=1):
+    # Seqlock write, one writer per slot
+    seq[0] += 1
+    record[offset:offset+len(values)] = values
+    seq[0] += 1
+
+
+def _read(seq, *arrays):
+    # Seqlock read, copies of arrays and the even sequence number they came from
+    while True:
+        s = seq[0]
+        if s % 2 == 0:
+            copies = [a.copy() for a in arrays]
+            if seq[0] == s:
+                return s, copies
+        time.sleep(0)
+
+
+class LiveLocaliser():
+    '''
+    Particle filter localisation on a separate process, fed one scan at
+    a time
+
+    :param map_file: static map image, as for LaserLocator
+    :param init: initial pose (x, y, heading, speed), None to find it by
+                 global scan matching on the first scan
+    :param std: standard deviation of the initial particles
+    :param num: initial number of particles
+    :param beams: beams per scan
+    :param metrics: metrics.Metrics for pose rate and latency
+    :param locator_args: further LaserLocator arguments, e.g. kld, ndt
+    '''
+
+    def __init__(self, map_file, init=None, std=(5,5,5,1), num=2000, beams=720,
+                 metrics=NULL_METRICS, **locator_args):
+        self.beams = beams
+        self.metrics = metrics
+
+        self.scan_shm = shared_memory.SharedMemory(create=True, size=8*len(SCAN_HEAD) + beams)
+        self.scan_head = np.ndarray(len(SCAN_HEAD), dtype=np.float64, buffer=self.scan_shm.buf)
+        self.scan = np.ndarray(beams, dtype=np.uint8, buffer=self.scan_shm.buf, offset=8*len(SCAN_HEAD))
+        self.scan_head[:] = 0.
+        self.pose_shm = shared_memory.SharedMemory(create=True, size=8*len(POSE))
+        self.pose = np.ndarray(len(POSE), dtype=np.float64, buffer=self.pose_shm.buf)
+        self.pose[:] = 0.
+
+        self.closed = False
+        self.scans = 0
+        self.last_pose = 0
+        self.skipped = 0
+
+        ctx = mp.get_context('spawn')
+        self.ready = ctx.Event()
+        self.stop = ctx.Event()
+        self.process = ctx.Process(target=_worker, daemon=True,
+                                   args=(self.scan_shm.name, self.pose_shm.name, beams, self.ready,
+                                         self.stop, map_file, init, std, num, locator_args))
+        self.process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, ranges, stamp):
+        '''
+        Make a scan the newest, replacing any the filter has not picked
+        up yet. Called from the SiK thread
+
+        :param ranges: beam ranges in pixels, uint8
+        :param stamp: monotonic time the scan was read
+        '''
+        if self.closed:
+            return
+        self.scans += 1
+        seq = self.scan_head[:1]
+        seq[0] += 1
+        self.scan_head[1] = stamp
+        self.scan[:] = ranges
+        seq[0] += 1
+        self.ready.set()
+
+    def latest(self):
+        '''
+        Newest estimate not yet returned, or None. Called from the GUI
+        thread, records the pose rate and scan to pose latency
+
+        :return: dict of the POSE fields
+        '''
+        if self.closed or self.pose[P['seq']] == self.last_pose:
+            return None
+        seq, (pose,) = _read(self.pose[:1], self.pose)
+        self.last_pose = seq
+        result = dict(zip(POSE, pose.tolist()))
+        self.metrics.event('pose')
+        self.metrics.latency('localise', result['t_done'] - result['t_scan'])
+        self.metrics.since('scan to pose', result['t_scan'])
+        if result['skipped'] > self.skipped:
+            self.metrics.event('scans skipped', int(result['skipped'] - self.skipped))
+            self.skipped = result['skipped']
+        return result
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        '''
+        Stop the filter process and release the shared memory
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.stop.set()
+        self.ready.set()
+        self.process.join(5.)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.scan_head = self.scan = self.pose = None
+        for shm in (self.scan_shm, self.pose_shm):
+            shm.close()
+            shm.unlink()
+
+
+def _worker(scan_name, pose_name, beams, ready, stop, map_file, init, std, num, locator_args):
+    import particle_filter_xyh as pf
+    from localiser_ndt import LaserLocator
+
+    scan_shm = shared_memory.SharedMemory(name=scan_name)
+    pose_shm = shared_memory.SharedMemory(name=pose_name)
+    scan_head = np.ndarray(len(SCAN_HEAD), dtype=np.float64, buffer=scan_shm.buf)
+    scan_buf = np.ndarray(beams, dtype=np.uint8, buffer=scan_shm.buf, offset=8*len(SCAN_HEAD))
+    pose = np.ndarray(len(POSE), dtype=np.float64, buffer=pose_shm.buf)
+
+    locator = LaserLocator(init=init or (0.,0.,0.,0.), log_file=None, map_file=map_file, **locator_args)
+    locator.scan_angles = np.linspace(np.radians(0),np.radians(360),beams)
+    particles = None
+    last = 0
+    skipped = 0
+    try:
+        while not stop.is_set():
+            if not ready.wait(0.1):
+                continue
+            ready.clear()
+            seq, (head, ranges) = _read(scan_head[:1], scan_head, scan_buf)
+            if seq == last:
+                continue
+            # Two increments per scan
+            skipped += max(0, int(seq - last) // 2 - 1)
+            last = seq
+            t = time.perf_counter()
+
+            scan, angles = locator.prepare_scan(ranges)
+            if particles is None:
+                if init is None:
+                    found, score = locator.global_localise(scan, angles)
+                    if found is None:
+                        continue
+                particles = pf.gen_gaussian_particles(num=num, std=std,
+                                                      init=(locator.dx, locator.dy, locator.dh, locator.dv))
+            particles, estimate, var, scored = locator.step(particles, scan, angles)
+
+            _write(pose, pose[:1], [seq // 2, head[1], time.monotonic(), time.perf_counter() - t,
+                                    locator.dx, locator.dy, locator.dh, locator.dv,
+                                    *var, particles.shape[0], skipped])
+    finally:
+        locator.close()
+        scan_shm.close()
+        pose_shm.close()
+
+
+def benchmark(rates=(5., 10., 20., 50.), duration=5., num=1000, odometry=(None, 'line')):
+    '''
+    Track the synthetic room of simulators.synthetic_scans, submitting
+    scans at increasing rates as the SiK thread would, and report the
+    pose rate, skipped scans, latency and error against the truth
+
+    :param rates: scans per second to try
+    :param duration: seconds per rate
+    :param num: initial number of particles
+    :param odometry: LaserLocator motion models to compare
+    '''
+    import os
+    import tempfile
+    import cv2
+    from simulators import synthetic_scans
+    from metrics import Metrics
+
+    # The room is 200x120 pixels, the scanner at its centre turning -1 degree per scan
+    room = np.zeros((500,500),dtype=np.uint8)
+    cv2.rectangle(room, (150,190), (350,310), 255, 1)
+    map_file = os.path.join(tempfile.mkdtemp(prefix='live_localiser_'), 'room.png')
+    cv2.imwrite(map_file, room)
+    scans = synthetic_scans()
+
+    for odo, rate in [(odo, rate) for odo in odometry for rate in rates]:
+        metrics = Metrics()
+        with LiveLocaliser(map_file, init=(250., 250., 0., 0.), num=num, metrics=metrics,
+                           min_particles=200, max_particles=num, odometry=odo) as loc:
+            errors = []
+            start = time.monotonic()
+            next_scan = start
+            i = 0
+            while time.monotonic() - start < duration:
+                loc.submit(scans[i % len(scans)], time.monotonic())
+                i += 1
+                next_scan += 1. / rate
+                while time.monotonic() < next_scan:
+                    pose = loc.latest()
+                    if pose is not None:
+                        # The room is symmetric under a half turn
+                        truth = (pose["scan"] - 1) % len(scans)
+                        dh = (pose['h'] - truth + 90.) % 180. - 90.
+                        errors.append((np.hypot(pose['x'] - 250., pose['y'] - 250.), abs(dh)))
+                    time.sleep(0.001)
+            rates_, latency = metrics.snapshot()
+        errors = np.array(errors) if errors else np.full((1,2), np.nan)
+        lat = latency.get('localise', {})
+        print(f'{odo or "none":>5} {rate:5.0f} scans/s: {rates_.get("pose", 0.):5.1f} poses/s, {int(loc.skipped)} of {i} skipped, '
+              f'localise p50 {lat.get("p50", np.nan)*1e3:.1f}ms max {lat.get("max", np.nan)*1e3:.1f}ms, '
+              f'error {np.median(errors[:,0]):.1f}px {np.median(errors[:,1]):.1f}deg')
+
+
+if __name__ == '__main__':
+    benchmark()
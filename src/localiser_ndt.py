@@ -1,19 +1,72 @@
 import numpy as np
-import pandas as pd
 import cv2
+import time
+import argparse
+from datetime import datetime
 
 import particle_filter_xyh as pf
 from particle_filter_xyh import X,Y,H,W,V
+from scan_likelihood import score_particles, score_particles_field, CHUNK_SIZE
+import likelihood_field
+from parallel_scoring import SharedMapScorer
+from gcs_log import GCSLog
+from ndt import NDTMatcher
+from correlative import CorrelativeMatcher
+from scan_odometry import ScanOdometry
+from pathlib import Path
+
+MAP_FILE = '/home/peter/code/AMSL/amsl_gcs/src/survival_pool.png'
+LOG_FILE = '/home/peter/code/AMSL/amsl_gcs/src/logs/20251119_145433/gcs_145433.log'
+
+# Particle jitter per step, x, y, heading, speed. With scan odometry the
+# motion is known, so the jitter is small plus a fraction of each increment
+JITTER = (0.25,0.25,0.25,0.25)
+ODOMETRY_JITTER = (0.05,0.05,0.05,0.)
+MOTION_NOISE = 0.1
 
 class LaserLocator():
-    def __init__(self, init=(0.,0.,0.,0.)):
+    def __init__(self, init=(0.,0.,0.,0.), chunk_size=CHUNK_SIZE, use_field=True, resample_threshold=0.5,
+                 kld=True, min_particles=500, max_particles=10000, workers=0,
+                 log_file=LOG_FILE, display_rate=0., map_file=MAP_FILE, ndt=None,
+                 odometry=None, jitter=None, motion_noise=MOTION_NOISE):
         
-        # Static Base Map
-        self.static_map = cv2.imread('/home/peter/code/AMSL/amsl_gcs/src/survival_pool.png',cv2.IMREAD_GRAYSCALE)
+        # Static Base Map and its likelihood field
+        self.static_map, self.field = likelihood_field.load_field(map_file)
+        self.use_field = use_field
+
+        # NDT scan matching, None, 'refine' the particle filter estimate,
+        # or 'only' to track with NDT alone
+        self.ndt = ndt
+        self.matcher = NDTMatcher(self.static_map) if ndt else None
+
+        # Built on first use by global_localise
+        self.global_matcher = None
+
+        # Scan to scan ICP odometry as the motion model, None, 'line' or
+        # 'point', in place of the constant velocity model
+        self.odometry = ScanOdometry(odometry) if odometry else None
+        self.jitter = np.asarray(jitter if jitter is not None else
+                                 ODOMETRY_JITTER if odometry else JITTER, dtype=np.float64)
+        self.motion_noise = motion_noise
+        self.increment = None
 
         # Laser Scans
         self.scan_angles = np.linspace(np.radians(0),np.radians(360),720)
-        self.laser_file = open('/home/peter/code/AMSL/amsl_gcs/src/logs/20251119_145433/gcs_145433.log')
+        # Either a text gcs_*.log or a columnar store from gcs_log.convert,
+        # or None when scans are passed in live, see live_localiser
+        self.log = None
+        self.laser_file = None
+        if log_file is None:
+            pass
+        elif Path(log_file).is_dir():
+            self.log = GCSLog(log_file)
+            self.scan_row = 0
+        else:
+            self.laser_file = open(log_file)
+        self.scan_time = None
+
+        # Max map view refresh rate in replay, 0 for none
+        self.display_rate = display_rate
 
         # State Estimate
         self.dx = init[0]
@@ -21,93 +74,276 @@ class LaserLocator():
         self.dh = init[2]
         self.dv = init[3]
 
+        # Particles scored per batch, optionally across worker processes
+        self.chunk_size = chunk_size
+        self.scorer = None
+        if workers:
+            self.scorer = SharedMapScorer(self.field if use_field else self.static_map,
+                                          field=use_field, workers=workers, chunk_size=chunk_size)
+
+        # Resample once the effective sample size drops below this fraction
+        self.resample_threshold = resample_threshold
+
+        # KLD-sampling adapts the particle count to the posterior spread
+        # whenever the effective sample size triggers a resample
+        self.kld = kld
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+
+
+    def close(self):
+        if self.scorer is not None:
+            self.scorer.close()
+            self.scorer = None
+
+
+    def prepare_scan(self, ranges):
+        '''
+        Beam ranges and angles of a raw scan, dropping beams with no return
+
+        :param ranges: all beam ranges in pixels, as logged or received
+        '''
+        scan = np.asarray(ranges).astype(np.int64)
+        filt = np.argwhere(scan>1.)
+        return scan[filt], self.scan_angles[filt]
+
 
     def get_next_scan(self):
+        '''
+        Read the next LIDAR scan from the log, dropping beams with no return.
+        The log timestamp of the scan is kept in self.scan_time
+        '''
+        if self.log is not None:
+            if self.scan_row >= len(self.log.lidar_time):
+                return None, None
+            self.scan_time = self.log.lidar_time[self.scan_row].item()
+            scan = self.log.lidar_scan[self.scan_row]
+            self.scan_row += 1
+            return self.prepare_scan(scan)
+        if self.laser_file is None:
+            return None, None
         for line in self.laser_file:
             fields = line.split(',')
             if len(fields) > 4 and fields[3] == 'LIDAR':
-                scan = np.array([int(f) for f in fields[4:]])
-                filt = np.argwhere(scan>1.)
-                return scan[filt], self.scan_angles[filt]
-    
+                self.scan_time = datetime.strptime(f'{fields[0]}{fields[1]}{fields[2]}', '%Y%m%d%H%M%S%f')
+                return self.prepare_scan([int(f) for f in fields[4:]])
+        return None, None
+
 
-    def start_particle_filter(self, std=(10,10,10,10)):
+    def seek(self, seconds):
         '''
-        Utilise a particle filter to estimate the position starting from
-        the initial state
-        
-        :param std: standard deviation of initial particle distribution
+        Skip to the first scan at least this many seconds into the log.
+        Only supported for columnar logs
+
+        :param seconds: offset from the start of the log
         '''
-        particles = pf.gen_gaussian_particles(num=5000,std=std,init=(self.dx, self.dy, self.dh, self.dv))
-        
-        scan,angles = self.get_next_scan()
-        while True:
+        if self.log is None:
+            raise ValueError('seek needs a columnar log, see gcs_log.convert')
+        self.scan_row = self.log.seek(seconds)
 
-            output_grid = np.zeros_like(self.static_map)
-            
 
-            # Calculate likelihood
-            likelihood = []
-            for p in particles:
-                x = p[X] + scan * np.cos(np.radians(p[H]) + angles)
-                y = p[Y] + scan * np.sin(np.radians(p[H]) + angles)
-                x = np.clip(x,0,499)
-                y = np.clip(y,0,499)
-                #laser_grid = np.zeros_like(self.static_map)
-                #laser_grid[y.astype(np.uint16), x.astype(np.uint16)] = 255
-                #laser_corners = cv2.cornerHarris(laser_grid, 10, 3, 0.04)
-                score = self.static_map[y.astype(np.uint16), x.astype(np.uint16)].sum()**2
-                #score = np.multiply(self.static_map, laser_corners).sum()**2
-                likelihood.append(score)
-
-                
-                try:
-                    output_grid[p[X].astype(np.uint16),p[Y].astype(np.uint16)] = 128
-                except:
-                    pass
-            # Update Step
-            particles = pf.update_particles(particles, np.array(likelihood))
-
-            # Estimate
-            estimate, var = pf.estimate(particles)
-            self.dx = estimate[X]
-            self.dy = estimate[Y]
-            self.dh = estimate[H]
-            self.dv = estimate[V]
+    def global_localise(self, scan=None, angles=None):
+        '''
+        Find the pose from scratch with correlative scan matching over the
+        whole map, e.g. at start up or after the filter has lost track.
+        Uses the next scan in the log if none is given
 
-            
-            self.dh = (self.dh+180)%360 - 180
-            x = self.dx + scan * np.cos(np.radians(self.dh) + angles)
-            y = self.dy + scan * np.sin(np.radians(self.dh) + angles)
-            x = np.clip(x,0,499)
-            y = np.clip(y,0,499)
-            output_grid[y.astype(np.uint16),x.astype(np.uint16)] = 255
-            combined = self.static_map + output_grid
-            cv2.imshow('EST',cv2.resize(combined,None,fx=2,fy=2))
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        :return: pose (x, y, heading) and mean beam score, or None, 0
+        '''
+        if scan is None:
+            scan, angles = self.get_next_scan()
+        if self.global_matcher is None:
+            self.global_matcher = CorrelativeMatcher(np.exp(self.field))
+        pose, score = self.global_matcher.match(scan, angles)
+        if pose is not None:
+            self.dx, self.dy, self.dh = pose
+        return pose, score
+
+
+    def step_ndt(self, scan, angles):
+        '''
+        Align the scan with NDT, warm started from the current estimate
 
-            print(estimate)
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        :return: estimate (x, y, heading, speed)
+        '''
+        pose, score, it = self.matcher.align(scan, angles, (self.dx, self.dy, self.dh))
+        self.dx, self.dy, self.dh = pose
+        return np.array([self.dx, self.dy, self.dh, self.dv])
 
-            # Resample
-            particles = pf.resample_particles(particles)
 
-            # Predict Step
+    def step(self, particles, scan, angles, keep_scored=False):
+        '''
+        Run one filter iteration against a scan
+
+        :param particles: particle set
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        :param keep_scored: also return a copy of the weighted particles for display
+        :return: resampled and predicted particles, weighted estimate and
+                 variance, and the scored particles (or None)
+        '''
+        if self.ndt == 'only':
+            estimate = self.step_ndt(scan, angles)
+            return particles, estimate, np.full(4, np.nan), particles if keep_scored else None
+
+        # Odometry moves the particles from the last scan to this one
+        if self.odometry is not None:
+            particles = self.predict_odometry(particles, scan, angles)
+
+        # Calculate likelihood
+        if self.scorer is not None:
+            likelihood = self.scorer.score(particles, scan, angles)
+        elif self.use_field:
+            likelihood = score_particles_field(self.field, particles, scan, angles,
+                                               chunk_size=self.chunk_size)
+        else:
+            likelihood = score_particles(self.static_map, particles, scan, angles,
+                                         chunk_size=self.chunk_size)
+
+        # Update Step
+        particles = pf.update_particles(particles, likelihood)
+        scored = particles.copy() if keep_scored else None
+
+        # Estimate
+        estimate, var = pf.estimate(particles)
+        self.dx = estimate[X]
+        self.dy = estimate[Y]
+        self.dh = (estimate[H]+180)%360 - 180
+        self.dv = estimate[V]
+        if self.ndt == 'refine':
+            estimate = self.step_ndt(scan, angles)
+
+        # Resample, once the effective sample size drops
+        if not self.kld:
+            particles = pf.resample_if_needed(particles, threshold=self.resample_threshold)
+        elif pf.neff(particles) < self.resample_threshold * particles.shape[0]:
+            particles = pf.kld_resample(particles, self.min_particles, self.max_particles)
+
+        # Predict Step, with odometry this happens on the next scan
+        if self.odometry is None:
             particles = pf.predict_particles(particles)
-            particles = pf.jitter_particles(particles)
+            particles = pf.jitter_particles(particles, self.jitter)
+        return particles, estimate, var, scored
 
 
+    def predict_odometry(self, particles, scan, angles):
+        '''
+        Move the particles by the scan odometry increment from the last
+        scan, jittered by the base jitter plus motion_noise times the
+        increment. Without an increment (first scan, failed match) the
+        particles get the constant velocity model's jitter instead
 
-            key = cv2.waitKey(0)
+        :param particles: particle set
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        '''
+        self.increment = self.odometry.step(scan, angles)
+        if self.increment is None:
+            return pf.jitter_particles(particles, JITTER)
+        dx, dy, dh = self.increment
+        particles = pf.predict_particles(particles, self.increment)
+        move = np.array([np.hypot(dx, dy), np.hypot(dx, dy), abs(dh), 0.])
+        return pf.jitter_particles(particles, self.jitter + self.motion_noise * move)
+
+
+    def show_estimate(self, particles, scan, angles, wait=0):
+        '''
+        Draw the particles and the scan at the current estimate over the map
+
+        :param particles: particle set
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        :param wait: cv2.waitKey delay, 0 blocks until a key press
+        :return: key pressed
+        '''
+        output_grid = np.zeros_like(self.static_map)
+
+        px = particles[:,X].astype(np.int64)
+        py = particles[:,Y].astype(np.int64)
+        inside = (px >= 0) & (px < output_grid.shape[0]) & (py >= 0) & (py < output_grid.shape[1])
+        output_grid[px[inside],py[inside]] = 128
+
+        x = self.dx + scan * np.cos(np.radians(self.dh) + angles)
+        y = self.dy + scan * np.sin(np.radians(self.dh) + angles)
+        x = np.clip(x,0,499)
+        y = np.clip(y,0,499)
+        output_grid[y.astype(np.uint16),x.astype(np.uint16)] = 255
+        combined = self.static_map + output_grid
+        cv2.imshow('EST',cv2.resize(combined,None,fx=2,fy=2))
+        return cv2.waitKey(wait)
+
+
+    def start_particle_filter(self, std=(10,10,10,10), num=5000):
+        '''
+        Utilise a particle filter to estimate the position starting from
+        the initial state
+        
+        :param std: standard deviation of initial particle distribution
+        :param num: number of particles
+        '''
+        particles = pf.gen_gaussian_particles(num=num,std=std,init=(self.dx, self.dy, self.dh, self.dv))
+        
+        scan,angles = self.get_next_scan()
+        while scan is not None:
+            particles, estimate, var, scored = self.step(particles, scan, angles, keep_scored=True)
+            print(estimate, particles.shape[0])
+
+            key = self.show_estimate(scored, scan, angles)
             if key == ord('q'):
-                cv2.destroyAllWindows()
                 break
-            else:
+            scan,angles = self.get_next_scan()
+        cv2.destroyAllWindows()
+
+
+    def replay(self, out_file, std=(10,10,10,10), num=5000):
+        '''
+        Headless replay, run every scan in the log through the filter as
+        fast as possible and write the trajectory to out_file as
+        time,x,y,heading,speed,var_x,var_y,var_heading,var_speed,particles
+        The map view is only drawn if display_rate is set, at most that
+        many times per second.
+
+        :param out_file: trajectory output path
+        :param std: standard deviation of initial particle distribution
+        :param num: number of particles
+        :return: scans per second and real-time factor
+        '''
+        particles = pf.gen_gaussian_particles(num=num,std=std,init=(self.dx, self.dy, self.dh, self.dv))
+
+        scans = 0
+        first_time = None
+        last_draw = 0.
+        start = time.perf_counter()
+        with open(out_file, 'w') as out:
+            scan,angles = self.get_next_scan()
+            while scan is not None:
+                first_time = first_time or self.scan_time
+                particles, estimate, var, scored = self.step(particles, scan, angles,
+                                                             keep_scored=bool(self.display_rate))
+                out.write(f'{self.scan_time:%Y%m%d,%H%M%S,%f},{self.dx:.3f},{self.dy:.3f},{self.dh:.3f},{self.dv:.3f},'
+                          f'{var[X]:.4f},{var[Y]:.4f},{var[H]:.4f},{var[V]:.4f},{particles.shape[0]}\n')
+                scans += 1
+
+                now = time.perf_counter()
+                if self.display_rate and now - last_draw > 1./self.display_rate:
+                    last_draw = now
+                    if self.show_estimate(scored, scan, angles, wait=1) == ord('q'):
+                        break
                 scan,angles = self.get_next_scan()
-                if scan is None:
-                    cv2.destroyAllWindows()
-                    break
+        elapsed = time.perf_counter() - start
+        if self.display_rate:
+            cv2.destroyAllWindows()
+
+        rate = scans / elapsed if elapsed else 0.
+        log_span = (self.scan_time - first_time).total_seconds() if scans else 0.
+        rtf = log_span / elapsed if elapsed else 0.
+        print(f'{scans} scans in {elapsed:.2f}s, {rate:.1f} scans/s, real-time factor {rtf:.1f}')
+        return rate, rtf
 
-                    
-        
 
     def start_manual(self):
         scan,angles = self.get_next_scan()
@@ -163,30 +399,35 @@ class LaserLocator():
 
 
 if __name__ == '__main__':
-    locater = LaserLocator(init=(199., 169., -110., 0.))
-    #locater.start_manual()
-    locater.start_particle_filter(std=(1,1,1,1))
-'''    
+    parser = argparse.ArgumentParser(description='Laser localisation from a GCS log')
+    parser.add_argument('log', nargs='?', default=LOG_FILE, help='gcs_*.log to read scans from')
+    parser.add_argument('--start', type=float, default=0., metavar='S', help='seconds into a columnar log to start')
+    parser.add_argument('--map', default=MAP_FILE, help='static map image')
+    parser.add_argument('--replay', metavar='OUT', help='headless replay, write trajectory to OUT')
+    parser.add_argument('--init', type=float, nargs=4, default=(199., 169., -110., 0.), metavar=('X','Y','H','V'))
+    parser.add_argument('--global', dest='global_init', action='store_true',
+                        help='find the initial pose by global scan matching instead of --init')
+    parser.add_argument('--std', type=float, nargs=4, default=(1,1,1,1), metavar=('X','Y','H','V'))
+    parser.add_argument('--num', type=int, default=5000, help='initial number of particles')
+    parser.add_argument('--ndt', choices=('refine','only'), help='NDT refinement of, or in place of, the particle filter')
+    parser.add_argument('--workers', type=int, default=0, help='scoring worker processes')
+    parser.add_argument('--display', type=float, default=0., metavar='HZ', help='replay map view rate')
+    parser.add_argument('--odometry', choices=('line','point'), help='ICP scan odometry motion model')
+    parser.add_argument('--jitter', type=float, nargs=4, metavar=('X','Y','H','V'),
+                        help='particle jitter per step, defaults depend on --odometry')
+    parser.add_argument('--min-particles', type=int, default=500, help='KLD-sampling lower bound')
+    args = parser.parse_args()
 
-    with open('/home/peter/code/AMSL/amsl_gcs/src/logs/20251119_145433/gcs_145433.log') as logfile:
-        for line in logfile:
-            fields = line.split(',')
-            if len(fields) > 4 and fields[3] == 'LIDAR':
-                scan = np.array([int(f)/10. for f in fields[4:]])
-                x = scan * np.cos(angles)
-                y = scan * np.sin(angles)
-                grid = np.zeros((320,320),dtype=np.uint8)
-                grid[x.astype(np.uint8),y.astype(np.uint8)] = 0xFF
-                
-                df = pd.DataFrame({'x':x, 'y':y, 'x_sub':x.round(0),'y_sub':y.round()})
-                m = df.groupby(['x_sub','y_sub']).mean()
-                v = df.groupby(['x_sub','y_sub']).var()
-                print(m)
-                print(v)
-                exit()
-                cv2.imshow('grid',mean)
-                key = cv2.waitKey(0)
-                if key == ord('q'):
-                    cv2.destroyAllWindows()
-                    break
-    '''
+    locater = LaserLocator(init=args.init, log_file=args.log, workers=args.workers,
+                           display_rate=args.display, map_file=args.map, ndt=args.ndt,
+                           odometry=args.odometry, jitter=args.jitter, min_particles=args.min_particles)
+    if args.start:
+        locater.seek(args.start)
+    if args.global_init:
+        print(locater.global_localise())
+    if args.replay:
+        locater.replay(args.replay, std=args.std, num=args.num)
+    else:
+        #locater.start_manual()
+        locater.start_particle_filter(std=args.std, num=args.num)
+    locater.close()
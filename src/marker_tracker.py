@@ -0,0 +1,173 @@
+import time
+
+import numpy as np
+import cv2
+
+'''
+Region of interest tracking for ArUco detection on the camera stream.
+Once markers have been found, each new frame is only searched in a box
+around where they are predicted to be, from their last corners and
+their motion between the last two detections. When the markers are
+missed for a few frames in a row the tracker falls back to a downscaled
+full frame search to pick them up again.
+Results are in the same form as cv2.aruco.detectMarkers.
+'''
+
+
+class MarkerTracker():
+    '''
+    Incremental ArUco detector
+
+    :param aruco_dict: cv2.aruco dictionary
+    :param aruco_params: cv2.aruco detector parameters
+    :param margin: ROI padding as a fraction of the marker box size
+    :param min_pad: minimum ROI padding in pixels
+    :param downscale: scale of the full frame search when not tracking
+    :param max_misses: missed ROI searches before tracking is dropped
+    '''
+
+    def __init__(self, aruco_dict, aruco_params, margin=1.0, min_pad=40,
+                 downscale=0.5, max_misses=3):
+        self.aruco_dict = aruco_dict
+        self.aruco_params = aruco_params
+        self.margin = margin
+        self.min_pad = min_pad
+        self.downscale = downscale
+        self.max_misses = max_misses
+
+        self.corners = None
+        self.velocity = np.zeros(2, dtype=np.float32)
+        self.misses = 0
+
+        self.roi_searches = 0
+        self.full_searches = 0
+
+    def _detect(self, image):
+        return cv2.aruco.detectMarkers(image, self.aruco_dict, parameters=self.aruco_params)[:2]
+
+    @property
+    def tracking(self):
+        return self.corners is not None
+
+    def roi(self, shape):
+        '''
+        Predicted search box (x0, y0, x1, y1) in the frame, or None when
+        it is empty
+
+        :param shape: frame shape
+        '''
+        size = np.array([shape[1], shape[0]], dtype=np.float32)
+        # A prediction running off the frame is held at its edge
+        pts = np.clip(self.corners + self.velocity, 0, size)
+        lo = pts.min(axis=0)
+        hi = pts.max(axis=0)
+        pad = np.maximum((hi - lo) * self.margin, self.min_pad)
+        x0, y0 = np.maximum(lo - pad, 0).astype(int)
+        x1, y1 = np.minimum(hi + pad, size).astype(int)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def detect(self, frame):
+        '''
+        Find markers in a frame, searching near the last detection first
+
+        :param frame: camera image
+        :return: marker corners in frame pixels and ids, as
+                 cv2.aruco.detectMarkers
+        '''
+        corners, ids = (), None
+        box = None
+        if self.tracking:
+            self.roi_searches += 1
+            box = self.roi(frame.shape)
+        if box is not None:
+            x0, y0, x1, y1 = box
+            corners, ids = self._detect(frame[y0:y1, x0:x1])
+            if ids is not None:
+                offset = np.array([x0, y0], dtype=np.float32)
+                corners = tuple(c + offset for c in corners)
+
+        # An empty search box counts as a miss and goes straight to the
+        # full frame
+        if ids is None and (box is None or self.misses + 1 >= self.max_misses):
+            self.full_searches += 1
+            small = cv2.resize(frame, None, fx=self.downscale, fy=self.downscale,
+                               interpolation=cv2.INTER_AREA)
+            corners, ids = self._detect(small)
+            if ids is not None:
+                corners = self._to_frame(corners, frame.shape, small.shape)
+
+        self._update(corners, ids)
+        return corners, ids
+
+    @staticmethod
+    def _to_frame(corners, shape, small_shape):
+        # Corners found in the downscaled image back in frame pixels. The
+        # scale comes from the sizes cv2.resize rounded to, and pixel
+        # centres line up, so (u + 0.5) / scale - 0.5
+        scale = np.array([shape[1] / small_shape[1], shape[0] / small_shape[0]], dtype=np.float32)
+        return tuple(((c + 0.5) * scale - 0.5).astype(np.float32) for c in corners)
+
+    def _update(self, corners, ids):
+        if ids is None:
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.corners = None
+                self.velocity[:] = 0
+            return
+        pts = np.concatenate([c.reshape(-1, 2) for c in corners])
+        if self.corners is not None and self.misses == 0:
+            self.velocity = pts.mean(axis=0) - self.corners.mean(axis=0)
+        else:
+            self.velocity[:] = 0
+        self.corners = pts
+        self.misses = 0
+
+
+def benchmark(frames, aruco_dict, aruco_params):
+    '''
+    Compare full frame detection with the tracker over recorded frames
+
+    :param frames: list of images
+    :param aruco_dict: cv2.aruco dictionary
+    :param aruco_params: cv2.aruco detector parameters
+    :return: full frame and tracker detections per second, tracker hit rate
+    '''
+    tracker = MarkerTracker(aruco_dict, aruco_params)
+
+    t = time.perf_counter()
+    full = [tracker._detect(f)[1] for f in frames]
+    full_rate = len(frames) / (time.perf_counter() - t)
+
+    t = time.perf_counter()
+    tracked = [tracker.detect(f)[1] for f in frames]
+    track_rate = len(frames) / (time.perf_counter() - t)
+
+    found = [set(i.ravel()) if i is not None else set() for i in full]
+    hits = sum(1 for f, i in zip(found, tracked) if f and i is not None and f <= set(i.ravel()))
+    hit_rate = hits / max(1, sum(1 for f in found if f))
+    print(f'{len(frames)} frames: full frame {full_rate:.1f}/s, tracker {track_rate:.1f}/s, '
+          f'hit rate {hit_rate:.3f}, {tracker.roi_searches} roi / {tracker.full_searches} full searches')
+    return full_rate, track_rate, hit_rate
+
+
+if __name__ == '__main__':
+    import sys
+    from pathlib import Path
+
+    # Frames from a log directory of JPEGs or from a video file
+    source = Path(sys.argv[1])
+    if source.is_dir():
+        frames = [cv2.imread(str(p)) for p in sorted(source.glob('*.jpg'))]
+    else:
+        cap = cv2.VideoCapture(str(source))
+        frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+    aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+    aruco_params = cv2.aruco.DetectorParameters_create()
+    benchmark(frames, aruco_dict, aruco_params)
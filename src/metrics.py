@@ -0,0 +1,255 @@
+import json
+import time
+import bisect
+from datetime import datetime
+
+import numpy as np
+
+'''
+Latency and rate instrumentation for the GCS front ends.
+Stages record a latency in seconds, usually now() minus a monotonic stamp
+taken earlier in the data path, or just count an event. Latencies go into
+fixed log spaced histograms, 100us to 100s at 8 bins per decade, so a
+sample costs one bisect and an increment whatever the rate.
+Histograms cover a rolling window. Every interval seconds the window is
+closed, appended to the metrics file as one JSON line and a new one is
+started. snapshot() summarises the closed window and the open one.
+Metrics are approximate when several threads record to the same stage.
+
+When disabled, create() returns NULL_METRICS, whose methods do nothing.
+'''
+
+EDGES = np.logspace(-4, 2, 6*8 + 1).tolist()
+
+
+class Histogram():
+    '''
+    Log binned latency histogram
+    '''
+
+    def __init__(self):
+        self.counts = [0] * (len(EDGES) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_right(EDGES, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        out = Histogram()
+        out.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        out.count = self.count + other.count
+        out.total = self.total + other.total
+        out.max = max(self.max, other.max)
+        return out
+
+    def percentile(self, q):
+        '''
+        Upper edge of the bin holding the q-th percentile (s)
+        '''
+        if not self.count:
+            return np.nan
+        i = int(np.searchsorted(np.cumsum(self.counts), q / 100. * self.count))
+        return min(EDGES[min(i, len(EDGES) - 1)], self.max)
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else np.nan,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'max': self.max}
+
+
+class Metrics():
+    '''
+    Rolling per stage latency histograms and event counts
+
+    :param path: metrics file, JSON lines, None for no file
+    :param interval: window length and file dump period (s)
+    '''
+
+    def __init__(self, path=None, interval=10.):
+        self.path = path
+        self.interval = interval
+        self.file = open(path, 'a') if path else None
+        self.now = time.monotonic
+        self._open_window(self.now())
+        self.last = ({}, {}, self.window_start, self.window_start)
+
+    def __bool__(self):
+        return True
+
+    def _open_window(self, now):
+        self.hist = {}
+        self.events = {}
+        self.window_start = now
+
+    def latency(self, stage, seconds):
+        '''
+        Record a latency sample
+
+        :param stage: stage name
+        :param seconds: latency (s)
+        '''
+        hist = self.hist.get(stage)
+        if hist is None:
+            hist = self.hist[stage] = Histogram()
+        hist.add(seconds)
+
+    def since(self, stage, stamp):
+        '''
+        Record the latency from a monotonic stamp to now
+        '''
+        self.latency(stage, self.now() - stamp)
+
+    def event(self, stage, n=1):
+        '''
+        Count n events for a rate
+        '''
+        self.events[stage] = self.events.get(stage, 0) + n
+
+    def tick(self):
+        '''
+        Close the window and dump it when interval has passed, call
+        periodically, e.g. from the GUI update
+        '''
+        now = self.now()
+        if now - self.window_start < self.interval:
+            return
+        self.last = (self.hist, self.events, self.window_start, now)
+        self._open_window(now)
+        if self.file is not None:
+            hist, events, start, end = self.last
+            rates = {k: v / (end - start) for k, v in events.items()}
+            line = {'time': f'{datetime.now():%Y-%m-%dT%H:%M:%S.%f}', 'window': end - start,
+                    'rates': rates, 'latency': {k: h.summary() for k, h in hist.items()},
+                    'histograms': {k: h.counts for k, h in hist.items()}}
+            self.file.write(json.dumps(line) + '\n')
+            self.file.flush()
+
+    def snapshot(self):
+        '''
+        Rates (per second) and latency summaries over the last closed
+        window and the open one
+        '''
+        hist, events, start, _ = self.last
+        now = self.now()
+        span = max(now - start, 1e-9)
+        stages = set(events) | set(self.events)
+        rates = {k: (events.get(k, 0) + self.events.get(k, 0)) / span for k in stages}
+        latency = {}
+        for k in set(hist) | set(self.hist):
+            latency[k] = hist.get(k, Histogram()).merge(self.hist.get(k, Histogram())).summary()
+        return rates, latency
+
+    def format(self):
+        '''
+        Snapshot as a text table
+        '''
+        rates, latency = self.snapshot()
+        lines = [f'{"rate":<16}{"/s":>8}']
+        lines += [f'{k:<16}{v:8.1f}' for k, v in sorted(rates.items())]
+        lines.append(f'{"latency ms":<16}{"p50":>8}{"p90":>8}{"p99":>8}{"max":>8}')
+        for k, s in sorted(latency.items()):
+            lines.append(f'{k:<16}' + ''.join(f'{s[q]*1e3:8.1f}' for q in ('p50', 'p90', 'p99', 'max')))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class NullMetrics():
+    '''
+    Disabled metrics, every call is a no-op
+    '''
+
+    def __bool__(self):
+        return False
+
+    def now(self):
+        return 0.
+
+    def latency(self, stage, seconds):
+        pass
+
+    def since(self, stage, stamp):
+        pass
+
+    def event(self, stage, n=1):
+        pass
+
+    def tick(self):
+        pass
+
+    def snapshot(self):
+        return {}, {}
+
+    def format(self):
+        return ''
+
+    def close(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def create(enabled=True, path=None, interval=10.):
+    '''
+    Metrics, or NULL_METRICS when disabled
+
+    :param enabled: record anything at all
+    :param path: metrics file, JSON lines
+    :param interval: window length and file dump period (s)
+    '''
+    return Metrics(path, interval) if enabled else NULL_METRICS
+
+
+def stats_panel(master, metrics, period=1000):
+    '''
+    Small Tk window showing the metrics table, refreshed every period ms.
+    Does nothing for disabled metrics
+
+    :param master: Tk root
+    :param metrics: Metrics
+    '''
+    if not metrics:
+        return None
+    import tkinter as tk
+    panel = tk.Toplevel(master)
+    panel.wm_title('GCS stats')
+    label = tk.Label(panel, font=('Courier', 9), justify=tk.LEFT, anchor='nw')
+    label.pack(fill=tk.BOTH, expand=True)
+    pending = [None]
+    def refresh():
+        label.configure(text=metrics.format())
+        pending[0] = panel.after(period, refresh)
+    def closed(event):
+        # Closing the window must not leave a refresh scheduled on it
+        if event.widget is panel and pending[0] is not None:
+            panel.after_cancel(pending[0])
+            pending[0] = None
+    panel.bind('<Destroy>', closed)
+    refresh()
+    return panel
+
+
+if __name__ == '__main__':
+    # Cost per sample, enabled and disabled
+    n = 200000
+    enabled = create(True)
+    for metrics in (enabled, create(False)):
+        t = time.perf_counter()
+        for i in range(n):
+            t0 = metrics.now()
+            metrics.since('stage', t0)
+            metrics.event('events')
+        dt = (time.perf_counter() - t) / n
+        print(f'{"enabled" if metrics else "disabled"}: {dt*1e9:.0f}ns per stage')
+    print(enabled.format())
@@ -0,0 +1,206 @@
+import numpy as np
+
+from scan_likelihood import beam_vectors
+
+'''
+Normal Distributions Transform scan matching.
+The walls of the static map are split into cells and each cell is
+summarised by the mean and covariance of its wall pixels. A scan is
+aligned by Newton's method over (x, y, heading), falling back to
+Gauss-Newton steps where the Hessian is indefinite, maximising the sum
+of the cell gaussians at the projected beam end points.
+Four grids offset by half a cell are used so the score is smooth across
+cell borders.
+
+Biber and Strasser, "The Normal Distributions Transform: A New Approach
+to Laser Scan Matching", 2003
+'''
+
+CELL_SIZE = 10.
+THRESHOLD = 127
+MIN_POINTS = 3
+# Smallest covariance eigenvalue, absolute and relative to the largest
+MIN_EIG = 0.5
+EIG_RATIO = 0.05
+
+
+class NDTGrid():
+    '''
+    Per cell mean and inverse covariance of the map wall pixels
+
+    :param points: (n,2) wall pixel x,y
+    :param shape: map shape (rows, cols)
+    :param cell_size: cell width in pixels
+    :param offset: grid origin (x,y) in pixels
+    '''
+
+    def __init__(self, points, shape, cell_size=CELL_SIZE, offset=(0.,0.), min_points=MIN_POINTS):
+        self.cell_size = cell_size
+        self.offset = np.asarray(offset, dtype=np.float64)
+        self.nx = int(np.ceil((shape[1] - self.offset[0]) / cell_size)) + 1
+        self.ny = int(np.ceil((shape[0] - self.offset[1]) / cell_size)) + 1
+        ncells = self.nx * self.ny
+
+        cell = self.cell_index(points)
+        ok = cell >= 0
+        cell, px, py = cell[ok], points[ok,0], points[ok,1]
+
+        count = np.bincount(cell, minlength=ncells).astype(np.float64)
+        sx = np.bincount(cell, px, ncells)
+        sy = np.bincount(cell, py, ncells)
+        sxx = np.bincount(cell, px*px, ncells)
+        sxy = np.bincount(cell, px*py, ncells)
+        syy = np.bincount(cell, py*py, ncells)
+
+        self.valid = count >= min_points
+        n = np.maximum(count, 1.)
+        self.mean = np.stack((sx/n, sy/n), axis=1)
+        cov = np.empty((ncells, 2, 2))
+        cov[:,0,0] = sxx/n - self.mean[:,0]**2
+        cov[:,0,1] = cov[:,1,0] = sxy/n - self.mean[:,0]*self.mean[:,1]
+        cov[:,1,1] = syy/n - self.mean[:,1]**2
+
+        # Inflate near singular covariances (straight walls) before inverting
+        eig, vec = np.linalg.eigh(cov)
+        eig = np.maximum(eig, np.maximum(MIN_EIG, EIG_RATIO * eig[:,1:]))
+        self.inv_cov = np.einsum('nij,nj,nkj->nik', vec, 1./eig, vec)
+
+    def cell_index(self, points):
+        '''
+        Flat cell index of each point, -1 outside the grid
+
+        :param points: (n,2) x,y
+        '''
+        c = np.floor((points - self.offset) / self.cell_size).astype(np.int64)
+        inside = (c[:,0] >= 0) & (c[:,0] < self.nx) & (c[:,1] >= 0) & (c[:,1] < self.ny)
+        return np.where(inside, c[:,1] * self.nx + c[:,0], -1)
+
+
+class NDTMatcher():
+    '''
+    Align laser scans against a static map
+
+    :param static_map: greyscale map, walls are bright
+    :param cell_size: NDT cell width in pixels
+    :param threshold: map values above this are walls
+    '''
+
+    def __init__(self, static_map, cell_size=CELL_SIZE, threshold=THRESHOLD):
+        wy, wx = np.nonzero(static_map > threshold)
+        points = np.stack((wx, wy), axis=1).astype(np.float64) + 0.5
+        half = cell_size / 2.
+        self.grids = [NDTGrid(points, static_map.shape, cell_size, offset)
+                      for offset in ((0.,0.), (half,0.), (0.,half), (half,half))]
+
+    def derivatives(self, bx, by, pose):
+        '''
+        Score, gradient and Hessian of the negative NDT score at pose,
+        plus the always positive semi-definite Gauss-Newton approximation
+        of the Hessian
+
+        :param bx: beam x offsets from beam_vectors
+        :param by: beam y offsets from beam_vectors
+        :param pose: x, y, heading in radians
+        '''
+        c, s = np.cos(pose[2]), np.sin(pose[2])
+        points = np.stack((pose[0] + c*bx - s*by, pose[1] + s*bx + c*by), axis=1)
+        # d(point)/d(heading) and its second derivative
+        dh = np.stack((-s*bx - c*by, c*bx - s*by), axis=1)
+        ddh = np.stack((-c*bx + s*by, -s*bx - c*by), axis=1)
+
+        score = 0.
+        grad = np.zeros(3)
+        hess = np.zeros((3,3))
+        hess_gn = np.zeros((3,3))
+        for grid in self.grids:
+            cell = grid.cell_index(points)
+            ok = cell >= 0
+            ok[ok] = grid.valid[cell[ok]]
+            if not ok.any():
+                continue
+            cell = cell[ok]
+            q = points[ok] - grid.mean[cell]
+            C = grid.inv_cov[cell]
+            Cq = np.einsum('nij,nj->ni', C, q)
+            e = np.exp(-0.5 * np.einsum('ni,ni->n', q, Cq))
+
+            # q^T C J for J = [e_x, e_y, dh]
+            qCJ = np.stack((Cq[:,0], Cq[:,1], np.einsum('ni,ni->n', Cq, dh[ok])), axis=1)
+            CJh = np.einsum('nij,nj->ni', C, dh[ok])
+            # J_k^T C J_l
+            JCJ = np.empty((len(e),3,3))
+            JCJ[:,:2,:2] = C
+            JCJ[:,:2,2] = CJh
+            JCJ[:,2,:2] = CJh
+            JCJ[:,2,2] = np.einsum('ni,ni->n', dh[ok], CJh)
+
+            score -= e.sum()
+            grad += qCJ.T @ e
+            hess_gn += np.einsum('n,nkl->kl', e, JCJ)
+            JCJ[:,2,2] += np.einsum('ni,ni->n', Cq, ddh[ok])
+            hess += np.einsum('n,nkl->kl', e, JCJ - qCJ[:,:,None] * qCJ[:,None,:])
+        return score, grad, hess, hess_gn
+
+    def align(self, scan, angles, init, iterations=15, tol=1e-3):
+        '''
+        Newton optimisation of the scan pose, warm started from init
+
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        :param init: x, y, heading in degrees
+        :param iterations: maximum Newton steps
+        :param tol: stop once the step is below this
+        :return: pose (x, y, heading in degrees), score, number of iterations
+        '''
+        bx, by = beam_vectors(scan, angles)
+        pose = np.array([init[0], init[1], np.radians(init[2])], dtype=np.float64)
+        score, grad, hess, hess_gn = self.derivatives(bx, by, pose)
+        it = 0
+        for it in range(1, iterations + 1):
+            # Newton step where the Hessian is positive definite,
+            # otherwise fall back to Gauss-Newton
+            if np.linalg.eigvalsh(hess)[0] <= 1e-9:
+                hess = hess_gn + 1e-9 * np.eye(3)
+            delta = -np.linalg.solve(hess, grad)
+
+            # Backtrack if the full step makes the score worse
+            step = 1.
+            while step > 1e-3:
+                trial = pose + step * delta
+                t = self.derivatives(bx, by, trial)
+                if t[0] <= score:
+                    break
+                step *= 0.5
+            else:
+                break
+            pose = trial
+            score, grad, hess, hess_gn = t
+            if np.abs(step * delta).max() < tol:
+                break
+
+        heading = (np.degrees(pose[2]) + 180.) % 360. - 180.
+        return (pose[0], pose[1], heading), -score, it
+
+
+if __name__ == '__main__':
+    import time
+    import cv2
+
+    static_map = np.zeros((500,500),dtype=np.uint8)
+    cv2.rectangle(static_map,(100,100),(300,389),255,1)
+    cv2.rectangle(static_map,(244,149),(300,318),255,1)
+    matcher = NDTMatcher(static_map)
+
+    # Synthetic scan from a known pose by ray marching the map
+    true = (180., 250., 30.)
+    angles = np.linspace(np.radians(0),np.radians(360),720)
+    r = np.arange(1,250)
+    h = np.radians(true[2]) + angles
+    x = np.clip(true[0] + np.outer(np.cos(h), r), 0, 499).astype(int)
+    y = np.clip(true[1] + np.outer(np.sin(h), r), 0, 499).astype(int)
+    scan = (static_map[y, x] > 0).argmax(axis=1) + 1.
+
+    t = time.perf_counter()
+    pose, score, it = matcher.align(scan, angles, (true[0]+4, true[1]-3, true[2]+3))
+    print(f'true {true} found {np.round(pose,2)} score {score:.1f} in {it} iterations, '
+          f'{(time.perf_counter()-t)*1e3:.1f}ms')
@@ -0,0 +1,339 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+from gcs_log import GCSLog, convert, parse_time
+
+'''
+Occupancy grid mapping from laser scans at known poses.
+Each cell holds the log odds of being occupied. A beam adds l_hit to the
+cell it ends in and l_free to every cell it passes through on the way,
+and the sum is clipped to [l_min, l_max] so the map can still change.
+
+Scans are integrated in batches. Every beam of every scan in a batch is
+sampled at each pixel along its length, a few blocks of beams of similar
+range at a time, the samples are counted into a dense window covering
+the batch, and the window is added to the grid tiles it overlaps. Tiles are allocated as the map grows, in any
+direction, so the extent does not need to be known up front. Within a
+batch a cell gets at most one free update per scan, and none if a beam
+ended in it, so grazing beams do not erase thin walls.
+
+Map and pose coordinates are pixels, indexed [y,x] with the heading in
+degrees, as for LaserLocator, and save() writes a greyscale image with
+bright walls that LaserLocator and likelihood_field load directly.
+'''
+
+TILE = 128
+L_HIT = 0.85
+L_FREE = -0.4
+L_MIN = -4.
+L_MAX = 4.
+# Beams are traced in this many groups of similar range
+RANGE_BANDS = 8
+
+
+class OccupancyGrid():
+    '''
+    Tiled log odds occupancy grid
+
+    :param tile: tile width and height in cells
+    :param l_hit: log odds added where a beam ends
+    :param l_free: log odds added along a beam
+    :param l_min: lower clip of the log odds
+    :param l_max: upper clip of the log odds
+    :param max_range: beams at or beyond this range are free space only
+    :param batch: scans buffered by add before they are integrated
+    '''
+
+    def __init__(self, tile=TILE, l_hit=L_HIT, l_free=L_FREE, l_min=L_MIN, l_max=L_MAX,
+                 max_range=255, batch=16):
+        self.tile = tile
+        self.l_hit = l_hit
+        self.l_free = l_free
+        self.l_min = l_min
+        self.l_max = l_max
+        self.max_range = max_range
+        self.batch = batch
+        self.tiles = {}
+        self.pending = []
+        self.scans = 0
+        self.beams = 0
+
+    def add(self, scan, angles, pose):
+        '''
+        Queue a scan, integrating the queue once it holds batch scans
+
+        :param scan: beam ranges in pixels, as from LaserLocator.get_next_scan
+        :param angles: beam angles in radians
+        :param pose: x, y, heading of the sensor
+        '''
+        self.pending.append((np.ravel(scan), np.ravel(angles), pose))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        '''
+        Integrate any queued scans
+        '''
+        if not self.pending:
+            return
+        scans, angles, poses = zip(*self.pending)
+        self.pending = []
+        counts = [len(s) for s in scans]
+        poses = np.array([p[:3] for p in poses], dtype=np.float64)
+        index = np.repeat(np.arange(len(counts)), counts)
+        self._integrate(index, poses, np.concatenate(scans).astype(np.float64),
+                        np.concatenate(angles).astype(np.float64))
+
+    def add_batch(self, scans, poses, angles=None):
+        '''
+        Integrate full scans straight away, beams with no return (range
+        1 or less) are dropped as in LaserLocator
+
+        :param scans: (n, beams) beam ranges in pixels
+        :param poses: (n, 3) x, y, heading of the sensor
+        :param angles: beam angles in radians, defaults to LaserLocator's
+        '''
+        scans = np.asarray(scans)
+        if angles is None:
+            angles = np.linspace(np.radians(0),np.radians(360),scans.shape[1])
+        index, beam = np.nonzero(scans > 1)
+        self._integrate(index, np.asarray(poses, dtype=np.float64)[:,:3],
+                        scans[index, beam].astype(np.float64), angles[beam])
+
+    def _integrate(self, index, poses, ranges, angles):
+        # One batch of beams, index is the scan of each beam in poses
+        num = len(poses)
+        if not len(ranges):
+            return
+        theta = np.radians(poses[index, 2]) + angles
+        c, s = np.cos(theta).astype(np.float32), np.sin(theta).astype(np.float32)
+        px, py = poses[index, 0].astype(np.float32), poses[index, 1].astype(np.float32)
+        hit = ranges < self.max_range
+        ranges = np.minimum(ranges, self.max_range).astype(np.float32)
+        ex, ey = px + ranges * c, py + ranges * s
+
+        # Dense window over the batch, beams run from the poses to the end points
+        x0 = int(np.floor(min(px.min(), ex.min())))
+        y0 = int(np.floor(min(py.min(), ey.min())))
+        w = int(np.floor(max(px.max(), ex.max()))) - x0 + 1
+        h = int(np.floor(max(py.max(), ey.max()))) - y0 + 1
+        cells = w * h
+        key_type = np.int32 if (num + 1) * cells < 2**31 else np.int64
+
+        # Every whole pixel along each beam, stopping a pixel short of the
+        # end, as (beams, steps) blocks of beams of similar length. Samples
+        # past the end go to a spare cell, and each scan has its own layer
+        # of seen cells so a scan frees a cell at most once
+        seen = np.zeros(num * cells + 1, dtype=bool)
+        order = np.argsort(ranges)
+        for part in np.array_split(order, min(len(order), RANGE_BANDS)):
+            r = ranges[part, None]
+            steps = np.arange(int(np.ceil(r[-1,0])), dtype=np.float32)
+            fx = steps * c[part, None]
+            fx += px[part, None] - x0
+            fy = steps * s[part, None]
+            fy += py[part, None] - y0
+            key = np.floor(fy, out=fy).astype(key_type)
+            key *= w
+            key += np.floor(fx, out=fx).astype(key_type)
+            key += (index[part] * cells).astype(key_type)[:,None]
+            key[steps >= r - 1.] = num * cells
+            seen[key] = True
+        free = np.add.reduce(seen[:-1].reshape(num, cells).view(np.uint8), axis=0,
+                             dtype=np.uint8 if num < 256 else np.int32)
+
+        hx = np.floor(ex[hit] - x0).astype(np.intp)
+        hy = np.floor(ey[hit] - y0).astype(np.intp)
+        hits = np.bincount(hy * w + hx, minlength=cells)
+        free[hits > 0] = 0
+        delta = (self.l_free * free + self.l_hit * hits).astype(np.float32).reshape(h, w)
+        self._add_window(x0, y0, delta)
+        self.scans += num
+        self.beams += len(ranges)
+
+    def _add_window(self, x0, y0, delta):
+        t = self.tile
+        h, w = delta.shape
+        for ty in range(y0 // t, (y0 + h - 1) // t + 1):
+            for tx in range(x0 // t, (x0 + w - 1) // t + 1):
+                # Overlap of the window and this tile, in window coordinates
+                ax, bx = max(x0, tx * t), min(x0 + w, (tx + 1) * t)
+                ay, by = max(y0, ty * t), min(y0 + h, (ty + 1) * t)
+                part = delta[ay-y0:by-y0, ax-x0:bx-x0]
+                if not part.any():
+                    continue
+                tile = self.tiles.get((ty, tx))
+                if tile is None:
+                    tile = self.tiles[(ty, tx)] = np.zeros((t, t), dtype=np.float32)
+                view = tile[ay-ty*t:by-ty*t, ax-tx*t:bx-tx*t]
+                view += part
+                np.clip(view, self.l_min, self.l_max, out=view)
+
+    def extent(self):
+        '''
+        x0, y0, x1, y1 of the allocated tiles
+        '''
+        if not self.tiles:
+            return 0, 0, 0, 0
+        ty, tx = np.array(list(self.tiles)).T
+        return tx.min() * self.tile, ty.min() * self.tile, (tx.max() + 1) * self.tile, (ty.max() + 1) * self.tile
+
+    def log_odds(self, shape=None, origin=(0, 0)):
+        '''
+        Dense copy of part of the grid, unknown cells are 0
+
+        :param shape: rows, columns, defaults to everything from origin
+                      to the far edge of the allocated tiles
+        :param origin: map x, y of the top left cell
+        '''
+        self.flush()
+        x0, y0 = origin
+        if shape is None:
+            _, _, x1, y1 = self.extent()
+            shape = (max(y1 - y0, 0), max(x1 - x0, 0))
+        out = np.zeros(shape, dtype=np.float32)
+        t = self.tile
+        for (ty, tx), tile in self.tiles.items():
+            ax, bx = max(x0, tx * t), min(x0 + shape[1], (tx + 1) * t)
+            ay, by = max(y0, ty * t), min(y0 + shape[0], (ty + 1) * t)
+            if ax < bx and ay < by:
+                out[ay-y0:by-y0, ax-x0:bx-x0] = tile[ay-ty*t:by-ty*t, ax-tx*t:bx-tx*t]
+        return out
+
+    def to_map(self, shape=None, origin=(0, 0), threshold=1.):
+        '''
+        Static map image, occupied cells 255 and everything else 0
+
+        :param shape: see log_odds
+        :param origin: see log_odds
+        :param threshold: log odds above which a cell is a wall
+        '''
+        return np.where(self.log_odds(shape, origin) > threshold, 255, 0).astype(np.uint8)
+
+    def save(self, path, shape=(500, 500), threshold=1.):
+        '''
+        Write the map image for LaserLocator, with the origin at map (0,0)
+
+        :param path: image file
+        :param shape: rows, columns
+        :param threshold: log odds above which a cell is a wall
+        '''
+        if not cv2.imwrite(str(path), self.to_map(shape, threshold=threshold)):
+            raise OSError(f'Could not write map {path}')
+
+
+def load_trajectory(path):
+    '''
+    Scan times and poses written by LaserLocator.replay
+
+    :param path: trajectory file, time,x,y,heading,...
+    :return: datetime64[us] times and (n,3) x, y, heading
+    '''
+    times, poses = [], []
+    with open(path) as f:
+        for line in f:
+            fields = line.split(',')
+            try:
+                times.append(parse_time(fields))
+                poses.append([float(v) for v in fields[3:6]])
+            except (ValueError, IndexError):
+                continue
+    return np.array(times, dtype='datetime64[us]'), np.array(poses, dtype=np.float64).reshape(-1, 3)
+
+
+def match_poses(scan_times, pose_times, poses, max_dt=0.05):
+    '''
+    Pose for each scan from the nearest pose in time
+
+    :param scan_times: datetime64 scan times, sorted
+    :param pose_times: datetime64 pose times, sorted
+    :param poses: (m,3) poses
+    :param max_dt: scans further than this from any pose are dropped (s)
+    :return: indices of the matched scans and their poses
+    '''
+    if not len(pose_times):
+        return np.zeros(0, dtype=np.intp), poses[:0]
+    i = np.clip(np.searchsorted(pose_times, scan_times), 1, len(pose_times) - 1)
+    i = np.where(len(pose_times) > 1, i, 0)
+    before = np.abs(scan_times - pose_times[i - 1])
+    after = np.abs(pose_times[i] - scan_times)
+    i = np.where(before < after, i - 1, i)
+    dt = np.abs(scan_times - pose_times[i]) / np.timedelta64(1, 's')
+    keep = np.flatnonzero(dt <= max_dt)
+    return keep, poses[i[keep]]
+
+
+def build_from_log(log, trajectory, grid=None, batch=16, max_dt=0.05):
+    '''
+    Map a whole session from its log and a LaserLocator trajectory
+
+    :param log: columnar log directory, or a gcs_*.log which is converted
+    :param trajectory: trajectory file from LaserLocator.replay
+    :param grid: OccupancyGrid to add to, a new one if None
+    :param batch: scans per batch
+    :param max_dt: see match_poses
+    :return: grid
+    '''
+    if not Path(log).is_dir():
+        log = convert(log)
+    log = GCSLog(log)
+    grid = grid or OccupancyGrid()
+    times, scans = log.scans()
+    keep, poses = match_poses(times, *load_trajectory(trajectory), max_dt=max_dt)
+    for i in range(0, len(keep), batch):
+        grid.add_batch(scans[keep[i:i+batch]], poses[i:i+batch])
+    return grid
+
+
+def build_with_locator(locator, grid=None, std=(1,1,1,1), num=5000):
+    '''
+    Run the particle filter over the locator's log and add each scan at
+    the estimated pose
+
+    :param locator: LaserLocator, with its initial pose set
+    :param grid: OccupancyGrid to add to, a new one if None
+    :param std: standard deviation of the initial particles
+    :param num: initial number of particles
+    :return: grid
+    '''
+    import particle_filter_xyh as pf
+    grid = grid or OccupancyGrid()
+    particles = pf.gen_gaussian_particles(num=num,std=std,init=(locator.dx, locator.dy, locator.dh, locator.dv))
+    scan, angles = locator.get_next_scan()
+    while scan is not None:
+        particles, estimate, var, scored = locator.step(particles, scan, angles)
+        grid.add(scan, angles, (locator.dx, locator.dy, locator.dh))
+        scan, angles = locator.get_next_scan()
+    grid.flush()
+    return grid
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build a static map from a GCS log')
+    parser.add_argument('log', help='gcs_*.log or its columnar store')
+    parser.add_argument('trajectory', nargs='?', help='LaserLocator.replay output, localise with --map if not given')
+    parser.add_argument('--out', default='map.png', help='map image to write')
+    parser.add_argument('--shape', type=int, nargs=2, default=(500, 500), metavar=('ROWS','COLS'))
+    parser.add_argument('--threshold', type=float, default=1., help='wall log odds threshold')
+    parser.add_argument('--batch', type=int, default=16, help='scans per batch')
+    parser.add_argument('--map', help='existing map to localise against when there is no trajectory')
+    parser.add_argument('--init', type=float, nargs=4, default=(199., 169., -110., 0.), metavar=('X','Y','H','V'))
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    if args.trajectory:
+        grid = build_from_log(args.log, args.trajectory, OccupancyGrid(batch=args.batch), batch=args.batch)
+    else:
+        from localiser_ndt import LaserLocator, MAP_FILE
+        locator = LaserLocator(init=args.init, log_file=args.log, map_file=args.map or MAP_FILE)
+        grid = build_with_locator(locator, OccupancyGrid(batch=args.batch))
+        locator.close()
+    elapsed = time.perf_counter() - t
+    grid.save(args.out, args.shape, args.threshold)
+    x0, y0, x1, y1 = grid.extent()
+    print(f'{grid.scans} scans, {grid.beams} beams in {elapsed:.2f}s, {grid.scans/max(elapsed, 1e-9):.0f} scans/s, '
+          f'{len(grid.tiles)} tiles covering x {x0}..{x1} y {y0}..{y1}, map written to {args.out}')
@@ -0,0 +1,133 @@
+import os
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from scan_likelihood import gather_sums, CHUNK_SIZE
+
+'''
+Process pool backend for particle scoring.
+The map (static map or likelihood field) is copied into shared memory
+once, each worker attaches to it at start up, and only the particle
+chunks and the scan are sent per step. Small particle sets are scored
+in process, where the pool overhead would outweigh the gain.
+'''
+
+MIN_PARALLEL = 2000
+
+# Worker side view of the shared map
+_shm = None
+_grid = None
+
+
+def _attach(name, shape, dtype):
+    global _shm, _grid
+    _shm = shared_memory.SharedMemory(name=name)
+    _grid = np.ndarray(shape, dtype=dtype, buffer=_shm.buf)
+
+
+def _gather(args):
+    particles, scan, angles, chunk_size = args
+    return gather_sums(_grid, particles, scan, angles, chunk_size)
+
+
+class SharedMapScorer():
+    '''
+    Score particles against a map using a pool of worker processes
+
+    :param grid: static map or log likelihood field
+    :param field: True if grid is a log likelihood field
+    :param workers: number of worker processes, defaults to the cpu count
+    :param min_parallel: particle count below which scoring stays in process
+    :param chunk_size: particles projected at once within a worker
+    '''
+
+    def __init__(self, grid, field=True, workers=None, min_parallel=MIN_PARALLEL,
+                 chunk_size=CHUNK_SIZE, scale=1.):
+        self.field = field
+        self.scale = scale
+        self.workers = workers or os.cpu_count()
+        self.min_parallel = min_parallel
+        self.chunk_size = chunk_size
+
+        self.shm = shared_memory.SharedMemory(create=True, size=grid.nbytes)
+        self.grid = np.ndarray(grid.shape, dtype=grid.dtype, buffer=self.shm.buf)
+        self.grid[:] = grid
+        self.pool = mp.Pool(self.workers, initializer=_attach,
+                            initargs=(self.shm.name, grid.shape, grid.dtype))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.shm.close()
+        self.shm.unlink()
+
+    def gather(self, particles, scan, angles):
+        '''
+        Sum of map values under the beams of each particle
+
+        :param particles: (n,5) particle array
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        '''
+        num = particles.shape[0]
+        if self.workers < 2 or num < self.min_parallel:
+            return gather_sums(self.grid, particles, scan, angles, self.chunk_size)
+        splits = np.array_split(particles, self.workers)
+        sums = self.pool.map(_gather, [(p, scan, angles, self.chunk_size) for p in splits])
+        return np.concatenate(sums)
+
+    def score(self, particles, scan, angles):
+        '''
+        Likelihood vector for pf.update_particles, matching
+        score_particles_field or score_particles depending on the map
+
+        :param particles: (n,5) particle array
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        '''
+        sums = self.gather(particles, scan, angles)
+        if self.field:
+            return np.exp(self.scale * (sums - sums.max()))
+        return sums**2
+
+
+def benchmark(num=20000, beams=720, repeats=5, max_workers=None):
+    '''
+    Print scoring time and speedup against the in process path for an
+    increasing number of worker processes
+
+    :param num: number of particles
+    :param beams: number of beams in the scan
+    :param repeats: timed repeats per worker count
+    :param max_workers: largest pool size, defaults to the cpu count
+    '''
+    import time
+    import particle_filter_xyh as pf
+
+    field = np.log(np.random.random((500,500)).astype(np.float32) + 0.1)
+    scan = np.random.randint(2,150,beams).astype(np.float64)
+    angles = np.linspace(np.radians(0),np.radians(360),beams)
+    particles = pf.gen_gaussian_particles(num=num,std=(50,50,180,1),init=(250.,250.,0.,0.))
+
+    base = None
+    for workers in range(1, (max_workers or os.cpu_count()) + 1):
+        with SharedMapScorer(field, workers=workers, min_parallel=0) as scorer:
+            scorer.score(particles, scan, angles)
+            t = time.perf_counter()
+            for _ in range(repeats):
+                scorer.score(particles, scan, angles)
+            dt = (time.perf_counter() - t) / repeats
+        base = base or dt
+        print(f'{workers:3d} workers {dt*1e3:8.1f}ms  speedup {base/dt:0.2f}')
+
+
+if __name__ == '__main__':
+    benchmark()
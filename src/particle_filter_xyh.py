@@ -1,5 +1,7 @@
 import numpy as np
 
+import resampling
+
 
 '''
 heavily inspired by: https://github.com/rlabbe/Kalman-and-Bayesian-Filters-in-Python
@@ -35,12 +37,82 @@ def gen_gaussian_particles(num=50, std=(10,10,10,10),init=(0,0,0,0)):
 
 
 
-def predict_particles(particles):
-    particles[:,X] += particles[:,V] * np.cos(np.radians(particles[:,H]))
-    particles[:,Y] += particles[:,V] * np.cos(np.radians(particles[:,H]))
+def _wrap_heading(h):
+    h += 180.
+    np.mod(h, 360., out=h)
+    h -= 180.
+
+
+def _predict(x, y, h, v, c, s):
+    np.radians(h, out=s)
+    np.cos(s, out=c)
+    np.sin(s, out=s)
+    c *= v
+    s *= v
+    x += c
+    y += s
+
+
+def _move(x, y, h, v, u, c, s):
+    # Apply a dx, dy, dheading increment in each particle's own frame,
+    # as a step of length |dx,dy| at the particle heading plus its bearing
+    # Plain floats, so float32 particles are updated without casting
+    dx, dy, dh = (float(a) for a in u[:3])
+    bearing, step = float(np.arctan2(dy, dx)), float(np.hypot(dx, dy))
+    np.radians(h, out=s)
+    s += bearing
+    np.cos(s, out=c)
+    np.sin(s, out=s)
+    c *= step
+    s *= step
+    x += c
+    y += s
+    h += dh
+    _wrap_heading(h)
+    v[:] = dx
+
+
+def _jitter(x, y, h, v, std, noise, fill_normal):
+    # Update heading
+    fill_normal(noise)
+    noise *= std[H]
+    h += noise
+    _wrap_heading(h)
+
+    # Move particles
+    for col, s in ((x, std[X]), (y, std[Y]), (v, std[V])):
+        fill_normal(noise)
+        noise *= s
+        col += noise
+
+
+def _update(w, likelihood, floor):
+    w *= likelihood
+    w += floor
+    w /= w.sum()
+
+
+def predict_particles(particles, u=None):
+    '''
+    Move particles forward one step, by their own speed along their
+    heading, or by a control input such as scan odometry
+
+    :param particles: particle set
+    :param u: dx, dy, dheading in the particle frame, None for the
+              constant velocity model. The speed becomes dx
+    '''
+    c, s = np.empty(particles.shape[0]), np.empty(particles.shape[0])
+    if u is None:
+        _predict(particles[:,X], particles[:,Y], particles[:,H], particles[:,V], c, s)
+    else:
+        _move(particles[:,X], particles[:,Y], particles[:,H], particles[:,V], u, c, s)
     return particles
 
 
+def _fill_randn(out):
+    out[:] = np.random.randn(out.shape[0])
+
+
 def jitter_particles(particles, std=[0.25,0.25,0.25,0.25]):
     '''
     Move particles randomly.
@@ -51,16 +123,8 @@ def jitter_particles(particles, std=[0.25,0.25,0.25,0.25]):
     :param particles: particle set to be jitterd
     :param std: standard deviation
     '''
-    num = particles.shape[0]
-    # Update heading
-    particles[:,H] += np.random.randn(num) * std[H]
-    particles[:,H] = (particles[:,H] + 180.)%360. - 180.
-
-    # Move particles
-    particles[:,X] += np.random.randn(num) * std[X]
-    particles[:,Y] += np.random.randn(num) * std[Y]
-    particles[:,V] += np.random.randn(num) * std[V]
-
+    _jitter(particles[:,X], particles[:,Y], particles[:,H], particles[:,V],
+            std, np.empty(particles.shape[0]), _fill_randn)
     return particles
     
 
@@ -71,21 +135,18 @@ def update_particles(particles, likelihood):
     :param particles: Description
     :param likelihood: Description
     '''
-    particles[:,W] *= likelihood
-    particles[:,W] += 1.e-300
-    particles[:,W] /= sum(particles[:,W])
+    _update(particles[:,W], likelihood, 1.e-300)
     return particles
 
 
-def resample_particles(particles):
+def resample_particles(particles, scheme='multinomial'):
     '''
-    Multinomial Resampling
+    Resample particles in proportion to their weights
     
     :param particles: Description
+    :param scheme: multinomial, systematic, stratified or residual
     '''
-    cum_sum = np.cumsum(particles[:,W])
-    cum_sum[-1] = 1
-    i = np.searchsorted(cum_sum, np.random.random(particles.shape[0]))
+    i = resampling.SCHEMES[scheme](particles[:,W])
 
     particles[:] = particles[i]
     particles[:,W] = 1./particles.shape[0]
@@ -93,6 +154,95 @@ def resample_particles(particles):
     return particles
 
 
+def neff(particles):
+    '''
+    Effective sample size of the particle set
+    
+    :param particles: Description
+    '''
+    return resampling.effective_sample_size(particles[:,W])
+
+
+def resample_if_needed(particles, threshold=0.5, scheme='systematic'):
+    '''
+    Adaptive resampling, only resample once the effective sample size
+    drops below threshold * N. Otherwise the weights are carried over
+    
+    :param particles: Description
+    :param threshold: fraction of N below which to resample
+    :param scheme: multinomial, systematic, stratified or residual
+    '''
+    if neff(particles) < threshold * particles.shape[0]:
+        particles = resample_particles(particles, scheme)
+    return particles
+
+
+def kld_sample_size(k, epsilon=0.05, z=2.326):
+    '''
+    Number of particles needed so the KL divergence between the sample
+    based and true posterior is below epsilon with probability given by
+    the standard normal quantile z, when the posterior covers k bins.
+    Fox, "Adapting the Sample Size in Particle Filters Through KLD-Sampling"
+    
+    :param k: number of occupied histogram bins
+    :param epsilon: KL divergence bound
+    :param z: upper standard normal quantile, 2.326 for 0.99
+    '''
+    k = np.maximum(np.asarray(k, dtype=np.float64), 2.)
+    a = 2. / (9. * (k - 1.))
+    return np.ceil((k - 1.) / (2. * epsilon) * (1. - a + np.sqrt(a) * z)**3)
+
+
+def bin_keys(particles, bin_size=(5.,5.,10.)):
+    '''
+    Flattened (x,y,heading) histogram bin of each particle
+    
+    :param particles: Description
+    :param bin_size: bin width in x, y and heading
+    '''
+    bx = np.floor(particles[:,X] / bin_size[X]).astype(np.int64)
+    by = np.floor(particles[:,Y] / bin_size[Y]).astype(np.int64)
+    bh = np.floor((particles[:,H] + 180.) / bin_size[H]).astype(np.int64)
+    # Offset x,y so negative bins stay unique after packing
+    return ((bx + (1 << 20)) << 40) | ((by + (1 << 20)) << 16) | (bh & 0xFFFF)
+
+
+def kld_resample(particles, min_num=500, max_num=10000, epsilon=0.05, z=2.326,
+                 bin_size=(5.,5.,10.), scheme='systematic'):
+    '''
+    Resample with KLD-sampling, the returned particle set is just large
+    enough for the spread of the posterior, within [min_num, max_num].
+    Up to max_num samples are drawn in random order, and the set is cut
+    at the first n where n covers kld_sample_size of the bins occupied
+    by the first n samples.
+    
+    :param particles: Description
+    :param min_num: minimum number of particles
+    :param max_num: maximum number of particles
+    :param epsilon: KL divergence bound
+    :param z: upper standard normal quantile
+    :param bin_size: histogram bin width in x, y and heading
+    :param scheme: multinomial, systematic, stratified or residual
+    '''
+    i = resampling.SCHEMES[scheme](particles[:,W], max_num)
+    np.random.shuffle(i)
+
+    # Number of occupied bins after each sample
+    _, first = np.unique(bin_keys(particles[i], bin_size), return_index=True)
+    k = np.zeros(max_num, dtype=np.int64)
+    k[first] = 1
+    k = np.cumsum(k)
+
+    n = np.arange(1, max_num + 1)
+    enough = np.flatnonzero(n >= kld_sample_size(k, epsilon, z))
+    num = enough[0] + 1 if len(enough) else max_num
+    num = max(min_num, min(max_num, num))
+
+    particles = particles[i[:num]]
+    particles[:,W] = 1./num
+    return particles
+
+
 def estimate(particles):
     '''
     Docstring for estimate
@@ -107,10 +257,268 @@ def estimate(particles):
     return mean,var
 
 
+class ParticleSet():
+    '''
+    Particle set stored as a structure of arrays, one contiguous row per
+    state (X,Y,H,V,W) in float32 by default.
+    Scratch buffers are allocated once, up to capacity, and reused so
+    predict, jitter, update, estimate and systematic or stratified
+    resampling do not allocate in steady state. Resampling gathers into a
+    second buffer and swaps, multinomial and residual resampling go through
+    resampling.SCHEMES and allocate their indexes. Random numbers come from
+    an owned Generator so a run can be reproduced from its seed.
+    '''
+
+    def __init__(self, num=50, std=(10,10,10,10), init=(0,0,0,0), seed=None,
+                 dtype=np.float32, capacity=None):
+        self.rng = np.random.default_rng(seed)
+        self.dtype = np.dtype(dtype)
+        self.capacity = max(num, capacity or num)
+        self.num = num
+
+        self._data = np.empty((W + 1, self.capacity), dtype=self.dtype)
+        self._swap = np.empty_like(self._data)
+        self._noise = np.empty(self.capacity, dtype=self.dtype)
+        self._tmp = np.empty(self.capacity, dtype=self.dtype)
+        self._floor = np.finfo(self.dtype).tiny
+
+        # Resampling index buffers, float64 so the cumulative weights
+        # reach 1 as in resampling
+        self._cum = np.empty(self.capacity)
+        self._pos = np.empty(self.capacity)
+        self._gather = np.empty(self.capacity)
+        self._ramp = np.arange(self.capacity, dtype=np.float64)
+        self._strata = np.empty(self.capacity, dtype=np.intp)
+        self._below = np.empty(self.capacity, dtype=np.intp)
+        self._count = np.empty(self.capacity, dtype=np.intp)
+        self._index = np.empty(self.capacity, dtype=np.intp)
+
+        self.x[:] = init[X] + self._normal(std[X])
+        self.y[:] = init[Y] + self._normal(std[Y])
+        self.h[:] = init[H] + self._normal(std[H])
+        self.v[:] = init[V] + self._normal(std[V])
+        np.abs(self.v, out=self.v)
+        _wrap_heading(self.h)
+        self.w[:] = 1./num
+
+    @classmethod
+    def from_array(cls, particles, seed=None, dtype=np.float32):
+        '''
+        Build a particle set from an (n,5) particle array
+
+        :param particles: particle array
+        :param seed: Generator seed
+        :param dtype: storage type
+        '''
+        ps = cls(num=particles.shape[0], std=(0,0,0,0), seed=seed, dtype=dtype)
+        ps.data[:] = particles.T
+        return ps
+
+    def to_array(self):
+        '''
+        Copy out as an (n,5) float64 particle array
+        '''
+        return self.data.T.astype(np.float64)
+
+    @property
+    def data(self):
+        return self._data[:, :self.num]
+
+    @property
+    def x(self):
+        return self._data[X, :self.num]
+
+    @property
+    def y(self):
+        return self._data[Y, :self.num]
+
+    @property
+    def h(self):
+        return self._data[H, :self.num]
+
+    @property
+    def v(self):
+        return self._data[V, :self.num]
+
+    @property
+    def w(self):
+        return self._data[W, :self.num]
+
+    def _fill_normal(self, out):
+        self.rng.standard_normal(out=out, dtype=self.dtype)
+
+    def _normal(self, std):
+        noise = self._noise[:self.num]
+        self._fill_normal(noise)
+        noise *= std
+        return noise
+
+    def predict(self, u=None):
+        '''
+        Move particles forward one step, see predict_particles
+
+        :param u: dx, dy, dheading control input, None for constant velocity
+        '''
+        # The jitter noise buffer doubles as scratch
+        c, s = self._tmp[:self.num], self._noise[:self.num]
+        if u is None:
+            _predict(self.x, self.y, self.h, self.v, c, s)
+        else:
+            _move(self.x, self.y, self.h, self.v, u, c, s)
+
+    def jitter(self, std=(0.25,0.25,0.25,0.25)):
+        '''
+        Move particles randomly, see jitter_particles
+
+        :param std: standard deviation
+        '''
+        _jitter(self.x, self.y, self.h, self.v, std, self._noise[:self.num], self._fill_normal)
+
+    def update(self, likelihood):
+        '''
+        Weight particles by likelihood and normalise
+
+        :param likelihood: likelihood of each particle
+        '''
+        _update(self.w, likelihood, self._floor)
+
+    def neff(self):
+        return resampling.effective_sample_size(self.w)
+
+    def resample(self, scheme='systematic', num=None):
+        '''
+        Resample in proportion to the weights, optionally to a new
+        particle count (up to capacity)
+
+        :param scheme: multinomial, systematic, stratified or residual
+        :param num: new particle count, defaults to the current count
+        '''
+        num = self.num if num is None else num
+        if num > self.capacity:
+            raise ValueError(f'{num} particles exceeds capacity {self.capacity}')
+        if scheme in ('systematic', 'stratified'):
+            i = self._strata_indexes(scheme, num)
+        else:
+            i = resampling.SCHEMES[scheme](self.w.astype(np.float64), num, rng=self.rng)
+        # mode='clip' so take writes straight into out instead of a copy
+        np.take(self.data, i, axis=1, out=self._swap[:, :num], mode='clip')
+        self._data, self._swap = self._swap, self._data
+        self.num = num
+        self.w[:] = 1./num
+
+    def _strata_indexes(self, scheme, num):
+        # resampling.systematic_indexes or stratified_indexes computed in the
+        # preallocated buffers, see resampling._strata_indexes
+        n = self.num
+        cum = self._cum[:n]
+        cum[:] = self.w
+        np.cumsum(cum, out=cum)
+        cum[-1] = 1.
+
+        pos = self._pos[:num]
+        if scheme == 'systematic':
+            np.add(self._ramp[:num], self.rng.random(), out=pos)
+        else:
+            self.rng.random(out=pos)
+            pos += self._ramp[:num]
+        pos /= num
+
+        # Stratum of each cumulative weight, and whether it is below that
+        # stratum's position
+        strata, below, tmp = self._strata[:n], self._below[:n], self._gather[:n]
+        np.multiply(cum, num, out=tmp)
+        np.copyto(strata, tmp, casting='unsafe')
+        np.minimum(strata, num - 1, out=strata)
+        np.take(pos, strata, out=tmp, mode='clip')
+        np.less(cum, tmp, out=below, casting='unsafe')
+
+        # Weights in earlier strata plus those below in its own
+        count, index = self._count[:num], self._index[:num]
+        count[:] = 0
+        np.add.at(count, strata, 1)
+        np.cumsum(count, out=index)
+        index -= count
+        count[:] = 0
+        np.add.at(count, strata, below)
+        index += count
+        return index
+
+    def estimate(self):
+        '''
+        Weighted mean and variance of X,Y,H,V
+        '''
+        states = self._data[:W, :self.num]
+        w = self.w
+        mean = states @ w / w.sum()
+        var = np.empty(W)
+        tmp = self._tmp[:self.num]
+        for i in range(W):
+            np.subtract(states[i], mean[i], out=tmp)
+            np.square(tmp, out=tmp)
+            var[i] = tmp @ w
+        var /= w.sum()
+        return mean, var
+
+    @staticmethod
+    def benchmark(num=5000, steps=100):
+        '''
+        Compare per step time and allocated bytes of the (n,5) float64
+        array functions against ParticleSet, the allocation as the
+        peak traced by tracemalloc for each stage of a step
+
+        :param num: number of particles
+        :param steps: number of filter steps
+        '''
+        import time
+        import tracemalloc
+
+        likelihood = np.random.random(num)
+
+        def run_array():
+            state = {'p': gen_gaussian_particles(num=num)}
+            def stage(f, *args):
+                def run():
+                    state['p'] = f(state['p'], *args)
+                return run
+            return (('predict', stage(predict_particles)),
+                    ('jitter', stage(jitter_particles)),
+                    ('update', stage(update_particles, likelihood)),
+                    ('estimate', lambda: estimate(state['p'])),
+                    ('resample', stage(resample_particles, 'systematic')))
+
+        def run_set():
+            ps = ParticleSet(num=num, seed=0)
+            lk = likelihood.astype(ps.dtype)
+            return (('predict', ps.predict),
+                    ('jitter', ps.jitter),
+                    ('update', lambda: ps.update(lk)),
+                    ('estimate', ps.estimate),
+                    ('resample', lambda: ps.resample('systematic')))
+
+        for name, make in (('array', run_array), ('ParticleSet', run_set)):
+            stages = make()
+            for _, f in stages:
+                f()
+            t = time.perf_counter()
+            for _ in range(steps):
+                for _, f in stages:
+                    f()
+            dt = (time.perf_counter() - t) / steps
+
+            peaks = []
+            for _, f in stages:
+                tracemalloc.start()
+                f()
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            detail = ' '.join(f'{stage} {peak/1024:.1f}' for (stage, _), peak in zip(stages, peaks))
+            print(f'{name:12s} {dt*1e6:8.1f}us/step  allocation KiB: {detail}')
+
 if __name__ == '__main__':
     p = gen_gaussian_particles()
     p = jitter_particles(p)
     p = update_particles(p, np.ones_like(p[:,W])*.1)
     p = resample_particles(p)
     print(p)
-    print(estimate(p))
\ No newline at end of file
+    print(estimate(p))
+    ParticleSet.benchmark()
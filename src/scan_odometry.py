@@ -0,0 +1,249 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from scan_likelihood import beam_vectors
+
+'''
+Scan to scan odometry by ICP.
+Each scan is turned into sensor frame points and indexed by a KD-tree,
+rebuilt once per scan. The next scan is aligned to it by iterating
+nearest neighbour association and a closed form or linearised least
+squares fit of (dx, dy, dheading), starting from the previous increment:
+
+    point   point to point, Besl and McKay, "A Method for Registration of
+            3-D Shapes", 1992, with the closed form 2D fit
+    line    point to line, Censi, "An ICP variant using a point-to-line
+            metric", 2008. Line normals come from the k nearest
+            neighbours of each reference point, so only the current
+            scan's rotation is linearised
+
+Pairs further apart than max_distance, or with a poor normal, are
+dropped, and the gate is tightened to a few times the median residual
+after the first iterations so outliers from moving objects and changed
+views fall away.
+
+The increment is the pose of the new scan in the frame of the previous
+one, in the localiser's convention: pixels, x along the zero beam,
+heading in degrees.
+'''
+
+MAX_ITERATIONS = 30
+MAX_DISTANCE = 10.
+TOLERANCE = 1e-3
+MIN_PAIRS = 20
+NEIGHBOURS = 5
+
+
+def scan_points(scan, angles, stride=1):
+    '''
+    Sensor frame (n,2) points of a scan
+
+    :param scan: beam ranges in pixels
+    :param angles: beam angles in radians
+    :param stride: keep every stride-th beam
+    '''
+    bx, by = beam_vectors(scan, angles)
+    return np.stack((bx[::stride], by[::stride]), axis=1)
+
+
+def rotation(h):
+    c, s = np.cos(h), np.sin(h)
+    return np.array([[c, -s], [s, c]])
+
+
+def compose(pose, increment):
+    '''
+    Pose after moving by an increment in its own frame
+
+    :param pose: x, y, heading (degrees)
+    :param increment: dx, dy, dheading in the frame of pose
+    '''
+    h = np.radians(pose[2])
+    c, s = np.cos(h), np.sin(h)
+    return (pose[0] + c*increment[0] - s*increment[1],
+            pose[1] + s*increment[0] + c*increment[1],
+            (pose[2] + increment[2] + 180.) % 360. - 180.)
+
+
+class Reference():
+    '''
+    Points of one scan with their KD-tree and line normals
+
+    :param points: (n,2) sensor frame points
+    :param neighbours: points used for each normal
+    '''
+
+    def __init__(self, points, neighbours=NEIGHBOURS):
+        self.points = points
+        self.tree = cKDTree(points)
+        k = min(neighbours, len(points))
+        _, i = self.tree.query(points, k=k)
+        near = points[i.reshape(len(points), k)]
+        near = near - near.mean(axis=1, keepdims=True)
+        cov = np.einsum('nki,nkj->nij', near, near)
+        # Smallest eigenvector is the normal, a low ratio means a clean line
+        vals, vecs = np.linalg.eigh(cov)
+        self.normals = vecs[:,:,0]
+        self.flat = vals[:,0] <= 0.1 * np.maximum(vals[:,1], 1e-9)
+
+
+class ScanOdometry():
+    '''
+    Relative motion between consecutive scans
+
+    :param metric: 'line' for point to line, 'point' for point to point
+    :param max_iterations: ICP iterations per scan
+    :param max_distance: initial association gate in pixels
+    :param tolerance: stop once an update moves less than this, in
+                      pixels and degrees
+    :param stride: use every stride-th beam
+    :param min_pairs: fewer associated pairs than this is a failed match
+    '''
+
+    def __init__(self, metric='line', max_iterations=MAX_ITERATIONS, max_distance=MAX_DISTANCE,
+                 tolerance=TOLERANCE, stride=1, min_pairs=MIN_PAIRS):
+        if metric not in ('line', 'point'):
+            raise ValueError(f'Unknown ICP metric {metric}')
+        self.metric = metric
+        self.max_iterations = max_iterations
+        self.max_distance = max_distance
+        self.tolerance = tolerance
+        self.stride = stride
+        self.min_pairs = min_pairs
+        self.reference = None
+        self.last = np.zeros(3)
+        self.iterations = 0
+        self.rms = np.nan
+        self.failures = 0
+
+    def reset(self):
+        self.reference = None
+        self.last = np.zeros(3)
+
+    def step(self, scan, angles):
+        '''
+        Increment from the previous scan to this one, which becomes the
+        reference for the next
+
+        :param scan: beam ranges in pixels
+        :param angles: beam angles in radians
+        :return: dx, dy, dheading, or None for the first scan or a failed
+                 match
+        '''
+        points = scan_points(scan, angles, self.stride)
+        if len(points) < self.min_pairs:
+            self.failures += 1
+            return None
+        increment = None
+        if self.reference is not None:
+            increment = self.match(self.reference, points, self.last)
+            if increment is None:
+                self.failures += 1
+                self.last = np.zeros(3)
+            else:
+                self.last = increment
+        self.reference = Reference(points)
+        return increment
+
+    def match(self, reference, points, guess=(0., 0., 0.)):
+        '''
+        Align points to a reference scan
+
+        :param reference: Reference of the previous scan
+        :param points: (n,2) sensor frame points of the new scan
+        :param guess: initial dx, dy, dheading
+        :return: dx, dy, dheading of the new scan in the reference frame,
+                 or None if too few points could be associated
+        '''
+        h = np.radians(guess[2])
+        t = np.array(guess[:2], dtype=np.float64)
+        gate = self.max_distance
+        for it in range(self.max_iterations):
+            moved = points @ rotation(h).T + t
+            dist, i = reference.tree.query(moved, distance_upper_bound=gate)
+            ok = np.isfinite(dist)
+            if self.metric == 'line':
+                ok &= reference.flat[np.minimum(i, len(reference.points) - 1)]
+            if np.count_nonzero(ok) < self.min_pairs:
+                return None
+            src, dst, moved, dist = points[ok], reference.points[i[ok]], moved[ok], dist[ok]
+            self.rms = np.sqrt(np.mean(dist**2))
+            # Gate at a few times the typical residual once roughly aligned
+            if it >= 2:
+                gate = max(1., min(gate, 3. * np.median(dist)))
+
+            if self.metric == 'point':
+                dh, dt = _fit_points(moved, dst)
+            else:
+                dh, dt = _fit_lines(moved, dst, reference.normals[i[ok]])
+            h += dh
+            t = rotation(dh) @ t + dt
+            if np.hypot(*dt) < self.tolerance and abs(np.degrees(dh)) < self.tolerance:
+                break
+        self.iterations = it + 1
+        return np.array([t[0], t[1], np.degrees(h)])
+
+
+def _fit_points(src, dst):
+    # Rotation about the origin then translation taking src onto dst, least squares
+    ms, md = src.mean(axis=0), dst.mean(axis=0)
+    a, b = src - ms, dst - md
+    h = np.arctan2(np.sum(a[:,0]*b[:,1] - a[:,1]*b[:,0]), np.sum(a[:,0]*b[:,0] + a[:,1]*b[:,1]))
+    return h, md - rotation(h) @ ms
+
+
+def _fit_lines(src, dst, normals):
+    # Linearised point to line fit of a small rotation and translation
+    n = normals
+    J = np.stack((n[:,0], n[:,1], n[:,1]*src[:,0] - n[:,0]*src[:,1]), axis=1)
+    r = np.sum(n * (dst - src), axis=1)
+    A = J.T @ J + 1e-6 * np.eye(3)
+    tx, ty, h = np.linalg.solve(A, J.T @ r)
+    # Small angle solution, taken as an exact rotation about the origin
+    return h, np.array([tx, ty])
+
+
+def benchmark(num=120, seed=0):
+    '''
+    Accuracy and cost of both metrics on the synthetic room of
+    simulators.synthetic_scans, which turns 1 degree per scan in place,
+    and on the same room moving along x
+
+    :param num: scans per run
+    '''
+    import time
+    from simulators import synthetic_scans
+
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(np.radians(0),np.radians(360),720, endpoint=False)
+    turning = synthetic_scans(num=num, seed=seed)
+
+    # Rectangle walls seen from a sensor moving 1 pixel per scan along x
+    def ranges(x):
+        c, s = np.cos(angles), np.sin(angles)
+        with np.errstate(divide='ignore'):
+            rx = np.where(c > 0, (100 - x) / c, (-100 - x) / c)
+            ry = np.where(s > 0, 60 / s, -60 / s)
+        return np.clip(np.minimum(np.abs(rx), np.abs(ry)) + rng.normal(0, 1, len(angles)), 0, 254)
+    moving = np.array([ranges(-num / 2. + i) for i in range(num)])
+
+    for name, scans, truth in (('turning', turning, (0., 0., 1.)), ('moving', moving, (1., 0., 0.))):
+        for metric in ('point', 'line'):
+            odom = ScanOdometry(metric)
+            errors, iterations = [], []
+            t = time.perf_counter()
+            for scan in scans:
+                keep = scan > 1
+                inc = odom.step(scan[keep].astype(np.float64), angles[keep])
+                if inc is not None:
+                    errors.append(inc - truth)
+                    iterations.append(odom.iterations)
+            dt = (time.perf_counter() - t) / len(scans)
+            errors = np.abs(np.array(errors))
+            print(f'{name:>8} {metric:>5}: {dt*1e3:5.2f}ms/scan, {np.mean(iterations):4.1f} iterations, '
+                  f'mean error {errors[:,0].mean():.3f} {errors[:,1].mean():.3f}px {errors[:,2].mean():.3f}deg, '
+                  f'{odom.failures} failures')
+
+
+if __name__ == '__main__':
+    benchmark()
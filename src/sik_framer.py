@@ -0,0 +1,155 @@
+import time
+
+import numpy as np
+
+'''
+Streaming frame parser for the LIDAR packets from the SiK radio.
+A packet is FRAME_LEN bytes, a 15 byte timestamp, 720 ranges and a 0xFF
+terminator. Bytes are read straight into a preallocated bytearray and
+complete frames are handed out as memoryview slices of it, so nothing
+is copied per packet. Frames always sit contiguously in the buffer, the
+unparsed tail is moved back to the front when space runs out.
+
+Once aligned, only the byte at the end of each frame is checked, so 0xFF
+inside the range data does not split a frame. If the terminator is
+missing the parser drops bytes up to the next 0xFF and tries again from
+there.
+'''
+
+FRAME_LEN = 736
+TERMINATOR = 0xFF
+STAMP_LEN = 15
+
+
+class SikFramer():
+    '''
+    Zero copy framer over a preallocated buffer
+
+    :param frame_len: packet length including the terminator
+    :param terminator: last byte of every packet
+    :param capacity: buffer size in bytes
+    '''
+
+    def __init__(self, frame_len=FRAME_LEN, terminator=TERMINATOR, capacity=64*1024):
+        self.frame_len = frame_len
+        self.terminator = terminator
+        self.buf = bytearray(max(capacity, 4 * frame_len))
+        self.view = memoryview(self.buf)
+        self.head = 0
+        self.tail = 0
+
+        # Link health counters
+        self.frames = 0
+        self.dropped_bytes = 0
+        self.resyncs = 0
+        self._last_frames = 0
+        self._last_time = time.monotonic()
+
+    def free(self):
+        '''
+        Writable view of the free space at the end of the buffer,
+        compacting the buffer first if it is short of a frame
+        '''
+        if len(self.buf) - self.tail < self.frame_len:
+            pending = self.tail - self.head
+            self.buf[:pending] = self.buf[self.head:self.tail]
+            self.head, self.tail = 0, pending
+        return self.view[self.tail:]
+
+    def commit(self, n):
+        '''
+        Mark n bytes written into the view from free() as received
+
+        :param n: number of bytes written
+        '''
+        self.tail += n
+
+    def feed(self, data):
+        '''
+        Copy received bytes into the buffer
+
+        :param data: bytes-like
+        '''
+        data = memoryview(data)
+        while len(data):
+            space = self.free()
+            n = min(len(space), len(data))
+            space[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+
+    def read_from(self, port, bulk=4096):
+        '''
+        Read whatever the serial port has waiting (at least one byte,
+        blocking) straight into the buffer
+
+        :param port: serial.Serial
+        :param bulk: largest single read
+        :return: number of bytes read
+        '''
+        space = self.free()
+        n = max(1, min(port.in_waiting, bulk, len(space)))
+        n = port.readinto(space[:n]) or 0
+        self.commit(n)
+        return n
+
+    def frames_available(self):
+        '''
+        Yield each complete frame as a memoryview into the buffer.
+        A frame is only valid until the next call to free, feed or read_from
+        '''
+        end = self.frame_len - 1
+        while self.tail - self.head >= self.frame_len:
+            if self.buf[self.head + end] == self.terminator:
+                frame = self.view[self.head:self.head + self.frame_len]
+                self.head += self.frame_len
+                self.frames += 1
+                yield frame
+                continue
+
+            # Lost alignment, restart after the next terminator
+            self.resyncs += 1
+            i = self.buf.find(self.terminator, self.head, self.tail)
+            skip = (i + 1 if i >= 0 else self.tail) - self.head
+            self.head += skip
+            self.dropped_bytes += skip
+
+    def stats(self):
+        '''
+        Frames per second since the last call and the running counters
+        '''
+        now = time.monotonic()
+        fps = (self.frames - self._last_frames) / max(now - self._last_time, 1e-9)
+        self._last_frames, self._last_time = self.frames, now
+        return fps, self.frames, self.dropped_bytes, self.resyncs
+
+
+def split_frame(frame):
+    '''
+    Timestamp bytes and ranges of a frame, both views into it
+
+    :param frame: memoryview of one frame
+    '''
+    return frame[:STAMP_LEN], np.frombuffer(frame[STAMP_LEN:-1], dtype=np.uint8)
+
+
+if __name__ == '__main__':
+    framer = SikFramer()
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(2000):
+        ranges = rng.integers(0, 256, 720, dtype=np.uint8)
+        frames.append(b'%015d' % i + ranges.tobytes() + b'\xFF')
+    stream = bytearray(b''.join(frames))
+    # Corrupt a frame and split the stream at arbitrary points
+    del stream[736*100+200:736*100+260]
+    t = time.perf_counter()
+    got = 0
+    for start in range(0, len(stream), 1000):
+        framer.feed(stream[start:start+1000])
+        for frame in framer.frames_available():
+            stamp, ranges = split_frame(frame)
+            got += 1
+    dt = time.perf_counter() - t
+    fps, n, dropped, resyncs = framer.stats()
+    print(f'{got} frames of {len(frames)}, {dropped} bytes dropped, {resyncs} resyncs, {got/dt:.0f} frames/s')
@@ -0,0 +1,354 @@
+import os
+import tty
+import time
+import select
+import socket
+from pathlib import Path
+from threading import Thread, Event
+
+import numpy as np
+
+from sik_framer import FRAME_LEN, STAMP_LEN, TERMINATOR
+from gcs_log import GCSLog, convert
+from vessel_link import period_stats
+
+'''
+Local stand-ins for the vessel hardware, for exercising and benchmarking
+the GCS front ends without a boat.
+
+WamvSim is a UDP WAM-V. It sends N2K fixes and HLC thruster states to
+the GCS and answers each command it receives with an ECHO packet,
+run_fleet runs many of them for the fleet view.
+SikSim is a SiK radio on a pseudo terminal. It streams FRAME_LEN byte
+LIDAR frames, synthetic or replayed from a gcs_*.log, and echoes the
+$CMD lines it receives to the console.
+
+Both put their send time (time.monotonic) in each message, so a GCS on
+the same host can measure end to end latency. For N2K and HLC it is an
+extra trailing field, which the GCS ignores. For LIDAR frames it is the
+frame timestamp, in microseconds, see stamp_age.
+'''
+
+
+def stamp_age(stamp):
+    '''
+    Seconds since a simulator LIDAR frame was sent
+
+    :param stamp: timestamp bytes of the frame
+    '''
+    return time.monotonic() - int(bytes(stamp)) * 1e-6
+
+
+class WamvSim():
+    '''
+    UDP WAM-V, circles about origin and echoes commands
+
+    :param gcs_addr: where telemetry is sent
+    :param addr: address commands are received on, port 0 for any
+    :param n2k_rate: N2K fixes per second
+    :param hlc_rate: HLC messages per second
+    :param origin: lat, lon of the centre of the circle
+    :param echo: answer commands with ECHO,<command>
+    '''
+
+    def __init__(self, gcs_addr=('127.0.0.1', 5000), addr=('127.0.0.1', 6000),
+                 n2k_rate=10., hlc_rate=2., origin=(-42.8826, 147.3257), echo=True):
+        self.gcs_addr = gcs_addr
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(addr)
+        self.sock.setblocking(False)
+        self.addr = self.sock.getsockname()
+        self.n2k_rate = n2k_rate
+        self.hlc_rate = hlc_rate
+        self.origin = origin
+        self.echo = echo
+
+        self.thrust, self.rudder = 0, 0
+        self.reset()
+        self._stop = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def reset(self):
+        '''
+        Zero the counters
+        '''
+        self.n2k_sent = 0
+        self.hlc_sent = 0
+        self.send_errors = 0
+        self.commands = []
+        self.started = time.monotonic()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+        self.sock.close()
+
+    def _send(self, msg):
+        try:
+            self.sock.sendto(msg.encode(), self.gcs_addr)
+            return True
+        except OSError:
+            self.send_errors += 1
+            return False
+
+    def _n2k(self, now):
+        t = now - self.started
+        lat = self.origin[0] + 2e-4 * np.sin(t / 30)
+        lon = self.origin[1] + 3e-4 * np.cos(t / 30)
+        hdg = np.degrees(-t / 30) % 360
+        if self._send(f'N2K,{lat:.8f},{lon:.8f},1.5,{hdg:.1f},{now:.6f}\n'):
+            self.n2k_sent += 1
+
+    def _hlc(self, now):
+        port = max(-1000, min(1000, self.thrust + self.rudder))
+        stbd = max(-1000, min(1000, self.thrust - self.rudder))
+        if self._send(f'HLC,0,0,{port},{stbd},{now:.6f}\n'):
+            self.hlc_sent += 1
+
+    def _command(self, data, sender):
+        line = data.decode(errors='replace').strip()
+        self.commands.append(time.monotonic())
+        fields = line.split(',')
+        if len(fields) == 4:
+            try:
+                self.thrust, self.rudder = int(fields[0]), int(fields[1])
+            except ValueError:
+                pass
+        if self.echo:
+            try:
+                self.sock.sendto(f'ECHO,{line}\n'.encode(), sender)
+            except OSError:
+                self.send_errors += 1
+
+    def _run(self):
+        now = time.monotonic()
+        next_n2k = next_hlc = now
+        while not self._stop.is_set():
+            # Rates may be changed from other threads, read them once
+            now, n2k_rate, hlc_rate = time.monotonic(), self.n2k_rate, self.hlc_rate
+            if n2k_rate > 0 and now >= next_n2k:
+                self._n2k(now)
+                next_n2k = max(next_n2k + 1. / n2k_rate, now - 1.)
+            if hlc_rate > 0 and now >= next_hlc:
+                self._hlc(now)
+                next_hlc = max(next_hlc + 1. / hlc_rate, now - 1.)
+            wait = min(next_n2k if n2k_rate > 0 else now + 0.1,
+                       next_hlc if hlc_rate > 0 else now + 0.1) - time.monotonic()
+            ready, _, _ = select.select([self.sock], [], [], max(0., min(wait, 0.1)))
+            while ready:
+                try:
+                    self._command(*self.sock.recvfrom(4096))
+                except (BlockingIOError, InterruptedError):
+                    break
+
+    def stats(self):
+        '''
+        Messages sent per second since reset, command count and period
+        statistics (mean, std, worst deviation from the mean)
+        '''
+        dt = max(time.monotonic() - self.started, 1e-9)
+        commands = np.array(self.commands)
+        if len(commands) > 2:
+            mean, std, worst = period_stats(commands, np.diff(commands).mean())
+        else:
+            mean, std, worst = np.nan, np.nan, np.nan
+        return {'n2k_rate': self.n2k_sent / dt, 'hlc_rate': self.hlc_sent / dt,
+                'commands': len(commands), 'cmd_period': mean, 'cmd_std': std,
+                'cmd_worst': worst, 'send_errors': self.send_errors}
+
+
+def run_fleet(gcs_addr, num, n2k_rate, duration, sent=None):
+    '''
+    Run num WamvSims for duration seconds, vessels spaced 100m apart.
+    Meant as a multiprocessing target so a large fleet does not share
+    the GIL with the GCS under test
+
+    :param gcs_addr: where telemetry is sent
+    :param num: number of vessels
+    :param n2k_rate: N2K fixes per second per vessel
+    :param duration: seconds to run
+    :param sent: multiprocessing.Queue given the N2K and HLC messages sent
+    '''
+    sims = [WamvSim(gcs_addr, ('127.0.0.1', 0), n2k_rate=n2k_rate, hlc_rate=2.,
+                    origin=(-42.8826 + 1e-3 * k, 147.3257), echo=False).start() for k in range(num)]
+    time.sleep(duration)
+    for sim in sims:
+        sim.stop()
+    if sent is not None:
+        sent.put((sum(sim.n2k_sent for sim in sims), sum(sim.hlc_sent for sim in sims)))
+
+
+def load_scans(log_file, beams=720):
+    '''
+    LIDAR scans from a gcs_*.log (converted on first use) or a converted
+    .cols directory, as uint8 rows of beams ranges
+    '''
+    log_file = Path(log_file)
+    if not log_file.is_dir():
+        cols = log_file.with_suffix('.cols')
+        log_file = cols if (cols / 'meta.json').exists() else convert(log_file)
+    scans = np.asarray(GCSLog(log_file).lidar_scan, dtype=np.uint8)
+    out = np.zeros((len(scans), beams), dtype=np.uint8)
+    n = min(beams, scans.shape[1]) if scans.ndim == 2 else 0
+    out[:, :n] = scans[:, :n]
+    return out
+
+
+def synthetic_scans(num=360, beams=720, seed=0):
+    '''
+    Scans of a slowly turning rectangular room with some noise
+    '''
+    rng = np.random.default_rng(seed)
+    angles = np.radians(np.arange(beams) * 360. / beams)
+    scans = np.empty((num, beams), dtype=np.uint8)
+    for i in range(num):
+        a = angles + np.radians(i)
+        r = np.minimum(100 / (np.abs(np.cos(a)) + 1e-9), 60 / (np.abs(np.sin(a)) + 1e-9))
+        scans[i] = np.clip(r + rng.normal(0, 1, beams), 0, 254)
+    return scans
+
+
+class SikSim():
+    '''
+    SiK radio on a pseudo terminal streaming LIDAR frames
+
+    :param rate: frames per second
+    :param log: gcs_*.log or .cols directory to replay, synthetic if None
+    :param echo: print received commands
+    '''
+
+    def __init__(self, rate=10., log=None, echo=True):
+        self.rate = rate
+        self.echo = echo
+        self.scans = load_scans(log) if log else synthetic_scans()
+        beams = FRAME_LEN - STAMP_LEN - 1
+        if self.scans.shape[1] != beams:
+            self.scans = np.resize(self.scans, (len(self.scans), beams))
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+
+        self.frame = bytearray(FRAME_LEN)
+        self.frame[-1] = TERMINATOR
+        self.pending = b''
+        self.line = b''
+        self.reset()
+        self._stop = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def reset(self):
+        '''
+        Zero the counters
+        '''
+        self.sent = 0
+        self.dropped = 0
+        self.commands = []
+        self.started = time.monotonic()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _write(self, data):
+        # Keep partial writes so frames stay contiguous on the wire
+        try:
+            n = os.write(self.master, data)
+        except BlockingIOError:
+            n = 0
+        return data[n:]
+
+    def _frame(self, now, i):
+        if self.pending:
+            self.pending = self._write(self.pending)
+            if self.pending:
+                self.dropped += 1
+                return
+        self.frame[:STAMP_LEN] = b'%015d' % int(now * 1e6)
+        self.frame[STAMP_LEN:-1] = self.scans[i % len(self.scans)].tobytes()
+        self.pending = self._write(bytes(self.frame))
+        self.sent += 1
+
+    def _read_commands(self):
+        try:
+            self.line += os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        *lines, self.line = self.line.split(b'\n')
+        for line in lines:
+            self.commands.append(time.monotonic())
+            if self.echo:
+                print(f'SIK < {line.decode(errors="replace")}')
+
+    def _run(self):
+        deadline = time.monotonic()
+        i = 0
+        while not self._stop.is_set():
+            now, rate = time.monotonic(), self.rate
+            if rate > 0 and now >= deadline:
+                self._frame(now, i)
+                i += 1
+                deadline = max(deadline + 1. / rate, now - 1.)
+            wait = deadline - time.monotonic() if rate > 0 else 0.1
+            ready, _, _ = select.select([self.master], [], [], max(0., min(wait, 0.1)))
+            if ready:
+                self._read_commands()
+
+    def stats(self):
+        '''
+        Frames sent per second since reset, frames dropped because the
+        reader fell behind, and commands received
+        '''
+        dt = max(time.monotonic() - self.started, 1e-9)
+        return {'frame_rate': self.sent / dt, 'frames': self.sent,
+                'dropped': self.dropped, 'commands': len(self.commands)}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Local WAM-V and SiK radio simulators')
+    sub = parser.add_subparsers(dest='sim', required=True)
+    wamv = sub.add_parser('wamv', help='UDP WAM-V for wamv_gcs.py --local ... --wamv ...')
+    wamv.add_argument('--gcs', default='127.0.0.1:5000', help='host:port telemetry is sent to')
+    wamv.add_argument('--bind', default='127.0.0.1:6000', help='host:port commands are received on')
+    wamv.add_argument('--n2k', type=float, default=10., help='N2K fixes per second')
+    wamv.add_argument('--hlc', type=float, default=2., help='HLC messages per second')
+    fleet = sub.add_parser('fleet', help='several UDP WAM-Vs, each on its own port')
+    fleet.add_argument('--gcs', default='127.0.0.1:5000', help='host:port telemetry is sent to')
+    fleet.add_argument('--vessels', type=int, default=10, help='number of vessels')
+    fleet.add_argument('--n2k', type=float, default=10., help='N2K fixes per second per vessel')
+    fleet.add_argument('--duration', type=float, default=3600., help='seconds to run')
+    sik = sub.add_parser('sik', help='pty SiK radio for gcs.py <pty>')
+    sik.add_argument('--rate', type=float, default=10., help='LIDAR frames per second')
+    sik.add_argument('--log', default=None, help='gcs_*.log or .cols directory to replay')
+    args = parser.parse_args()
+
+    if args.sim == 'fleet':
+        host, port = args.gcs.rsplit(':', 1)
+        print(f'{args.vessels} WAM-Vs sending to {args.gcs}')
+        run_fleet((host, int(port)), args.vessels, args.n2k, args.duration)
+        raise SystemExit
+    if args.sim == 'wamv':
+        addr = lambda s: (s.rsplit(':', 1)[0], int(s.rsplit(':', 1)[1]))
+        sim = WamvSim(addr(args.gcs), addr(args.bind), n2k_rate=args.n2k, hlc_rate=args.hlc).start()
+        print(f'WAM-V on {sim.addr[0]}:{sim.addr[1]} sending to {args.gcs}')
+    else:
+        sim = SikSim(args.rate, args.log).start()
+        print(f'SiK radio on {sim.port}, {len(sim.scans)} scans')
+    try:
+        while True:
+            time.sleep(5.)
+            print(', '.join(f'{k} {v:.4g}' for k, v in sim.stats().items()))
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,177 @@
+import struct
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from threading import Thread, Event
+
+import numpy as np
+
+'''
+Background telemetry logger for the GCS.
+log() only timestamps the record and appends it to a bounded deque, it
+never blocks on the disk. A writer thread drains the deque in batches
+and writes each batch with a single call. When the deque is full new
+records are dropped and counted rather than stalling the caller.
+
+Text records keep the gcs_*.log line format:
+    YYYYMMDD,HHMMSS,ffffff,<src_id>,<v0>,<v1>,...
+Binary records (.bin) are:
+    int64 microseconds since 1970-01-01 (local time), uint8 source id
+    length, source id, 1 byte numpy dtype char, uint32 count, raw values
+'''
+
+HEADER = struct.Struct('<qB')
+BODY = struct.Struct('<cI')
+EPOCH = datetime(1970,1,1)
+
+
+def format_text(stamp, src_id, data):
+    return f'{stamp:%Y%m%d,%H%M%S,%f},{src_id},{",".join(map(str, data.tolist()))}\n'
+
+
+def format_binary(stamp, src_id, data):
+    us = (stamp - EPOCH) // timedelta(microseconds=1)
+    src = src_id.encode()
+    return b''.join((HEADER.pack(us, len(src)), src,
+                     BODY.pack(data.dtype.char.encode(), data.size), data.tobytes()))
+
+
+def read_binary(path):
+    '''
+    Yield (timestamp, src_id, values) from a binary telemetry log
+
+    :param path: .bin file written by TelemetryLogger
+    '''
+    with open(path, 'rb') as f:
+        buf = f.read()
+    i = 0
+    while i + HEADER.size <= len(buf):
+        us, n = HEADER.unpack_from(buf, i)
+        i += HEADER.size
+        src = buf[i:i+n].decode()
+        i += n
+        char, count = BODY.unpack_from(buf, i)
+        i += BODY.size
+        dtype = np.dtype(char.decode())
+        data = np.frombuffer(buf, dtype=dtype, count=count, offset=i)
+        i += count * dtype.itemsize
+        yield EPOCH + timedelta(microseconds=us), src, data
+
+
+class TelemetryLogger():
+    '''
+    Batched, rotating log writer running on its own thread
+
+    :param logdir: directory for the log files
+    :param prefix: file name prefix, files are <prefix>_HHMMSS.log (or .bin)
+    :param binary: write the compact binary record format
+    :param max_records: queue bound, records beyond this are dropped
+    :param max_bytes: rotate once a file reaches this size, 0 for never
+    :param max_age: rotate once a file is this many seconds old, 0 for never
+    :param interval: seconds between batch writes
+    '''
+
+    def __init__(self, logdir, prefix='gcs', binary=False, max_records=20000,
+                 max_bytes=256*1024*1024, max_age=0, interval=0.5):
+        self.logdir = Path(logdir)
+        self.prefix = prefix
+        self.binary = binary
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+
+        self.queue = deque()
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.files = 0
+
+        self.file = None
+        self._open()
+        self._stop = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, src_id, data):
+        '''
+        Queue a record, never blocks
+
+        :param src_id: source id, e.g. LIDAR or ARUCO_3
+        :param data: numpy array of values, copied
+        '''
+        if len(self.queue) >= self.max_records:
+            self.dropped += 1
+            return False
+        self.queue.append((datetime.now(), src_id, np.array(data).ravel()))
+        return True
+
+    def stats(self):
+        '''
+        Queue depth, dropped, written records, batches and files
+        '''
+        return len(self.queue), self.dropped, self.written, self.batches, self.files
+
+    def close(self):
+        '''
+        Write out everything queued and stop the writer thread
+        '''
+        self._stop.set()
+        self.thread.join()
+        self.file.close()
+
+    def _open(self):
+        ext = 'bin' if self.binary else 'log'
+        stamp = f'{datetime.now():%H%M%S}'
+        path = self.logdir / f'{self.prefix}_{stamp}.{ext}'
+        n = 1
+        while path.exists():
+            path = self.logdir / f'{self.prefix}_{stamp}_{n}.{ext}'
+            n += 1
+        self.file = open(path, 'wb' if self.binary else 'w')
+        self.path = path
+        self.opened = time.monotonic()
+        self.size = 0
+        self.files += 1
+
+    def _write_batch(self):
+        records = []
+        for _ in range(len(self.queue)):
+            records.append(self.queue.popleft())
+        if not records:
+            return
+        fmt = format_binary if self.binary else format_text
+        chunk = (b'' if self.binary else '').join(fmt(*r) for r in records)
+        self.file.write(chunk)
+        self.file.flush()
+        self.size += len(chunk)
+        self.written += len(records)
+        self.batches += 1
+
+        if (self.max_bytes and self.size >= self.max_bytes) or \
+                (self.max_age and time.monotonic() - self.opened >= self.max_age):
+            self.file.close()
+            self._open()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._write_batch()
+        self._write_batch()
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    scan = np.random.randint(0,255,720).astype(np.uint8)
+    with tempfile.TemporaryDirectory() as logdir:
+        for binary in (False, True):
+            logger = TelemetryLogger(logdir, binary=binary, interval=0.1)
+            t = time.perf_counter()
+            for _ in range(5000):
+                logger.log('LIDAR', scan)
+            dt = (time.perf_counter() - t) / 5000
+            logger.close()
+            depth, dropped, written, batches, files = logger.stats()
+            print(f'binary={binary}: log() {dt*1e6:.1f}us, {written} written in {batches} batches, '
+                  f'{dropped} dropped, {logger.path.stat().st_size/written:.0f} bytes/record')
@@ -0,0 +1,218 @@
+import time
+
+import numpy as np
+
+'''
+Vessel track rendering on a Tk canvas.
+The track is kept as a ring of recent fixes at full rate plus a
+decimated history, where a fix is only kept once the vessel has moved
+min_dist or max_gap seconds have passed. When the history fills up
+every other point is dropped. The whole track is drawn as a single
+polyline item whose coordinates are updated in place, so the number of
+canvas items, and the redraw cost, stays fixed however long the session.
+Several tracks can share one View, so a fleet is drawn about a common
+origin and pans and zooms together.
+'''
+
+
+class View():
+    '''
+    Shared world to screen transform, the origin is the first fix added
+    to any track using it
+
+    :param canvas: tk.Canvas
+    :param center: screen position of the origin
+    '''
+
+    def __init__(self, canvas, center=(400,200)):
+        self.canvas = canvas
+        self.center = np.array(center, dtype=np.float64)
+        self.origin = None
+        self.scale = 1.
+        self.pan = np.zeros(2)
+        self.version = 0
+
+    def bind(self):
+        '''
+        Drag to pan, mouse wheel to zoom
+        '''
+        self.canvas.bind('<ButtonPress-1>', self._drag_start)
+        self.canvas.bind('<B1-Motion>', self._drag)
+        self.canvas.bind('<MouseWheel>', self._wheel)
+        self.canvas.bind('<Button-4>', lambda e: self.zoom(1.25, e.x, e.y))
+        self.canvas.bind('<Button-5>', lambda e: self.zoom(0.8, e.x, e.y))
+
+    def to_screen(self, xy):
+        return self.center + self.pan + self.scale * (xy - self.origin)
+
+    def zoom(self, factor, x=None, y=None):
+        '''
+        Zoom about a screen point, by default the origin
+
+        :param factor: scale multiplier
+        '''
+        if x is not None:
+            fixed = np.array([x, y], dtype=np.float64)
+            self.pan = fixed - self.center - factor * (fixed - self.center - self.pan)
+        self.scale *= factor
+        self.version += 1
+
+    def _drag_start(self, event):
+        self._drag_from = np.array([event.x, event.y], dtype=np.float64)
+
+    def _drag(self, event):
+        here = np.array([event.x, event.y], dtype=np.float64)
+        self.pan += here - self._drag_from
+        self._drag_from = here
+        self.version += 1
+
+    def _wheel(self, event):
+        self.zoom(1.25 if event.delta > 0 else 0.8, event.x, event.y)
+
+
+class TrackRenderer():
+    '''
+    Bounded, decimated track drawn as one canvas line
+
+    :param canvas: tk.Canvas
+    :param center: screen position of the origin
+    :param recent: number of full rate fixes kept
+    :param history: maximum decimated fixes kept
+    :param min_dist: distance between decimated fixes in metres
+    :param max_gap: maximum time between decimated fixes in seconds
+    :param colour: track colour
+    :param view: shared View, by default the track has its own
+    :param label: text drawn by the marker, None for none
+    '''
+
+    def __init__(self, canvas, center=(400,200), recent=600, history=2000,
+                 min_dist=2., max_gap=30., colour='blue', view=None, label=None):
+        self.canvas = canvas
+        self.view = view if view is not None else View(canvas, center)
+        self.min_dist = min_dist
+        self.max_gap = max_gap
+
+        self.recent = np.zeros((recent,2))
+        self.recent_len = 0
+        self.recent_head = 0
+        self.history = np.zeros((history,2))
+        self.history_len = 0
+        self.last_kept = 0.
+
+        self.dirty = False
+        self.line_dirty = False
+        self.drawn_version = -1
+
+        self.line = canvas.create_line(0,0,0,0, fill=colour, width=2)
+        self.marker = canvas.create_oval(0,0,0,0, fill=colour, outline='black')
+        self.text = None
+        if label is not None:
+            self.text = canvas.create_text(0,0, text=label, fill=colour, anchor='sw')
+
+    def bind_view(self):
+        '''
+        Drag to pan, mouse wheel to zoom
+        '''
+        self.view.bind()
+
+    def add(self, xy):
+        '''
+        Add a fix in world coordinates (metres)
+
+        :param xy: x, y
+        '''
+        xy = np.asarray(xy, dtype=np.float64)
+        if self.view.origin is None:
+            self.view.origin = xy.copy()
+
+        # Oldest recent fix moves to the decimated history when overwritten
+        if self.recent_len == len(self.recent):
+            self._keep(self.recent[self.recent_head])
+        else:
+            self.recent_len += 1
+        self.recent[self.recent_head] = xy
+        self.recent_head = (self.recent_head + 1) % len(self.recent)
+        self.dirty = True
+        self.line_dirty = True
+
+    def _keep(self, xy):
+        now = time.monotonic()
+        if self.history_len:
+            last = self.history[self.history_len - 1]
+            if np.hypot(*(xy - last)) < self.min_dist and now - self.last_kept < self.max_gap:
+                return
+        if self.history_len == len(self.history):
+            half = self.history[:self.history_len:2]
+            self.history_len = len(half)
+            self.history[:self.history_len] = half
+        self.history[self.history_len] = xy
+        self.history_len += 1
+        self.last_kept = now
+
+    def points(self):
+        '''
+        Whole track, oldest first, in world coordinates
+        '''
+        recent = np.roll(self.recent[:self.recent_len], -self.recent_head if
+                         self.recent_len == len(self.recent) else 0, axis=0)
+        return np.concatenate((self.history[:self.history_len], recent))
+
+    def to_screen(self, xy):
+        return self.view.to_screen(xy)
+
+    def zoom(self, factor, x=None, y=None):
+        self.view.zoom(factor, x, y)
+
+    def last(self):
+        '''
+        Newest fix in world coordinates
+        '''
+        return self.recent[self.recent_head - 1]
+
+    def draw(self, line=True):
+        '''
+        Update the canvas items if anything changed
+
+        :param line: also redraw the track line, otherwise only the
+                     marker moves and the line catches up on a later draw
+        '''
+        moved = self.drawn_version != self.view.version
+        if self.recent_len == 0 or not (self.dirty or self.line_dirty or moved):
+            return
+        if line and (self.line_dirty or moved):
+            screen = self.to_screen(self.points())
+            if len(screen) < 2:
+                screen = np.vstack((screen, screen))
+            self.canvas.coords(self.line, *screen.ravel().tolist())
+            self.line_dirty = False
+            self.drawn_version = self.view.version
+        x, y = self.to_screen(self.last()).tolist()
+        self.canvas.coords(self.marker, x-5, y-5, x+5, y+5)
+        if self.text is not None:
+            self.canvas.coords(self.text, x+6, y-6)
+        self.dirty = False
+
+
+if __name__ == '__main__':
+    import tkinter as tk
+
+    root = tk.Tk()
+    canvas = tk.Canvas(root, width=800, height=400, bg='black')
+    canvas.pack()
+    track = TrackRenderer(canvas, recent=200, history=500)
+    track.bind_view()
+
+    state = {'t': 0., 'ticks': 0, 'start': time.perf_counter()}
+    def tick():
+        state['t'] += 0.05
+        t = state['t']
+        track.add((150*np.cos(t/10) + 5*np.sin(t), 80*np.sin(t/7)))
+        track.draw()
+        state['ticks'] += 1
+        if state['ticks'] % 200 == 0:
+            dt = (time.perf_counter() - state['start']) / 200
+            print(f'{state["ticks"]} fixes, {len(canvas.find_all())} items, {dt*1e3:.2f}ms/tick')
+            state['start'] = time.perf_counter()
+        root.after(5, tick)
+    tick()
+    root.mainloop()
@@ -0,0 +1,188 @@
+import time
+import socket
+import logging
+import logging.handlers
+from queue import Queue, Full, Empty
+from threading import Thread
+
+'''
+Non-blocking telemetry receive path for the WAM-V GCS.
+Datagrams are received into one reusable buffer, split into fields and
+handed to the GUI thread through a bounded queue, stamped with their
+receive time. Nothing on the receive thread touches Tk, projects
+positions or writes to the console.
+Logging goes through a QueueHandler, so log calls only enqueue, and a
+QueueListener thread does the file and console I/O, with the console
+rate limited.
+'''
+
+# Linux socket option reporting datagrams dropped by the kernel
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Pass at most rate records per second, counting the rest
+
+    :param rate: records per second
+    '''
+
+    def __init__(self, rate=5.):
+        super().__init__()
+        self.interval = 1. / rate
+        self.next = 0.
+        self.suppressed = 0
+
+    def filter(self, record):
+        now = time.monotonic()
+        if now < self.next:
+            self.suppressed += 1
+            return False
+        self.next = now + self.interval
+        return True
+
+
+def setup_logging(filename, console_rate=5., fmt='%(asctime)s [%(levelname)s] [%(module)s] %(message)s'):
+    '''
+    Route the root logger through a queue to a file handler and a rate
+    limited console handler running on a listener thread
+
+    :param filename: log file
+    :param console_rate: console records per second
+    :return: started logging.handlers.QueueListener, stop it on exit
+    '''
+    formatter = logging.Formatter(fmt)
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(formatter)
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+    console.addFilter(RateLimitFilter(console_rate))
+
+    queue = Queue(-1)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    listener = logging.handlers.QueueListener(queue, file_handler, console, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class UdpReceiver():
+    '''
+    Receive thread feeding parsed datagrams to a queue. Either call
+    start() for a dedicated thread or register read_ready() with an
+    event loop
+
+    :param sock: bound UDP socket
+    :param logger: logger for the raw packets
+    :param depth: queue bound, packets beyond this are dropped
+    :param bufsize: largest datagram
+    '''
+
+    def __init__(self, sock, logger=None, depth=1000, bufsize=4096):
+        self.sock = sock
+        self.logger = logger
+        self.queue = Queue(maxsize=depth)
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+
+        self.packets = 0
+        self.queue_drops = 0
+        self.kernel_drops = 0
+        self.latency = 0.
+        self._last_packets = 0
+        self._last_time = time.monotonic()
+
+        self.ovfl = False
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.ovfl = True
+        except OSError:
+            pass
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _recv(self):
+        if self.ovfl:
+            n, ancdata, flags, addr = self.sock.recvmsg_into([self.view], socket.CMSG_SPACE(4))
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                    self.kernel_drops = int.from_bytes(data[:4], 'little')
+            return n, addr
+        return self.sock.recvfrom_into(self.view)
+
+    def _handle(self, n, addr):
+        t_recv = time.monotonic()
+        line = str(self.view[:n], 'ascii', 'replace').strip()
+        self.packets += 1
+        if self.logger is not None:
+            self.logger.info(line)
+        try:
+            self.queue.put_nowait((t_recv, addr, line.split(',')))
+        except Full:
+            self.queue_drops += 1
+
+    def _run(self):
+        while True:
+            self._handle(*self._recv())
+
+    def read_ready(self):
+        '''
+        Read every pending packet from a non-blocking socket, for use as
+        an event loop reader callback instead of the receive thread
+        '''
+        while True:
+            try:
+                n, addr = self._recv()
+            except (BlockingIOError, InterruptedError):
+                return
+            self._handle(n, addr)
+
+    def drain(self):
+        '''
+        All queued packets as (receive time, sender, fields), called
+        from the GUI thread. Tracks the receive to processing latency
+        '''
+        packets = []
+        while True:
+            try:
+                packets.append(self.queue.get_nowait())
+            except Empty:
+                break
+        if packets:
+            latency = time.monotonic() - packets[0][0]
+            self.latency += 0.1 * (latency - self.latency)
+        return packets
+
+    def stats(self):
+        '''
+        Packets per second since the last call, total packets, kernel
+        and queue drops, and mean receive to processing latency (s)
+        '''
+        now = time.monotonic()
+        rate = (self.packets - self._last_packets) / max(now - self._last_time, 1e-9)
+        self._last_packets, self._last_time = self.packets, now
+        return rate, self.packets, self.kernel_drops, self.queue_drops, self.latency
+
+
+if __name__ == '__main__':
+    # Loopback throughput, blast N2K-like packets and drain at the GUI rate
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(('127.0.0.1', 0))
+    receiver = UdpReceiver(rx, logger=logging.getLogger('udp'), depth=100000)
+    receiver.start()
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    pkt = b'N2K,-42.88412345,147.32912345,1.25,183.4\n'
+    num = 200000
+    t = time.perf_counter()
+    for i in range(num):
+        tx.sendto(pkt, rx.getsockname())
+        if i % 1000 == 0:
+            receiver.drain()
+    time.sleep(0.5)
+    receiver.drain()
+    rate, packets, kernel, queued, latency = receiver.stats()
+    print(f'sent {num/(time.perf_counter()-t):.0f}/s, received {packets}, '
+          f'kernel drops {kernel}, queue drops {queued}, latency {latency*1e3:.2f}ms')
@@ -0,0 +1,270 @@
+import sys
+import time
+import socket
+import asyncio
+import logging
+from threading import Thread, Event
+
+import numpy as np
+
+from udp_telemetry import UdpReceiver
+from metrics import NULL_METRICS
+
+'''
+Networking core for the WAM-V GCS.
+An asyncio event loop on its own thread owns the UDP socket. It reads
+telemetry as it arrives, transmits the current command on a fixed period
+scheduled against absolute deadlines, so GUI load does not stretch the
+period, and runs the command watchdog. The GUI only sets the command,
+feeds the watchdog and drains received packets.
+Python work on the GUI thread holds the GIL, so the loop thread only gets
+in on time when the application lowers the interpreter switch interval,
+see sys.setswitchinterval.
+'''
+
+
+def format_cmd(pos_mode, thrust, rudder, pos_sp):
+    '''
+    WAM-V command line
+
+    :param pos_mode: send a position hold instead of thrust and rudder
+    :param thrust: thrust set point
+    :param rudder: rudder set point
+    :param pos_sp: lat, lon hold position
+    '''
+    if pos_mode:
+        return f'POSCMD,{pos_sp[0]},{pos_sp[1]}\n'.encode()
+    return f'{thrust:4d},{rudder:4d},{thrust:4d},{rudder:4d}\n'.encode()
+
+
+class VesselLink():
+    '''
+    UDP receive, fixed rate command transmission and watchdog.
+    Each command destination has its own command and watchdog, every
+    destination that has been given a command is sent it each period
+    until it is removed
+
+    :param sock: bound UDP socket
+    :param dest: default vessel command address for set_command and
+                 feed, nothing is sent to it before its first command
+    :param rate: command rate (Hz)
+    :param timeout: watchdog timeout (s), a destination's command is
+                    zeroed when feed() has not been called for this long
+    :param logger: logger for packets and watchdog events
+    :param metrics: metrics.Metrics for command counts and latency
+    '''
+
+    def __init__(self, sock, dest, rate=10., timeout=60., logger=None, metrics=NULL_METRICS):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.dest = dest
+        self.period = 1. / rate
+        self.timeout = timeout
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.receiver = UdpReceiver(sock, logger=self.logger)
+        self.metrics = metrics
+
+        # Set from the GUI thread, single item assignments
+        self.enabled = False
+        self.commands = {}
+        self.last_feed = {}
+        self.trips = {}
+        self.watchdog_trips = 0
+
+        # Commands actually sent, and send loop periods for jitter()
+        self.sends = 0
+        self.send_errors = 0
+        self.ticks = 0
+        self.tick_times = np.zeros(1000)
+
+        self.loop = asyncio.new_event_loop()
+        self._started = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self._started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.add_reader(self.sock.fileno(), self.receiver.read_ready)
+        self._tasks = [self.loop.create_task(self._send_loop()),
+                       self.loop.create_task(self._watchdog())]
+        self.loop.call_soon(self._started.set)
+        self.loop.run_forever()
+        self.loop.run_until_complete(asyncio.gather(*self._tasks, return_exceptions=True))
+        self.loop.remove_reader(self.sock.fileno())
+        self.loop.close()
+
+    def set_command(self, cmd, send_now=False, stamp=None, dest=None):
+        '''
+        Replace the command sent each period, thread safe
+
+        :param cmd: command bytes, see format_cmd
+        :param send_now: also send it straight away
+        :param stamp: monotonic time of the key press, for the key to
+                      socket latency of the immediate send
+        :param dest: command address, defaults to the link's
+        '''
+        dest = self.dest if dest is None else dest
+        if dest not in self.last_feed:
+            self.last_feed[dest] = time.monotonic()
+        self.commands[dest] = cmd
+        if send_now:
+            self.loop.call_soon_threadsafe(self._send, dest, stamp)
+
+    def feed(self, dest=None):
+        '''
+        Reset the watchdog, thread safe
+
+        :param dest: command address, defaults to the link's
+        '''
+        self.last_feed[self.dest if dest is None else dest] = time.monotonic()
+
+    def remove(self, dest):
+        '''
+        Stop sending to a destination and drop its watchdog, thread safe
+
+        :param dest: command address
+        '''
+        self.commands.pop(dest, None)
+        self.last_feed.pop(dest, None)
+
+    def flush(self, timeout=1.):
+        '''
+        Wait for the sends already queued with send_now to go out
+
+        :param timeout: longest wait (s)
+        :return: False if the loop did not get to them in time
+        '''
+        done = Event()
+        self.loop.call_soon_threadsafe(done.set)
+        return done.wait(timeout)
+
+    def drain(self):
+        '''
+        Packets received since the last call, see UdpReceiver.drain
+        '''
+        return self.receiver.drain()
+
+    def _send(self, dest, stamp=None):
+        cmd = self.commands.get(dest)
+        if not self.enabled or cmd is None:
+            return
+        try:
+            self.sock.sendto(cmd, dest)
+        except OSError:
+            self.send_errors += 1
+            return
+        self.sends += 1
+        self.metrics.event('cmd')
+        if stamp is not None:
+            self.metrics.since('key to socket', stamp)
+
+    async def _send_loop(self):
+        deadline = self.loop.time()
+        while True:
+            deadline += self.period
+            await asyncio.sleep(deadline - self.loop.time())
+            self.tick_times[self.ticks % len(self.tick_times)] = time.perf_counter()
+            self.ticks += 1
+            for dest in list(self.commands):
+                self._send(dest)
+            # Skip missed periods rather than bursting to catch up
+            if self.loop.time() - deadline > self.period:
+                deadline = self.loop.time()
+
+    async def _watchdog(self):
+        while True:
+            now = time.monotonic()
+            for dest in list(self.commands):
+                if now - self.last_feed.get(dest, now) < self.timeout:
+                    continue
+                self.commands[dest] = format_cmd(False, 0, 0, None)
+                self.trips[dest] = self.trips.get(dest, 0) + 1
+                self.watchdog_trips += 1
+                self.last_feed[dest] = now
+                self.logger.info(f'WATCHDOG {0:+04d} {0:+04d} {dest[0]}:{dest[1]}')
+            await asyncio.sleep(self.period)
+
+    def jitter(self):
+        '''
+        Command period statistics over the recent send loop periods
+
+        :return: mean period, standard deviation and worst deviation (s)
+        '''
+        n = min(self.ticks, len(self.tick_times))
+        if n < 3:
+            return np.nan, np.nan, np.nan
+        times = np.roll(self.tick_times, -(self.ticks % len(self.tick_times)))[-n:]
+        return period_stats(times, self.period)
+
+    def close(self):
+        '''
+        Stop the event loop
+        '''
+        def stop():
+            for task in self._tasks:
+                task.cancel()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(stop)
+        self.thread.join()
+
+
+def period_stats(times, period):
+    '''
+    Mean, standard deviation and worst deviation from period of the
+    intervals between times
+    '''
+    dt = np.diff(times)
+    return dt.mean(), dt.std(), np.abs(dt - period).max()
+
+
+def benchmark(load=0.03, duration=10., rate=10.):
+    '''
+    Command period jitter with a loaded GUI thread, comparing the old
+    Tk after() polling, which sends after each GUI tick, with the link
+
+    :param load: maximum GUI work per tick (s), uniformly random
+    :param duration: seconds per run
+    :param rate: command rate (Hz)
+    '''
+    sys.setswitchinterval(0.001)
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.bind(('127.0.0.1', 0))
+    rng = np.random.default_rng(0)
+
+    def gui_work():
+        end = time.perf_counter() + rng.uniform(0, load)
+        while time.perf_counter() < end:
+            pass
+
+    # Before: send, do the GUI work, after(100)
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    times = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        times.append(time.perf_counter())
+        tx.sendto(b'   0,   0,   0,   0\n', rx.getsockname())
+        gui_work()
+        time.sleep(1. / rate)
+    before = period_stats(np.array(times), 1. / rate)
+
+    # After: the link sends while the same work runs on this thread
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tx.bind(('127.0.0.1', 0))
+    link = VesselLink(tx, rx.getsockname(), rate=rate, timeout=duration*2)
+    link.set_command(format_cmd(False, 0, 0, None))
+    link.enabled = True
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        gui_work()
+        time.sleep(0.1)
+    after = link.jitter()
+    link.close()
+
+    for name, (mean, std, worst) in (('tk after', before), ('link', after)):
+        print(f'{name:>8}: period {mean*1e3:.2f}ms, std {std*1e3:.2f}ms, worst {worst*1e3:.2f}ms')
+    return before, after
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,195 @@
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from threading import Thread, Event
+
+import numpy as np
+import cv2
+
+from gcs_log import parse_time
+
+'''
+Camera recording for the GCS.
+Frames are encoded into segmented video files by a background thread.
+Each segment <prefix>_HHMMSS.avi has a sidecar <prefix>_HHMMSS.idx with
+one line per frame,
+
+    <frame number>,YYYYMMDD,HHMMSS,ffffff
+
+using the same timestamp format as the gcs_*.log records, so camera
+frames can be lined up offline with the LIDAR and ArUco data. The stamp
+is taken when the frame is handed over, the capture time when written
+from the capture thread, not when the encoder gets to it.
+'''
+
+
+class VideoRecorder():
+    '''
+    Segmented video writer running on its own thread
+
+    :param logdir: directory for the segments
+    :param prefix: segment file name prefix
+    :param fps: nominal frame rate stored in the video header
+    :param segment_seconds: start a new segment after this long
+    :param fourcc: video codec
+    :param max_frames: queue bound, frames beyond this are dropped
+    '''
+
+    def __init__(self, logdir, prefix='cam', fps=10., segment_seconds=600.,
+                 fourcc='MJPG', max_frames=30):
+        self.logdir = Path(logdir)
+        self.prefix = prefix
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.max_frames = max_frames
+
+        self.queue = deque()
+        self.dropped = 0
+        self.written = 0
+        self.segments = 0
+
+        self.writer = None
+        self.index = None
+        self._stop = Event()
+        self._wake = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, frame, stamp=None):
+        '''
+        Queue a frame for recording, never blocks. The frame is copied
+
+        :param frame: camera image
+        :param stamp: capture time as from time.time(), defaults to now
+        '''
+        if len(self.queue) >= self.max_frames:
+            self.dropped += 1
+            return False
+        self.queue.append((time.time() if stamp is None else stamp, frame.copy()))
+        self._wake.set()
+        return True
+
+    def close(self):
+        '''
+        Encode everything queued and close the current segment
+        '''
+        self._stop.set()
+        self._wake.set()
+        self.thread.join()
+        self._close_segment()
+
+    def _open_segment(self, shape):
+        stamp = f'{datetime.now():%H%M%S}'
+        path = self.logdir / f'{self.prefix}_{stamp}.avi'
+        n = 1
+        while path.exists():
+            path = self.logdir / f'{self.prefix}_{stamp}_{n}.avi'
+            n += 1
+        self.writer = cv2.VideoWriter(str(path), self.fourcc, self.fps, (shape[1], shape[0]))
+        self.index = open(path.with_suffix('.idx'), 'w')
+        self.shape = shape
+        self.frame_no = 0
+        self.opened = time.monotonic()
+        self.segments += 1
+
+    def _close_segment(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.index.close()
+            self.writer = None
+
+    def _run(self):
+        while True:
+            self._wake.wait(1.)
+            self._wake.clear()
+            while self.queue:
+                stamp, frame = self.queue.popleft()
+                if self.writer is None or frame.shape != self.shape or \
+                        time.monotonic() - self.opened >= self.segment_seconds:
+                    self._close_segment()
+                    self._open_segment(frame.shape)
+                self.writer.write(frame)
+                self.index.write(f'{self.frame_no},{datetime.fromtimestamp(stamp):%Y%m%d,%H%M%S,%f}\n')
+                self.frame_no += 1
+                self.written += 1
+            if self.index is not None:
+                self.index.flush()
+            if self._stop.is_set():
+                return
+
+
+class VideoLog():
+    '''
+    Reader for recorded segments, finds frames by log timestamp
+
+    :param logdir: directory holding the segments
+    :param prefix: segment file name prefix
+    '''
+
+    def __init__(self, logdir, prefix='cam'):
+        self.segments = []
+        segment, frame, stamp = [], [], []
+        for idx in sorted(Path(logdir).glob(f'{prefix}_*.idx')):
+            with open(idx) as f:
+                rows = [line.rstrip('\n').split(',') for line in f if line.strip()]
+            self.segments.append(idx.with_suffix('.avi'))
+            segment += [len(self.segments) - 1] * len(rows)
+            frame += [int(r[0]) for r in rows]
+            stamp += [parse_time(r[1:]) for r in rows]
+        order = np.argsort(np.array(stamp, dtype='datetime64[us]'), kind='stable')
+        self.time = np.array(stamp, dtype='datetime64[us]')[order]
+        self.segment = np.array(segment, dtype=np.int32)[order]
+        self.frame = np.array(frame, dtype=np.int64)[order]
+        self._caps = {}
+
+    def __len__(self):
+        return len(self.time)
+
+    def nearest(self, stamp):
+        '''
+        Index row of the frame closest in time to stamp
+
+        :param stamp: np.datetime64 or datetime
+        '''
+        stamp = np.datetime64(stamp, 'us')
+        i = int(np.searchsorted(self.time, stamp))
+        if i == len(self.time) or (i > 0 and stamp - self.time[i-1] < self.time[i] - stamp):
+            i -= 1
+        return i
+
+    def frame_at(self, stamp):
+        '''
+        Decode the frame closest in time to stamp
+
+        :param stamp: np.datetime64 or datetime
+        :return: frame timestamp and image, or None, None
+        '''
+        if not len(self.time):
+            return None, None
+        i = self.nearest(stamp)
+        seg = self.segment[i]
+        cap = self._caps.get(seg)
+        if cap is None:
+            cap = self._caps[seg] = cv2.VideoCapture(str(self.segments[seg]))
+        if cap.get(cv2.CAP_PROP_POS_FRAMES) != self.frame[i]:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(self.frame[i]))
+        ret, image = cap.read()
+        return self.time[i], image if ret else None
+
+    def close(self):
+        for cap in self._caps.values():
+            cap.release()
+        self._caps = {}
+
+
+if __name__ == '__main__':
+    import sys
+    log = VideoLog(sys.argv[1])
+    print(f'{len(log)} frames in {len(log.segments)} segments')
+    if len(log):
+        t = time.perf_counter()
+        for stamp in log.time[::max(1, len(log)//50)]:
+            log.frame_at(stamp)
+        print(f'seek and decode {(time.perf_counter()-t)*1e3/min(50, len(log)):.1f}ms/frame')
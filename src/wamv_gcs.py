@@ -1,17 +1,33 @@
-import numpy as np
+import sys
 import socket
-from threading import Thread
 import tkinter as tk
 import time
 import logging
-from datetime import datetime
-from pathlib import Path
 import pyproj
 
+from track_view import TrackRenderer, View
+from fleet import Fleet
+from udp_telemetry import setup_logging
+from vessel_link import VesselLink, format_cmd
+import metrics
+
 INC = 100
 MAX = 700
 MIN = -700
 TIMEOUT = 60
+CMD_RATE = 10
+# Interpreter thread switch interval (s), short so GUI work cannot hold
+# the link's event loop thread off for a full default 5ms slice
+SWITCH_INTERVAL = 0.001
+GCS_ADDR = ('192.168.168.77', 5000)
+WAMV_ADDR = ('192.168.168.200', 6000)
+# Vessels take commands on this port of their telemetry sender address,
+# None to reply to the sender address itself
+CMD_PORT = WAMV_ADDR[1]
+METRICS = True
+# Tracks other than the selected vessel's redraw their line every Nth update
+LINE_EVERY = 5
+PALETTE = ('deep sky blue', 'red', 'lime green', 'orange', 'magenta', 'cyan', 'yellow', 'white')
 
 class GCS(tk.Tk):
     ''' Ground Control System
@@ -25,6 +41,11 @@ class GCS(tk.Tk):
         self.wm_title("WAMV GCS")
         self.canvas = tk.Canvas(self, width=800, height=400, bg='black')
         self.canvas.grid(row=0,column=0,columnspan=4)
+        self.view = View(self.canvas, center=(400,200))
+        self.view.bind()
+        self.tracks = []
+        self.vessel_label = tk.Label(self, text='No vessel')
+        self.vessel_label.grid(row=1,column=0)
         self.enable = tk.Button(self, text='Enable', command = self.on_enable,bg='red')
         self.enable.grid(row=1,column=1,columnspan=2)
         self.stbd_slider = tk.Scale(self, from_=-1000, to=1000,orient=tk.HORIZONTAL)
@@ -32,35 +53,44 @@ class GCS(tk.Tk):
         self.port_slider = tk.Scale(self, from_=-1000, to=1000,orient=tk.HORIZONTAL)
         self.port_slider.grid(row=2,column=2)
         # Logging, data collection
-        logging.basicConfig(
-            handlers=[logging.FileHandler(time.strftime("%Y%m%d_%H%M%S_wamv.log",time.localtime())),logging.StreamHandler()],
-            level=logging.INFO,
-            format='%(asctime)s [%(levelname)s] [%(module)s] %(message)s')
+        # File and console I/O happens on a listener thread, console rate limited
+        self.log_listener = setup_logging(time.strftime("%Y%m%d_%H%M%S_wamv.log",time.localtime()), console_rate=5.)
         self.logger = logging.getLogger()
+        self.metrics = metrics.create(METRICS, time.strftime("%Y%m%d_%H%M%S_wamv_metrics.jsonl",time.localtime()))
+        self.stats_panel = metrics.stats_panel(self, self.metrics)
+        self.t_key = None
 
-        # Handle WAMV input
+        # Handle WAMV link, receive, command rate and watchdog run on the
+        # link's event loop, packets are parsed on the GUI thread
+        self.link = None
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            #self.sock.settimeout(0)
-            self.sock.bind(('192.168.168.77', 5000))
-            self.sock_thread = Thread(target=self.read_sock, daemon=True)
-            self.sock_thread.start()
+            self.sock.bind(GCS_ADDR)
+            self.link = VesselLink(self.sock, WAMV_ADDR, rate=CMD_RATE, timeout=TIMEOUT, logger=self.logger,
+                                   metrics=self.metrics)
+            self.logger.info('Starting WAMV link')
         except:
             print('Could not open WAMV interface')
+        self.watchdog_trips = 0
+        self.last_rx_stats = time.monotonic()
 
         # Events
+        self.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.bind('<KeyPress>', self.key_press)
         self.last_press = time.time()
         self.timer = self.after(1000,self.update)
 
         self.proj = pyproj.Proj(proj='utm', zone=55, ellps='WGS84',preserve_units=True)
 
-        # State
+        # State, per vessel records are demultiplexed by sender address.
+        # Keys drive the selected vessel, set points of the others are kept
+        self.fleet = Fleet(self.proj, command_port=CMD_PORT)
+        self.selected = 0
+        self.target = WAMV_ADDR
+        self.setpoints = {}
+        self.trips_seen = {}
+        self.ticks = 0
         self.enabled = False
-        self.last_pos = [0.,0.]
-        self.last_xy = [0., 0.]
-        self.origin = [0., 0.]
-        self.last_hdg = 0.
         self.last_port = [0, 0]
         self.last_stbd = [0, 0]
         self.pos_mode = False
@@ -91,7 +121,47 @@ class GCS(tk.Tk):
         #   GeoFence?
 
         self.pos_mode = True
-        self.pos_sp = self.last_pos.copy()
+        if len(self.fleet):
+            vessel = self.fleet.data[self.selected]
+            self.pos_sp = [float(vessel['lat']), float(vessel['lon'])]
+        else:
+            self.pos_sp = [0., 0.]
+
+
+    def command_dest(self):
+        # Selected vessel, or the default WAM-V before any telemetry
+        if len(self.fleet):
+            return self.fleet.command_addr(self.selected)
+        return WAMV_ADDR
+
+
+    def select_vessel(self, step=1):
+        ''' Move keyboard control to the next vessel
+                keeping the set points of the last one
+        '''
+        if not len(self.fleet):
+            return
+        self.setpoints[self.command_dest()] = (self.pos_mode, self.thrust_sp, self.rudder_sp, self.pos_sp)
+        self.selected = (self.selected + step) % len(self.fleet)
+        self.pos_mode, self.thrust_sp, self.rudder_sp, self.pos_sp = \
+            self.setpoints.get(self.command_dest(), (False, 0, 0, [0., 0.]))
+        self.vessel_label.configure(text=self.fleet.name(self.selected))
+        self.follow_target()
+
+
+    def follow_target(self):
+        ''' Drop the last command target from the link when
+                control moves off it and it is not in the fleet,
+                e.g. the default WAM-V once telemetry arrives
+        '''
+        dest = self.command_dest()
+        if dest == self.target:
+            return
+        last, self.target = self.target, dest
+        if self.link is None:
+            return
+        if last not in [self.fleet.command_addr(i) for i in range(len(self.fleet))]:
+            self.link.remove(last)
 
 
     def stop(self):
@@ -102,32 +172,45 @@ class GCS(tk.Tk):
     
 
     def send_cmd(self):
-        if not self.enabled:
+        ''' Hand the set points to the link
+                sent now and then at CMD_RATE while enabled
+        '''
+        if self.link is None:
             return
-        if self.pos_mode:
-            cmd = f'POSCMD,{self.pos_sp[0]},{self.pos_sp[1]}\n'
-        else:
-            cmd = f'{self.thrust_sp:4d},{self.rudder_sp:4d},{self.thrust_sp:4d},{self.rudder_sp:4d}\n'
-        try:
-            self.sock.sendto(cmd.encode(),('192.168.168.200', 6000))
-        except:
-            print('Could not send cmd')
+        cmd = format_cmd(self.pos_mode, self.thrust_sp, self.rudder_sp, self.pos_sp)
+        self.link.set_command(cmd, send_now=True, stamp=self.t_key, dest=self.command_dest())
+        self.t_key = None
 
 
     def update(self):
-        
-        # Check for timeout
-        if (time.time() - self.last_press) > TIMEOUT:
-            self.stop()
-            self.last_press = time.time()
-        
-        # Send latest command
-        self.send_cmd()
-        
-        # Update GUI
-        dx = 400 + self.last_xy[0] - self.origin[0]
-        dy = 200 + self.last_xy[1] - self.origin[1]
-        self.canvas.create_oval(dx-5,dy-5,dx+5,dy+5,fill='blue',outline='black')
+        ''' Update
+                GUI side only, commands and the watchdog
+                are timed by the link
+        '''
+        # Follow watchdog stops made by the link
+        if self.link is not None and self.link.watchdog_trips != self.watchdog_trips:
+            self.watchdog_trips = self.link.watchdog_trips
+            for dest, trips in list(self.link.trips.items()):
+                if trips == self.trips_seen.get(dest, 0):
+                    continue
+                self.trips_seen[dest] = trips
+                self.setpoints[dest] = (False, 0, 0, [0., 0.])
+                if dest == self.command_dest():
+                    self.pos_mode = False
+                    self.thrust_sp = 0
+                    self.rudder_sp = 0
+
+        # Handle packets received since the last update
+        fixes = self.read_sock()
+        self.follow_target()
+
+        # Update GUI, the selected track every update, the others staggered
+        self.ticks += 1
+        for i, track in enumerate(self.tracks):
+            track.draw(line=(i == self.selected or (self.ticks + i) % LINE_EVERY == 0))
+        if fixes is not None and self.selected in fixes:
+            self.metrics.since('position display', self.fleet.data['t_fix'][self.selected])
+        self.metrics.tick()
         
         self.timer = self.after(100, self.update)
 
@@ -140,13 +223,33 @@ class GCS(tk.Tk):
             self.enabled = True
             self.enable.configure(bg='green')
             self.enable.configure(text='Disable')
+        if self.link is not None:
+            self.link.enabled = self.enabled
+            self.send_cmd()
         self.logger.info(f'ENABLE: {self.enabled}')
 
 
+    def on_closing(self):
+        ''' Stop every commanded vessel, then shut down
+                the link, metrics and logging
+        '''
+        self.stop()
+        if self.link is not None:
+            stop_cmd = format_cmd(False, 0, 0, None)
+            for dest in list(self.link.commands):
+                self.link.set_command(stop_cmd, send_now=True, dest=dest)
+            self.link.flush()
+            self.link.close()
+        self.metrics.close()
+        self.log_listener.stop()
+        self.destroy()
+
+
     def key_press(self, event):
         ''' Keyboard callback
                 generates state commands as needed
         '''
+        self.t_key = self.metrics.now()
         if event.keysym == 'Up':
             self.set_thrust(True)
         elif event.keysym == 'Down':
@@ -157,10 +260,13 @@ class GCS(tk.Tk):
             self.set_rudder(False)
         elif event.keysym == 'h':
             self.set_hold()
+        elif event.keysym == 'Tab':
+            self.select_vessel(1)
+        elif event.keysym == 'ISO_Left_Tab':
+            self.select_vessel(-1)
         elif event.keysym == 'q':
-            self.stop()
-            time.sleep(1)
-            self.destroy()
+            self.on_closing()
+            return
         else:
             self.stop()
         if self.pos_mode:
@@ -169,90 +275,73 @@ class GCS(tk.Tk):
             self.logger.info(f'KEY:{event.keysym} {self.thrust_sp:+04d} {self.rudder_sp:+04d}')
         self.send_cmd()
         self.last_press = time.time()
+        if self.link is not None:
+            self.link.feed(self.command_dest())
     
 
     def read_sock(self):
-        self.logger.info('Starting WAMV read thread')
-        while True:
-            pkt,addr = self.sock.recvfrom(4096)
-            self.last_pkt = pkt.decode().strip()
-            self.logger.info(self.last_pkt)
-            fields = self.last_pkt.split(',')
-            if fields[0] == 'N2K':
-                self.last_pos = [float(fields[1]),float(fields[2])]
-                self.last_hdg = float(fields[4])
-                self.last_xy = self.proj(self.last_pos[1], self.last_pos[0])
-                if self.origin == [0.,0.]:
-                    self.origin = self.last_xy
-            elif fields[0] == 'HLC':
-                self.port_slider.set(int(fields[3]))
-                self.stbd_slider.set(int(fields[4]))
+        ''' WAMV input
+                drains packets queued by the link into the
+                fleet records, adds new fixes to the tracks
+                and shows the selected vessel's HLC state
+        '''
+        if self.link is None:
+            return None
+        packets = self.link.drain()
+        if self.metrics:
+            for t_recv, addr, fields in packets:
+                self.metrics.event(fields[0])
+                self.metrics.since('rx queue', t_recv)
+        fixes, hlcs, bad = self.fleet.ingest(packets)
+        for addr, fields in bad:
+            self.logger.warning(f'Bad packet from {addr}: {",".join(fields)}')
+
+        # New vessels get a track and the first one is selected
+        while len(self.tracks) < len(self.fleet):
+            i = len(self.tracks)
+            self.tracks.append(TrackRenderer(self.canvas, recent=300, history=1000, view=self.view,
+                                             colour=PALETTE[i % len(PALETTE)], label=self.fleet.name(i)))
+            self.logger.info(f'VESSEL {i} {self.fleet.name(i)}')
+            if i == 0:
+                self.vessel_label.configure(text=self.fleet.name(0))
+        data = self.fleet.data
+        for i in fixes:
+            self.tracks[i].add((data['x'][i], data['y'][i]))
+        if self.selected in hlcs:
+            self.port_slider.set(int(data['port'][self.selected]))
+            self.stbd_slider.set(int(data['stbd'][self.selected]))
+
+        # Link health
+        if time.monotonic() - self.last_rx_stats > 10.:
+            self.last_rx_stats = time.monotonic()
+            rate, packets, kernel, queued, latency = self.link.receiver.stats()
+            self.logger.info(f'RX {rate:.1f}/s {packets} packets from {len(self.fleet)} vessels, drops kernel {kernel} queue {queued}, latency {latency*1e3:.1f}ms')
+            mean, std, worst = self.link.jitter()
+            self.logger.info(f'TX {self.link.sends} commands, period {mean*1e3:.1f}ms std {std*1e3:.2f}ms worst {worst*1e3:.2f}ms')
+        return fixes
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='WAM-V ground control')
+    parser.add_argument('--local', default=None, help='host:port to receive telemetry on')
+    parser.add_argument('--wamv', default=None, help='host:port of the vessel, e.g. a simulators.py wamv')
+    parser.add_argument('--no-metrics', action='store_true', help='no latency stats panel or metrics file')
+    parser.add_argument('--reply-to-sender', action='store_true',
+                        help='send commands to each vessel\'s telemetry address, e.g. for simulators.py fleet')
+    parser.add_argument('--switch-interval', type=float, default=SWITCH_INTERVAL,
+                        help='interpreter thread switch interval (s)')
+    args = parser.parse_args()
+    sys.setswitchinterval(args.switch_interval)
+    METRICS = not args.no_metrics
+    if args.local:
+        host, port = args.local.rsplit(':', 1)
+        GCS_ADDR = (host, int(port))
+    if args.wamv:
+        host, port = args.wamv.rsplit(':', 1)
+        WAMV_ADDR = (host, int(port))
+        CMD_PORT = WAMV_ADDR[1]
+    if args.reply_to_sender:
+        CMD_PORT = None
     gcs = GCS()
     gcs.mainloop()
-import numpy as np
-import socket
-from threading import Thread
-import tkinter as tk
-import time
-import logging
-from datetime import datetime
-from pathlib import Path
-
-INC = 30
-MAX = 100
-MIN = -100
-
-class GCS(tk.Tk):
-    ''' Ground Control System
-            Extends a Tkinter window
-    '''
-
-    def __init__(self, *args, **kwargs):
-
-        # Init Tk
-        tk.Tk.__init__(self, *args, **kwargs)
-        self.wm_title("WAMV GCS")
-        self.canvas = tk.Canvas(self, width=800, height=400, bg='black')
-        self.canvas.pack()
-        # Logging, data collection
-        logging.basicConfig(
-                handlers=[logging.FileHandler(f'{datetime.now():%Y%m%d_%H%M%S_wamv.log}'), logging.StreamHandler()],
-                level=logging.INFO,
-                format='%(asctime)s [%(levelname)s] [%(modules)s] %(message)s')
-        self.logger = logging.getLogger()
-        # Handle WAMV input
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.setsockopt(socket.SOL_SOCKET, sock.SO_REUSEADDR, 1)
-            self.sock.settimeout(0)
-            self.sock_thread = Thread(target=self.read_sock, daemon=True)
-            self.sock_thread.start()
-        except:
-            print('Could not open WAMV interface')
-
-        # Events
-        self.bind('<KeyPress>', self.key_press)
-        self.last_press = time.time()
-        self.timer = self.after(50,self.update)
-        self.protocol("WM_DELETE_WINDOW", self.on_closing)
-        
-
-        # State
-        self.thrust = 0
-        self.rudder = 0
-
-    
-    '''
-    Utility Functions
-    '''
-    def set_thrust(self,increase=True):
-        if increase: d=INC
-        else: d=-INC
-        self.thrust = max(MIN,min(MAX,self.thrust+d))
-    def set_rudder(self,increase=True):
-        if increase: d=INC
-        else: d=-INC
-        self.rudder = max(MIN,min(MAX,self.rudder+d))